@@ -0,0 +1,165 @@
+"""Pool of warm SQL agents.
+
+Building an agent creates its model client and its tools, and renders the
+instructions and the semantic model into its prompt. None of it depends on the
+chat session, so instead of building a new agent whenever a Streamlit session
+starts, switches session, changes model or toggles debug mode, agents are taken
+from this pool and bound to the session they serve.
+
+Agents are pooled by (model_id, debug_mode). An agent taken from the pool is
+only used by its caller until it is released: the app holds one for a single
+run of its script, so an agent released by one browser session serves the next
+one. An idle agent still bound to the requested session is preferred, its
+session does not have to be read again. The pool keeps at most `max_size` idle
+agents, and drops those idle for more than `idle_timeout` seconds.
+"""
+
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Tuple
+from uuid import uuid4
+
+from agno.agent import Agent
+from agno.memory.agent import AgentMemory
+from agno.utils.log import log_debug
+
+PoolKey = Tuple[str, bool]
+
+
+@dataclass
+class PooledAgent:
+    agent: Agent
+    key: PoolKey
+    released_at: float
+
+
+def bind_session(agent: Agent, session_id: Optional[str] = None, user_id: Optional[str] = None) -> Agent:
+    """Point an agent at another session, dropping the state of its previous one.
+
+    The session is read from storage by the next `load_session()`, a new session
+    is started when `session_id` is None.
+    """
+    agent.session_id = session_id or str(uuid4())
+    agent.user_id = user_id
+    agent.session_name = None
+    agent.session_state = None
+    agent.agent_session = None
+    agent.memory = AgentMemory()
+    # load_agent_session() keeps these, or merges the stored ones into them, instead of replacing them
+    agent.extra_data = None
+    agent.session_metrics = None
+    agent.images = None
+    agent.videos = None
+    agent.audio = None
+    agent.run_id = None
+    agent.run_input = None
+    agent.run_messages = None
+    agent.run_response = None
+    return agent
+
+
+class AgentPool:
+    """Idle agents by (model_id, debug_mode), least recently released first"""
+
+    def __init__(
+        self,
+        factory: Callable[[str, bool], Agent],
+        max_size: int = 8,
+        idle_timeout: float = 1800,
+    ):
+        """
+        Args:
+            factory: Builds a new agent for a model_id and a debug_mode
+            max_size: Number of idle agents kept
+            idle_timeout: Seconds an idle agent is kept
+        """
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle: "OrderedDict[int, PooledAgent]" = OrderedDict()
+        self.keys: Dict[int, PoolKey] = {}
+        self.created = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    def evict(self) -> None:
+        """Drop the agents idle for too long, then the oldest ones over the pool size"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                agent_key for agent_key, pooled in self.idle.items() if now - pooled.released_at > self.idle_timeout
+            ]
+            for agent_key in expired:
+                self.drop(agent_key)
+            while len(self.idle) > self.max_size:
+                self.drop(next(iter(self.idle)))
+
+    def drop(self, agent_key: int) -> None:
+        pooled = self.idle.pop(agent_key)
+        self.keys.pop(agent_key, None)
+        log_debug(f"Evicted idle agent {pooled.key}")
+
+    def acquire(
+        self,
+        model_id: str,
+        debug_mode: bool = False,
+        session_id: Optional[str] = None,
+        user_id: Optional[str] = None,
+    ) -> Agent:
+        """Take an idle agent of the model and debug mode, or build one, bound to a session"""
+        self.evict()
+        key = (model_id, debug_mode)
+        agent = None
+        bound = False
+        with self._lock:
+            # Most recently released first, its prompt and client are the warmest
+            candidates = [agent_key for agent_key in reversed(self.idle) if self.idle[agent_key].key == key]
+            for agent_key in candidates:
+                idle_agent = self.idle[agent_key].agent
+                if session_id is not None and idle_agent.session_id == session_id and idle_agent.user_id == user_id:
+                    # Still bound to the session, with its memory loaded
+                    agent, bound = self.idle.pop(agent_key).agent, True
+                    break
+            if agent is None and candidates:
+                agent = self.idle.pop(candidates[0]).agent
+            if agent is not None:
+                self.reused += 1
+        if agent is None:
+            agent = self.factory(model_id, debug_mode)
+            with self._lock:
+                self.keys[id(agent)] = key
+                self.created += 1
+            # Agents of sessions that never release them are garbage collected, forget their key
+            weakref.finalize(agent, self.forget, id(agent))
+            log_debug(f"Created agent {key} ({self.stats()})")
+        else:
+            log_debug(f"Reused agent {key}{' of the session' if bound else ''} ({self.stats()})")
+        return agent if bound else bind_session(agent, session_id=session_id, user_id=user_id)
+
+    def release(self, agent: Optional[Agent]) -> None:
+        """Give an agent back to the pool, it must not be used by the caller afterwards"""
+        if agent is None:
+            return
+        with self._lock:
+            key = self.keys.get(id(agent))
+            if key is None:
+                # Not built by this pool, e.g. an agent created before a restart of the pool
+                return
+            self.idle[id(agent)] = PooledAgent(agent=agent, key=key, released_at=time.monotonic())
+            self.idle.move_to_end(id(agent))
+        self.evict()
+
+    def forget(self, agent_key: int) -> None:
+        with self._lock:
+            self.keys.pop(agent_key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            for agent_key in list(self.idle):
+                self.drop(agent_key)
+
+    def stats(self) -> Dict[str, int]:
+        return {"created": self.created, "reused": self.reused, "idle": len(self.idle)}
@@ -20,350 +20,286 @@ Examples with table joins:
 View the README for instructions on how to run the application.
 """
 
-import json
-from pathlib import Path
+from datetime import timedelta
+from functools import lru_cache
+from importlib import import_module
 from textwrap import dedent
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
 
 from agno.agent import Agent
-from agno.embedder.openai import OpenAIEmbedder
-from agno.knowledge.combined import CombinedKnowledgeBase
-from agno.knowledge.json import JSONKnowledgeBase
-from agno.knowledge.text import TextKnowledgeBase
-from agno.models.anthropic import Claude
-from agno.models.google import Gemini
-from agno.models.groq import Groq
-from agno.models.openai import OpenAIChat
-from agno.storage.agent.postgres import PostgresAgentStorage
-from agno.tools.file import FileTools
-from agno.tools.sql import SQLTools
-from agno.vectordb.pgvector import PgVector
-
-# ************* Database Connection *************
-db_url = "postgresql+psycopg://ai:ai@localhost:5532/ai"
-# *******************************
+from semantic_model import SemanticModelPrompt, semantic_model
+from settings import cwd, db_url, knowledge_dir, output_dir
+
+if TYPE_CHECKING:
+    from agent_pool import AgentPool
+    from join_planner import JoinGraph
+    from agno.knowledge.combined import CombinedKnowledgeBase
+    from agno.models.base import Model
+    from question_cache import QuestionCache
+    from retrieval import KnowledgeRetriever
+    from rollups import RollupRewriter
+    from schema import TableSchema
+    from schema_catalog import SchemaCatalog
+    from session_compaction import CompactingAgentStorage
+    from session_index import SessionIndex
+    from sql_tools import QueryResultCache
+    from sqlalchemy import Engine
+
+# ************* Model Providers *************
+# Module and class of the model of each provider. A provider's SDK is only
+# imported when an agent uses one of its models.
+model_providers: Dict[str, Tuple[str, str]] = {
+    "openai": ("agno.models.openai", "OpenAIChat"),
+    "google": ("agno.models.google", "Gemini"),
+    "anthropic": ("agno.models.anthropic", "Claude"),
+    "groq": ("agno.models.groq", "Groq"),
+}
+
+
+def get_model(model_id: str, tool_concurrency: int = 1) -> "Model":
+    """Create the model of a model identifier in format 'provider:model_name'
+
+    Args:
+        model_id: Model identifier in format 'provider:model_name'
+        tool_concurrency: Tool calls of a model response run at the same time, 1 to run them one after another
+    """
+    provider, model_name = model_id.split(":")
+    if provider not in model_providers:
+        raise ValueError(f"Unsupported model provider: {provider}")
+    module_name, class_name = model_providers[provider]
+    model_class = getattr(import_module(module_name), class_name)
+    if tool_concurrency <= 1:
+        return model_class(id=model_name)
+
+    from concurrent_tools import concurrent_model_class
+
+    model = concurrent_model_class(model_class)(id=model_name)
+    model.tool_concurrency = tool_concurrency
+    return model
 
-# ************* Paths *************
-cwd = Path(__file__).parent
-knowledge_dir = cwd.joinpath("knowledge")
-output_dir = cwd.joinpath("output")
 
-# Create the output directory if it does not exist
-output_dir.mkdir(parents=True, exist_ok=True)
 # *******************************
 
-# ************* Storage & Knowledge *************
-agent_storage = PostgresAgentStorage(
-    db_url=db_url,
-    # Store agent sessions in the ai.sql_agent_sessions table
-    table_name="sql_agent_sessions",
-    schema="ai",
-)
-agent_knowledge = CombinedKnowledgeBase(
-    sources=[
-        # Reads text files, SQL files, and markdown files
-        TextKnowledgeBase(
-            path=knowledge_dir,
-            formats=[".txt", ".sql", ".md"],
-        ),
-        # Reads JSON files
-        JSONKnowledgeBase(path=knowledge_dir),
-    ],
-    # Store agent knowledge in the ai.sql_agent_knowledge table
-    vector_db=PgVector(
-        db_url=db_url,
-        table_name="sql_agent_knowledge",
+# ************* Shared Resources *************
+# The resources below are created on first use and then shared by every agent in
+# the process, so importing this module neither connects to the database nor
+# builds the knowledge indexes.
+
+
+@lru_cache(maxsize=None)
+def get_db_engine() -> "Engine":
+    """One pooled engine shared by the storage, the vector db, the SQL tools and the caches"""
+    from db import get_engine
+
+    return get_engine(db_url)
+
+
+@lru_cache(maxsize=None)
+def get_table_schemas() -> Dict[str, "TableSchema"]:
+    """Tables described by the metadata files of the knowledge directory"""
+    from schema import load_table_schemas
+
+    return load_table_schemas(knowledge_dir)
+
+
+@lru_cache(maxsize=None)
+def get_schema_catalog() -> "SchemaCatalog":
+    """Tables and columns of the database, read once and refreshed when the tables are reloaded or altered"""
+    from schema_catalog import SchemaCatalog
+
+    return SchemaCatalog(
+        db_engine=get_db_engine(),
+        table_descriptions={table["table_name"]: table["table_description"] for table in semantic_model["tables"]},
+    )
+
+
+@lru_cache(maxsize=None)
+def get_agent_storage() -> "CompactingAgentStorage":
+    from session_compaction import CompactingAgentStorage, SessionCompactor
+
+    return CompactingAgentStorage(
+        db_engine=get_db_engine(),
+        # Store agent sessions in the ai.sql_agent_sessions table
+        table_name="sql_agent_sessions",
         schema="ai",
-        # Use OpenAI embeddings
-        embedder=OpenAIEmbedder(id="text-embedding-3-small"),
-    ),
-    # 5 references are added to the prompt
-    num_documents=5,
-)
+        # Tool results over 4 KB are stored out of line, runs older than 30 days are archived
+        compactor=SessionCompactor(
+            db_engine=get_db_engine(), max_inline_bytes=4_000, archive_after=timedelta(days=30)
+        ),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_session_index() -> "SessionIndex":
+    """Ids and names of the sessions of the agent storage, for the session selector"""
+    from session_index import SessionIndex
+
+    agent_storage = get_agent_storage()
+    return SessionIndex(
+        db_engine=get_db_engine(), table_name=agent_storage.table_name, schema=agent_storage.schema, ttl=10
+    )
+
+
+@lru_cache(maxsize=None)
+def get_agent_knowledge() -> "CombinedKnowledgeBase":
+    from agno.embedder.openai import OpenAIEmbedder
+    from agno.knowledge.combined import CombinedKnowledgeBase
+    from agno.knowledge.json import JSONKnowledgeBase
+    from agno.knowledge.text import TextKnowledgeBase
+    from agno.vectordb.pgvector import PgVector
+    from embeddings import CachedEmbedder
+    from retrieval import SampleQueriesKnowledgeBase
+
+    return CombinedKnowledgeBase(
+        sources=[
+            # Reads text and markdown files
+            TextKnowledgeBase(
+                path=knowledge_dir,
+                formats=[".txt", ".md"],
+            ),
+            # Reads SQL files, one document per sample query and its description
+            SampleQueriesKnowledgeBase(path=knowledge_dir),
+            # Reads JSON files
+            JSONKnowledgeBase(path=knowledge_dir),
+        ],
+        # Store agent knowledge in the ai.sql_agent_knowledge table
+        vector_db=PgVector(
+            db_engine=get_db_engine(),
+            table_name="sql_agent_knowledge",
+            schema="ai",
+            # Use OpenAI embeddings, cached on disk so identical texts are only embedded once
+            embedder=CachedEmbedder(
+                embedder=OpenAIEmbedder(id="text-embedding-3-small"),
+                cache_path=cwd.joinpath(".cache", "embeddings.sqlite3"),
+            ),
+        ),
+        # 3 references are added to the prompt, each one a complete table or sample query
+        num_documents=3,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_knowledge_retriever() -> "KnowledgeRetriever":
+    """Exact table name searches are answered from the metadata files loaded in memory,
+    other searches combine the vector db with a keyword index of the same documents"""
+    from retrieval import BM25Index, KnowledgeRetriever, TableMetadataIndex
+
+    agent_knowledge = get_agent_knowledge()
+    return KnowledgeRetriever(
+        knowledge=agent_knowledge,
+        table_index=TableMetadataIndex(knowledge_dir),
+        keyword_index=BM25Index.from_knowledge(agent_knowledge),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_query_result_cache() -> "QueryResultCache":
+    """Results of read queries are shared by every agent in the process, and dropped
+    when `load_retail_data()` reloads a table they read"""
+    from sql_tools import QueryResultCache
+
+    return QueryResultCache(db_engine=get_db_engine(), max_entries=256, ttl=600)
+
+
+@lru_cache(maxsize=None)
+def get_rollup_rewriter() -> "RollupRewriter":
+    """Aggregate queries over the fact tables are run against the pre-aggregated
+    rollups built by `load_retail_data()` when the result is the same"""
+    from rollups import RollupRewriter
+
+    return RollupRewriter(db_engine=get_db_engine(), table_schemas=get_table_schemas())
+
+
+@lru_cache(maxsize=None)
+def get_question_cache() -> "QuestionCache":
+    """Questions answered before are matched by embedding, and the query that answered
+    them is run again instead of going through the whole agent loop"""
+    from question_cache import QuestionCache
+
+    return QuestionCache(
+        db_engine=get_db_engine(), embedder=get_agent_knowledge().vector_db.embedder, threshold=0.95
+    )
+
+
+@lru_cache(maxsize=None)
+def get_agent_pool() -> "AgentPool":
+    """Warm agents shared by the Streamlit sessions, each one bound to the session using it"""
+    from agent_pool import AgentPool
+
+    return AgentPool(
+        factory=lambda model_id, debug_mode: get_sql_agent(model_id=model_id, debug_mode=debug_mode),
+        max_size=8,
+        idle_timeout=1800,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_join_graph() -> "JoinGraph":
+    """Shortest join paths between all the tables, computed once from the relationships of the semantic model"""
+    from join_planner import JoinGraph
+
+    return JoinGraph(semantic_model)
+
+
+# Module attributes of the shared resources, e.g. `from agents import agent_knowledge`,
+# resolved on first access
+shared_resources = {
+    "db_engine": get_db_engine,
+    "table_schemas": get_table_schemas,
+    "schema_catalog": get_schema_catalog,
+    "agent_storage": get_agent_storage,
+    "session_index": get_session_index,
+    "agent_knowledge": get_agent_knowledge,
+    "knowledge_retriever": get_knowledge_retriever,
+    "query_result_cache": get_query_result_cache,
+    "rollup_rewriter": get_rollup_rewriter,
+    "question_cache": get_question_cache,
+    "join_graph": get_join_graph,
+    "agent_pool": get_agent_pool,
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in shared_resources:
+        return shared_resources[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # *******************************
 
 # ************* Semantic Model *************
-# The semantic model helps the agent identify the tables and columns to use
-# This is sent in the system prompt, the agent then uses the `search_knowledge_base` tool to get table metadata, rules and sample queries
-# This is very much how data analysts and data scientists work:
-#  - We start with a set of tables and columns that we know are relevant to the task
-#  - We then use the `search_knowledge_base` tool to get more information about the tables and columns
-#  - We then use the `search_knowledge_base` tool to get sample queries for the tables and columns
-#  - We then use the `describe_table` tool to get more information about the tables and columns
-semantic_model = {
-    "tables": [
-        {
-            "table_name": "DIM_CUSTOMER",
-            "table_description": "Customer dimension table for loyalty analysis with customer details and segments.",
-            "Use Case": "Use this table for customer profiling, loyalty analysis, and demographic studies.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"customer_id": "customer_id"},
-                    "description": "One customer makes many sales"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_DATE",
-            "table_description": "Date dimension table with calendar attributes for time-based analysis.",
-            "Use Case": "Use this table for temporal analysis, seasonality studies, and periodic reporting.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "One date has many sales"
-                },
-                {
-                    "related_table": "FACT_INVENTORY",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "One date has many inventory records"
-                },
-                {
-                    "related_table": "FACT_PURCHASE_ORDERS",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "One date has many purchase orders"
-                },
-                {
-                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "One date has many employee performance records"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_EMPLOYEE",
-            "table_description": "Employee dimension table with personnel details and roles.",
-            "Use Case": "Use this table for workforce analysis, performance evaluation, and organizational studies.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"employee_id": "employee_id"},
-                    "description": "One employee processes many sales"
-                },
-                {
-                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"employee_id": "employee_id"},
-                    "description": "One employee has many performance records"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_PRODUCT",
-            "table_description": "Product dimension table with catalog information, pricing, and suppliers.",
-            "Use Case": "Use this table for product analysis, category performance, and pricing strategies.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "One product included in many sales"
-                },
-                {
-                    "related_table": "FACT_INVENTORY",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "One product has many inventory records"
-                },
-                {
-                    "related_table": "FACT_PURCHASE_ORDERS",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "One product ordered in many purchase orders"
-                },
-                {
-                    "related_table": "DIM_SUPPLIER",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"supplier_id": "supplier_id"},
-                    "description": "Many products provided by one supplier"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_PROMOTION",
-            "table_description": "Promotion dimension table with campaign details and discounts.",
-            "Use Case": "Use this table for promotional effectiveness, campaign analysis, and discount evaluation.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"promotion_id": "promotion_id"},
-                    "description": "One promotion applied to many sales"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_STORE",
-            "table_description": "Store dimension table with location details and attributes.",
-            "Use Case": "Use this table for location analysis, store performance, and geographical studies.",
-            "relationships": [
-                {
-                    "related_table": "FACT_SALES",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "One store generates many sales"
-                },
-                {
-                    "related_table": "FACT_INVENTORY",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "One store maintains many inventory records"
-                },
-                {
-                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "One store has many employee performance records"
-                }
-            ]
-        },
-        {
-            "table_name": "DIM_SUPPLIER",
-            "table_description": "Supplier dimension table with vendor details and terms.",
-            "Use Case": "Use this table for supplier performance, vendor relations, and procurement analysis.",
-            "relationships": [
-                {
-                    "related_table": "DIM_PRODUCT",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"supplier_id": "supplier_id"},
-                    "description": "One supplier provides many products"
-                },
-                {
-                    "related_table": "FACT_PURCHASE_ORDERS",
-                    "relationship_type": "one-to-many",
-                    "join_columns": {"supplier_id": "supplier_id"},
-                    "description": "One supplier receives many purchase orders"
-                }
-            ]
-        },
-        {
-            "table_name": "FACT_EMPLOYEE_PERFORMANCE",
-            "table_description": "Employee performance fact table with metrics and KPIs.",
-            "Use Case": "Use this table for workforce productivity analysis, performance evaluation, and HR analytics.",
-            "relationships": [
-                {
-                    "related_table": "DIM_DATE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "Many performance records belong to one date"
-                },
-                {
-                    "related_table": "DIM_EMPLOYEE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"employee_id": "employee_id"},
-                    "description": "Many performance records belong to one employee"
-                },
-                {
-                    "related_table": "DIM_STORE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "Many performance records belong to one store"
-                }
-            ]
-        },
-        {
-            "table_name": "FACT_INVENTORY",
-            "table_description": "Inventory fact table for stock level analysis, with quantities and costs.",
-            "Use Case": "Use this table for stock level monitoring, inventory turnover analysis, and stockout prevention.",
-            "relationships": [
-                {
-                    "related_table": "DIM_DATE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "Many inventory records belong to one date"
-                },
-                {
-                    "related_table": "DIM_STORE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "Many inventory records maintained by one store"
-                },
-                {
-                    "related_table": "DIM_PRODUCT",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "Many inventory records for one product"
-                }
-            ]
-        },
-        {
-            "table_name": "FACT_PURCHASE_ORDERS",
-            "table_description": "Purchase orders fact table for procurement analysis.",
-            "Use Case": "Use this table for procurement analysis, supplier performance, and order fulfillment studies.",
-            "relationships": [
-                {
-                    "related_table": "DIM_DATE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "Many purchase orders belong to one date"
-                },
-                {
-                    "related_table": "DIM_SUPPLIER",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"supplier_id": "supplier_id"},
-                    "description": "Many purchase orders placed with one supplier"
-                },
-                {
-                    "related_table": "DIM_PRODUCT",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "Many purchase orders for one product"
-                }
-            ]
+# The semantic model, see `semantic_model.py`, is sent in the prompt in a compact form,
+# pruned to the tables relevant to the question being answered
+
+
+@lru_cache(maxsize=None)
+def get_semantic_model_prompt() -> SemanticModelPrompt:
+    """Tables are matched to questions by the words of their names, descriptions and columns"""
+    return SemanticModelPrompt(
+        semantic_model,
+        table_columns={
+            name: [column.name for column in table.columns] for name, table in get_table_schemas().items()
         },
-        {
-            "table_name": "FACT_SALES",
-            "table_description": "Sales fact table for transaction analysis with pricing, quantities, and margins.",
-            "Use Case": "Use this table for sales performance analysis, profitability studies, and customer purchasing behavior.",
-            "relationships": [
-                {
-                    "related_table": "DIM_DATE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"date_id": "date_id"},
-                    "description": "Many sales belong to one date"
-                },
-                {
-                    "related_table": "DIM_STORE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"store_id": "store_id"},
-                    "description": "Many sales generated by one store"
-                },
-                {
-                    "related_table": "DIM_PRODUCT",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"product_id": "product_id"},
-                    "description": "Many sales include one product"
-                },
-                {
-                    "related_table": "DIM_CUSTOMER",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"customer_id": "customer_id"},
-                    "description": "Many sales made by one customer"
-                },
-                {
-                    "related_table": "DIM_PROMOTION",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"promotion_id": "promotion_id"},
-                    "description": "Many sales applied with one promotion"
-                },
-                {
-                    "related_table": "DIM_EMPLOYEE",
-                    "relationship_type": "many-to-one",
-                    "join_columns": {"employee_id": "employee_id"},
-                    "description": "Many sales processed by one employee"
-                }
-            ]
-        }
-    ]
-}
-semantic_model_str = json.dumps(semantic_model, indent=2)
+    )
+
+
+def semantic_model_context(question: Optional[str] = None) -> str:
+    """The `additional_context` of the agent, describing the tables relevant to a question.
+
+    Set it before each run, e.g. `agent.additional_context = semantic_model_context(question)`,
+    without a question every table is described.
+    """
+    return (
+        dedent("""\n
+        The `semantic_model` contains information about tables and the relationships between them.
+        If the users asks about the tables you have access to, simply share the table names from the `semantic_model`.
+        <semantic_model>
+        """)
+        + get_semantic_model_prompt().build(question)
+        + dedent("""
+        </semantic_model>\
+        """)
+    )
 # *******************************
 
 
@@ -373,6 +309,7 @@ def get_sql_agent(
     model_id: str = "openai:gpt-4o",
     session_id: Optional[str] = None,
     debug_mode: bool = True,
+    tool_concurrency: int = 4,
 ) -> Agent:
     """Returns an instance of the SQL Agent.
 
@@ -380,29 +317,27 @@ def get_sql_agent(
         user_id: Optional user identifier
         debug_mode: Enable debug logging
         model_id: Model identifier in format 'provider:model_name'
+        tool_concurrency: Tool calls of a model response run at the same time, 1 to run them one after another
     """
-    # Parse model provider and name
-    provider, model_name = model_id.split(":")
+    from agno.tools.file import FileTools
+    from join_planner import JoinPlannerTools
+    from preflight import SQLPreflight
+    from sql_tools import RetailSQLTools
 
-    # Select appropriate model class based on provider
-    if provider == "openai":
-        model = OpenAIChat(id=model_name)
-    elif provider == "google":
-        model = Gemini(id=model_name)
-    elif provider == "anthropic":
-        model = Claude(id=model_name)
-    elif provider == "groq":
-        model = Groq(id=model_name)
-    else:
-        raise ValueError(f"Unsupported model provider: {provider}")
+    # Only the SDK of the selected provider is imported. Independent tool calls
+    # of a response, e.g. describing several tables, run concurrently
+    model = get_model(model_id, tool_concurrency=tool_concurrency)
+    # Query results too large for the prompt are written to the output directory
+    output_dir.mkdir(parents=True, exist_ok=True)
 
     return Agent(
         name=name,
         model=model,
         user_id=user_id,
         session_id=session_id,
-        storage=agent_storage,
-        knowledge=agent_knowledge,
+        storage=get_agent_storage(),
+        knowledge=get_agent_knowledge(),
+        retriever=get_knowledge_retriever(),
         # Enable Agentic RAG i.e. the ability to search the knowledge base on-demand
         search_knowledge=True,
         # Enable the ability to read the chat history
@@ -411,7 +346,25 @@ def get_sql_agent(
         read_tool_call_history=True,
         # Add tools to the agent
         tools=[
-            SQLTools(db_url=db_url, list_tables=False),
+            RetailSQLTools(
+                db_engine=get_db_engine(),
+                list_tables=False,
+                result_cache=get_query_result_cache(),
+                rollup_rewriter=get_rollup_rewriter(),
+                # Results over 200 rows or 20 KB are truncated, the whole result is written to the output directory on request
+                max_rows=200,
+                max_bytes=20_000,
+                spill_dir=output_dir,
+                # Queries are checked with EXPLAIN before running, and canceled after 30 seconds
+                max_cost=5_000_000,
+                statement_timeout=30,
+                # Table names are quoted and a LIMIT is added locally, before the query reaches the database
+                preflight=SQLPreflight(get_table_schemas(), auto_limit=1_000),
+                # Tables are described from a snapshot of the catalog held in memory
+                schema_catalog=get_schema_catalog(),
+            ),
+            # Join clauses of a set of tables, from the relationships of the semantic model
+            JoinPlannerTools(get_join_graph()),
             FileTools(base_dir=output_dir),
         ],
         debug_mode=debug_mode,
@@ -434,14 +387,20 @@ def get_sql_agent(
 
         If you need to query the database to answer the user's question, follow these steps:
         1. First identify the tables you need to query from the semantic model.
-        2. Then, ALWAYS use the `search_knowledge_base(table_name)` tool to get table metadata, rules and sample queries.
+        2. Then, ALWAYS use the `search_knowledge_base(table_name)` tool to get table metadata and rules.
+            - You can pass several table names at once, separated by commas, e.g. `search_knowledge_base("FACT_SALES, DIM_DATE")`.
+            - To find sample queries, search the knowledge base with a short description of the question instead of a table name.
         3. If table rules are provided, ALWAYS follow them.
         4. Then, "think" about query construction, don't rush this step.
         5. Follow a chain of thought approach before writing SQL, ask clarifying questions where needed.
         6. If sample queries are available, use them as a reference.
         7. If you need more information about the table, use the `describe_table` tool.
+            - It also gives the approximate row count of the table, use it to judge how much data a query reads.
         8. Then, using all the information available, create one single syntactically correct PostgreSQL query to accomplish your task.
-        9. If you need to join tables, check the `semantic_model` for the relationships between the tables.
+        9. If you need to join tables, use the `plan_joins` tool with the names of the tables, e.g. `plan_joins("FACT_SALES, DIM_STORE")`.
+            - It returns the FROM and JOIN clauses from the relationships of the `semantic_model`, use them and follow its `notes`.
+            - For several fact tables it returns a query template instead, aggregating each fact table in a CTE before joining them: fill it in, never join fact tables directly.
+            - The result may add tables needed to connect the ones you gave.
             - If the `semantic_model` contains a relationship between tables, use that relationship to join the tables even if the column names are different.
             - If you cannot find a relationship in the `semantic_model`, only join on the columns that have the same name and data type.
             - If you cannot find a valid relationship, ask the user to provide the column name to join.
@@ -452,6 +411,7 @@ def get_sql_agent(
             - The table name must be put inside the quotation marks. For example: SELECT ... FROM "<table_name>" WHERE ...
             - Do not add a `;` at the end of the query.
             - Always provide a limit unless the user explicitly asks for all results.
+            - If the query is rejected for its estimated cost or times out, fix the query using the `hint` of the error instead of running it again as is.
         13. After you run the query, "analyze" the results and return the answer in markdown format.
         14. Make sure to always "analyze" the results of the query before returning the answer.
         15. You Analysis should Reason about the results of the query, whether they make sense, whether they are complete, whether they are correct, could there be any data quality issues, etc.
@@ -478,13 +438,6 @@ def get_sql_agent(
         - ALWAYS FOLLOW THE `table rules` if provided. NEVER IGNORE THEM.
         </rules>\
         """),
-        additional_context=dedent("""\n
-        The `semantic_model` contains information about tables and the relationships between them.
-        If the users asks about the tables you have access to, simply share the table names from the `semantic_model`.
-        <semantic_model>
-        """)
-        + semantic_model_str
-        + dedent("""
-        </semantic_model>\
-        """),
+        # Replaced before each run by the tables relevant to the question
+        additional_context=semantic_model_context(),
     )
@@ -1,12 +1,17 @@
 import nest_asyncio
 import streamlit as st
-from agents import get_sql_agent
+from agents import get_agent_pool, get_question_cache, semantic_model_context
 from agno.agent import Agent
+from agno.models.message import Message
 from agno.utils.log import logger
 from utils import (
     CUSTOM_CSS,
     add_message,
+    display_chat_history,
     display_tool_calls,
+    load_run_history,
+    mark_runs_loaded,
+    pool_metrics_widget,
     rename_session_widget,
     session_selector_widget,
     sidebar_widget,
@@ -68,22 +73,24 @@ def main() -> None:
     model_id = model_options[selected_model]
 
     ####################################################################
-    # Initialize Agent
+    # Get an Agent from the pool
     ####################################################################
-    sql_agent: Agent
-    if (
-            "sql_agent" not in st.session_state
-            or st.session_state["sql_agent"] is None
-            or st.session_state.get("current_model") != model_id
-            or st.session_state.get("debug_mode_value") != DEBUG_MODE
-    ):
-        logger.info("---*--- Creating new SQL agent ---*---")
-        sql_agent = get_sql_agent(model_id=model_id, debug_mode=DEBUG_MODE)
-        st.session_state["sql_agent"] = sql_agent
-        st.session_state["current_model"] = model_id
-    else:
-        sql_agent = st.session_state["sql_agent"]
+    # The agent is only held for this run of the script, so the idle agents
+    # serve every browser session and not only the one that built them
+    logger.debug("---*--- Getting SQL agent from the pool ---*---")
+    sql_agent = get_agent_pool().acquire(
+        model_id=model_id,
+        debug_mode=DEBUG_MODE,
+        session_id=st.session_state.get("sql_agent_session_id"),
+    )
+    try:
+        chat(sql_agent, model_id, DEBUG_MODE)
+    finally:
+        get_agent_pool().release(sql_agent)
+
 
+def chat(sql_agent: Agent, model_id: str, debug_mode: bool) -> None:
+    """Chat with the agent, bound to the chat session of this browser session"""
     ####################################################################
     # Load Agent Session from the database
     ####################################################################
@@ -96,18 +103,7 @@ def main() -> None:
     ####################################################################
     # Load runs from memory
     ####################################################################
-    agent_runs = sql_agent.memory.runs
-    if len(agent_runs) > 0:
-        logger.debug("Loading run history")
-        st.session_state["messages"] = []
-        for _run in agent_runs:
-            if _run.message is not None:
-                add_message(_run.message.role, _run.message.content)
-            if _run.response is not None:
-                add_message("assistant", _run.response.content, _run.response.tools)
-    else:
-        logger.debug("No run history found")
-        st.session_state["messages"] = []
+    load_run_history(sql_agent)
 
     ####################################################################
     # Sidebar
@@ -123,15 +119,7 @@ def main() -> None:
     ####################################################################
     # Display chat history
     ####################################################################
-    for message in st.session_state["messages"]:
-        if message["role"] in ["user", "assistant"]:
-            _content = message["content"]
-            if _content is not None:
-                with st.chat_message(message["role"]):
-                    # Display tool calls if they exist in the message and debug mode is enabled
-                    if DEBUG_MODE and "tool_calls" in message and message["tool_calls"]:
-                        display_tool_calls(st.empty(), message["tool_calls"])
-                    st.markdown(_content)
+    display_chat_history(debug_mode)
 
     ####################################################################
     # Generate response for user message
@@ -143,29 +131,46 @@ def main() -> None:
         question = last_message["content"]
         with st.chat_message("assistant"):
             # Create container for tool calls if debug mode is enabled
-            tool_calls_container = st.empty() if DEBUG_MODE else None
+            tool_calls_container = st.empty() if debug_mode else None
             resp_container = st.empty()
             with st.spinner("🤔 Thinking..."):
                 response = ""
                 try:
+                    # Describe the tables relevant to the question, and to the previous one for follow-ups
+                    recent_questions = [m["content"] for m in st.session_state["messages"] if m["role"] == "user"][-2:]
+                    sql_agent.additional_context = semantic_model_context(" ".join(recent_questions))
+                    # Reuse the query of a similar question answered before,
+                    # the agent then only has to format its result
+                    cached_answer = get_question_cache().answer(question, sql_agent)
                     # Run the agent and stream the response
                     run_response = sql_agent.run(
-                        question, stream=True, stream_intermediate_steps=True
+                        question,
+                        messages=[Message(role="user", content=cached_answer)] if cached_answer else None,
+                        stream=True,
+                        stream_intermediate_steps=True,
                     )
-                    for _resp_chunk in run_response:
-                        # Display tool calls if available and debug mode is enabled
-                        if DEBUG_MODE and _resp_chunk.tools and len(_resp_chunk.tools) > 0:
-                            display_tool_calls(tool_calls_container, _resp_chunk.tools)
-
-                        # Display response if available and event is RunResponse
-                        if (
-                                _resp_chunk.event == "RunResponse"
-                                and _resp_chunk.content is not None
-                        ):
-                            response += _resp_chunk.content.replace("$", "&#36;")
-                            resp_container.markdown(response)
+                    try:
+                        for _resp_chunk in run_response:
+                            # Display tool calls if available and debug mode is enabled
+                            if debug_mode and _resp_chunk.tools and len(_resp_chunk.tools) > 0:
+                                display_tool_calls(tool_calls_container, _resp_chunk.tools)
+
+                            # Display response if available and event is RunResponse
+                            if (
+                                    _resp_chunk.event == "RunResponse"
+                                    and _resp_chunk.content is not None
+                            ):
+                                response += _resp_chunk.content.replace("$", "&#36;")
+                                resp_container.markdown(response)
+                    finally:
+                        # A rerun interrupts the script, end the run before the agent goes back to the pool
+                        run_response.close()
 
                     add_message("assistant", response, sql_agent.run_response.tools)
+                    # The new run is already in the chat history, it is not loaded again on the next rerun
+                    mark_runs_loaded(sql_agent)
+                    if cached_answer is None:
+                        get_question_cache().remember(question, sql_agent.run_response.tools)
                 except Exception as e:
                     logger.exception(e)
                     error_message = f"Sorry, I encountered an error: {str(e)}"
@@ -177,6 +182,8 @@ def main() -> None:
     ####################################################################
     session_selector_widget(sql_agent, model_id)
     rename_session_widget(sql_agent)
+    if debug_mode:
+        pool_metrics_widget()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""Benchmark the cold-start import time of the app modules.
+
+Each module is imported in a fresh interpreter several times and the median
+wall time, minus the startup time of an empty interpreter, is reported with the
+model provider SDKs the import loaded. An import raising an exception, e.g.
+because it connects to a database that is not running, is timed up to the
+exception and marked with its type. Pass `--ref` to compare with another git
+revision of this directory, exported to a temporary directory:
+
+    python benchmark_imports.py --ref HEAD~1
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+MODULES = ["agents", "load_data", "load_knowledge", "utils"]
+PROVIDER_SDKS = ["openai", "anthropic", "google.genai", "groq"]
+
+
+def run_python(code: str, cwd: Path) -> Tuple[float, str]:
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    return elapsed, process.stdout.strip()
+
+
+IMPORT_CODE = """
+import sys
+try:
+    import {module}
+    error = ""
+except Exception as e:
+    error = f" (raised {{type(e).__name__}})"
+print(",".join(m for m in {sdks!r} if m in sys.modules) + error)
+"""
+
+
+def import_time(module: str, cwd: Path, runs: int, startup: float) -> Tuple[float, str]:
+    """Median seconds to import a module in a fresh interpreter, and the provider SDKs it loaded"""
+    code = IMPORT_CODE.format(module=module, sdks=PROVIDER_SDKS)
+    times = []
+    sdks = ""
+    for _ in range(runs):
+        elapsed, sdks = run_python(code, cwd)
+        times.append(elapsed - startup)
+    return statistics.median(times), sdks if sdks and not sdks.startswith(" ") else f"-{sdks}"
+
+
+def benchmark(cwd: Path, modules: List[str], runs: int) -> Dict[str, Optional[Tuple[float, str]]]:
+    startup = statistics.median(run_python("pass", cwd)[0] for _ in range(runs))
+    results: Dict[str, Optional[Tuple[float, str]]] = {}
+    for module in modules:
+        try:
+            results[module] = import_time(module, cwd, runs, startup)
+        except RuntimeError as e:
+            print(f"Could not import {module} in {cwd}: {e}", file=sys.stderr)
+            results[module] = None
+    return results
+
+
+def export_revision(ref: str, directory: Path) -> Path:
+    """Write the files of this directory at a git revision to `directory`"""
+    here = Path(__file__).parent
+    prefix = subprocess.run(
+        ["git", "rev-parse", "--show-prefix"], cwd=here, capture_output=True, text=True, check=True
+    ).stdout.strip()
+    archive = subprocess.run(["git", "archive", ref, prefix or "."], cwd=here, capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", str(directory)], input=archive.stdout, check=True)
+    return directory.joinpath(prefix)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the app modules.")
+    parser.add_argument("--ref", help="Git revision to compare with, e.g. HEAD~1.")
+    parser.add_argument("--runs", type=int, default=5, help="Imports of each module, the median is reported.")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="Modules to import.")
+    args = parser.parse_args()
+
+    current = benchmark(Path(__file__).parent, args.modules, args.runs)
+    baseline: Dict[str, Optional[Tuple[float, str]]] = {}
+    if args.ref:
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = benchmark(export_revision(args.ref, Path(directory)), args.modules, args.runs)
+
+    header = f"{'module':<16}{'import (s)':>12}  {'provider SDKs':<32}"
+    if args.ref:
+        header += f"{args.ref + ' (s)':>14}  {args.ref + ' provider SDKs':<60}{'speedup':>8}"
+    print(header)
+    for module in args.modules:
+        result = current[module]
+        line = f"{module:<16}" + (f"{result[0]:>12.3f}  {result[1]:<32}" if result else f"{'error':>12}  {'':<32}")
+        if args.ref:
+            base = baseline.get(module)
+            line += f"{base[0]:>14.3f}  {base[1]:<60}" if base else f"{'error':>14}  {'':<60}"
+            if result and base:
+                line += f"{base[0] / max(result[0], 1e-6):>7.1f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark the tokens of the semantic model sent to the model with each call.
+
+For sample questions, the semantic model as it used to be sent (the whole model
+as indented JSON) is compared with the compact text of the tables relevant to
+the question. The semantic model is part of the system prompt, so the saving
+applies to every model call of a turn, including each tool call step.
+
+Tokens are counted with tiktoken when it is installed, and approximated by
+counting words and punctuation otherwise:
+
+    python benchmark_prompt.py
+"""
+
+import argparse
+import json
+import re
+from typing import Callable, List, Tuple
+
+from schema import load_table_schemas
+from semantic_model import SemanticModelPrompt, semantic_model
+from settings import knowledge_dir
+
+QUESTIONS = [
+    "Which tables do you have access to?",
+    "Who are our top 10 customers by total purchase amount?",
+    "Compare sales performance across different stores for the last quarter.",
+    "Which products are currently experiencing stockouts across our stores?",
+    "Show me the top 5 performing employees based on sales volume.",
+    "Analyze the effectiveness of our promotions by comparing sales with and without promotions.",
+    "Which suppliers have the most stockouts in the last quarter?",
+    "How do employee performance metrics correlate with sales figures?",
+    "Which products have the highest profit margins?",
+]
+
+
+def token_counter(encoding: str) -> Tuple[Callable[[str], int], str]:
+    try:
+        import tiktoken
+
+        tokenizer = tiktoken.get_encoding(encoding)
+        return lambda text: len(tokenizer.encode(text)), f"tiktoken {encoding}"
+    except ImportError:
+        return lambda text: len(re.findall(r"\w+|[^\w\s]", text)), "approximate, tiktoken is not installed"
+
+
+def main(questions: List[str], encoding: str) -> None:
+    count_tokens, counter_name = token_counter(encoding)
+    prompt = SemanticModelPrompt(
+        semantic_model,
+        table_columns={
+            name: [column.name for column in table.columns]
+            for name, table in load_table_schemas(knowledge_dir).items()
+        },
+    )
+    before = count_tokens(json.dumps(semantic_model, indent=2))
+    full = count_tokens(prompt.build())
+    print(f"Semantic model tokens ({counter_name})")
+    print(f"{'indented JSON, every table':<60}{before:>8}")
+    print(f"{'compact, every table':<60}{full:>8}{1 - full / before:>9.0%}")
+    print()
+    print(f"{'question':<60}{'tokens':>8}{'saved':>9}{'tables':>8}")
+    total = 0
+    for question in questions:
+        tokens = count_tokens(prompt.build(question))
+        total += tokens
+        label = question if len(question) <= 58 else question[:55] + "..."
+        print(f"{label:<60}{tokens:>8}{1 - tokens / before:>9.0%}{len(prompt.tables_for(question)):>8}")
+    average = total / len(questions)
+    print(f"{'average per model call':<60}{average:>8.0f}{1 - average / before:>9.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the tokens of the semantic model prompt.")
+    parser.add_argument("--encoding", default="o200k_base", help="tiktoken encoding, o200k_base is used by gpt-4o.")
+    parser.add_argument("questions", nargs="*", default=QUESTIONS, help="Questions to build the prompt for.")
+    args = parser.parse_args()
+    main(args.questions, args.encoding)
@@ -0,0 +1,128 @@
+"""Concurrent execution of the tool calls of a model response.
+
+When the model asks for several tools in one response, e.g. `describe_table`
+for each table of a join, agno runs them one after another. A model class built
+by `concurrent_model_class` starts them all first, at most `tool_concurrency` at
+a time on a thread pool, then lets agno process the calls in their original
+order as usual: each call returns the result computed in advance, and its
+result message and `tool_call_completed` event report the time its tool
+actually ran.
+
+Calls are left to agno, which runs them when it reaches them, when their tool
+takes the `agent` or the function call as an argument, has a `pre_hook` that
+must run first, or stops the run with `stop_after_tool_call`. Calls past the
+model's `tool_call_limit` are never run in advance, as agno would not run them.
+"""
+
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Type
+
+from agno.utils.log import log_debug
+
+if TYPE_CHECKING:
+    from agno.models.base import Model
+    from agno.tools.function import FunctionCall
+    from agno.utils.timer import Timer
+
+# Arguments agno fills in itself when calling a tool
+AGNO_ARGUMENTS = {"agent", "team", "fc"}
+
+
+@dataclass
+class PrecomputedCall:
+    result: Any = None
+    error: Optional[BaseException] = None
+    elapsed: float = 0.0
+
+
+def replay(call: PrecomputedCall) -> Callable[..., Any]:
+    """Entrypoint returning the result computed in advance, or raising its error"""
+
+    def entrypoint(*args: Any, **kwargs: Any) -> Any:
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    return entrypoint
+
+
+def can_run_concurrently(function_call: "FunctionCall") -> bool:
+    function = function_call.function
+    entrypoint = function.entrypoint
+    if entrypoint is None or function.pre_hook is not None or function.stop_after_tool_call:
+        return False
+    try:
+        parameters = inspect.signature(entrypoint).parameters
+    except (TypeError, ValueError):
+        return False
+    return not AGNO_ARGUMENTS.intersection(parameters)
+
+
+class ConcurrentToolCalls:
+    """Model mixin running the independent tool calls of a response concurrently"""
+
+    tool_concurrency: int = 4
+
+    def run_tool_calls_concurrently(self, function_calls: List["FunctionCall"]) -> Dict[str, float]:
+        """Run the calls on a thread pool and point each one at its result.
+
+        Returns:
+            Dict[str, float]: Seconds each call ran, by call id
+        """
+        # agno stops running the calls of a response once the model reached its tool call limit
+        tool_call_limit = getattr(self, "tool_call_limit", None)
+        if tool_call_limit:
+            calls_run = len(getattr(self, "_function_call_stack", None) or [])
+            function_calls = function_calls[: max(tool_call_limit - calls_run, 0)]
+        calls = [function_call for function_call in function_calls if can_run_concurrently(function_call)]
+        if len(calls) < 2 or self.tool_concurrency < 2:
+            return {}
+
+        def run(function_call: "FunctionCall") -> PrecomputedCall:
+            precomputed = PrecomputedCall()
+            start = time.perf_counter()
+            try:
+                precomputed.result = function_call.function.entrypoint(**(function_call.arguments or {}))
+            except Exception as e:
+                precomputed.error = e
+            precomputed.elapsed = time.perf_counter() - start
+            return precomputed
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.tool_concurrency, len(calls))) as executor:
+            precomputed_calls = list(executor.map(run, calls))
+        log_debug(
+            f"Ran {len(calls)} tool calls concurrently in {time.perf_counter() - start:.4f}s, "
+            f"{sum(call.elapsed for call in precomputed_calls):.4f}s one after another"
+        )
+
+        elapsed = {}
+        for function_call, precomputed in zip(calls, precomputed_calls):
+            # agno still validates the arguments, runs the post hook and builds the result from this entrypoint
+            function_call.function = function_call.function.model_copy(update={"entrypoint": replay(precomputed)})
+            elapsed[function_call.call_id] = precomputed.elapsed
+        return elapsed
+
+    def run_function_calls(self, function_calls: List["FunctionCall"], *args: Any, **kwargs: Any):
+        self._tool_call_times = self.run_tool_calls_concurrently(function_calls)
+        try:
+            yield from super().run_function_calls(function_calls, *args, **kwargs)  # type: ignore[misc]
+        finally:
+            self._tool_call_times = {}
+
+    def _create_function_call_result(self, fc: "FunctionCall", success: bool, output: Any, timer: "Timer"):
+        elapsed = getattr(self, "_tool_call_times", {}).get(fc.call_id)
+        if elapsed is not None:
+            # agno reads the same timer for the `completed in` text of the tool_call_completed event
+            timer.elapsed_time = elapsed
+        return super()._create_function_call_result(fc, success, output, timer)  # type: ignore[misc]
+
+
+@lru_cache(maxsize=None)
+def concurrent_model_class(model_class: Type["Model"]) -> Type["Model"]:
+    """Subclass of a model class running the tool calls of a response concurrently"""
+    return type(model_class.__name__, (ConcurrentToolCalls, model_class), {})
@@ -0,0 +1,133 @@
+"""Process-wide database engines.
+
+Everything connecting to Postgres (the SQL tools, the vector db, the agent
+storage, the caches and the loader) gets its engine from `get_engine`, so a
+process keeps a single connection pool per database URL however many agents it
+creates. The pools are tuned with environment variables:
+
+- `DB_POOL_SIZE`: connections kept open (default 10)
+- `DB_MAX_OVERFLOW`: connections opened on top of them under load (default 10)
+- `DB_POOL_TIMEOUT`: seconds to wait for a free connection (default 30)
+- `DB_POOL_RECYCLE`: seconds after which a connection is replaced (default 1800)
+- `DB_POOL_PRE_PING`: check connections before using them (default true)
+"""
+
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from agno.utils.log import log_debug
+from sqlalchemy import Engine, create_engine, event
+
+
+@dataclass
+class PoolStats:
+    connects: int = 0
+    checkouts: int = 0
+    invalidations: int = 0
+    peak_checked_out: int = 0
+    # Pool events fire on the threads using the connections
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def connected(self) -> None:
+        with self._lock:
+            self.connects += 1
+
+    def checked_out(self, checked_out: int) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.peak_checked_out = max(self.peak_checked_out, checked_out)
+
+    def invalidated(self) -> None:
+        with self._lock:
+            self.invalidations += 1
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "invalidations": self.invalidations,
+                "peak_checked_out": self.peak_checked_out,
+            }
+
+
+_engines: Dict[str, Engine] = {}
+_stats: Dict[str, PoolStats] = {}
+_lock = threading.Lock()
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return default if value is None else value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _track_pool(db_url: str, engine: Engine) -> None:
+    stats = _stats[db_url] = PoolStats()
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        stats.connected()
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.checked_out(engine.pool.checkedout())  # type: ignore[attr-defined]
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats.invalidated()
+
+
+def get_engine(
+    db_url: str,
+    pool_size: Optional[int] = None,
+    max_overflow: Optional[int] = None,
+    pool_timeout: Optional[int] = None,
+    pool_recycle: Optional[int] = None,
+    pool_pre_ping: Optional[bool] = None,
+) -> Engine:
+    """Get the shared engine of a database, creating it on first use.
+
+    The pool options only apply to the call creating the engine, they default
+    to the `DB_POOL_*` environment variables.
+    """
+    with _lock:
+        engine = _engines.get(db_url)
+        if engine is None:
+            engine = create_engine(
+                db_url,
+                pool_size=pool_size if pool_size is not None else _env_int("DB_POOL_SIZE", 10),
+                max_overflow=max_overflow if max_overflow is not None else _env_int("DB_MAX_OVERFLOW", 10),
+                pool_timeout=pool_timeout if pool_timeout is not None else _env_int("DB_POOL_TIMEOUT", 30),
+                pool_recycle=pool_recycle if pool_recycle is not None else _env_int("DB_POOL_RECYCLE", 1800),
+                pool_pre_ping=pool_pre_ping if pool_pre_ping is not None else _env_bool("DB_POOL_PRE_PING", True),
+            )
+            _engines[db_url] = engine
+            _track_pool(db_url, engine)
+            log_debug(f"Created engine for {engine.url.render_as_string(hide_password=True)}")
+        return engine
+
+
+def pool_metrics() -> Dict[str, Dict[str, Any]]:
+    """Utilization of the connection pool of each shared engine, keyed by database URL without the password"""
+    metrics = {}
+    with _lock:
+        for db_url, engine in _engines.items():
+            pool = engine.pool
+            capacity = pool.size() + max(pool._max_overflow, 0)  # type: ignore[attr-defined]
+            checked_out = pool.checkedout()  # type: ignore[attr-defined]
+            metrics[engine.url.render_as_string(hide_password=True)] = {
+                "pool_size": pool.size(),  # type: ignore[attr-defined]
+                "capacity": capacity,
+                "checked_out": checked_out,
+                "checked_in": pool.checkedin(),  # type: ignore[attr-defined]
+                "overflow": max(pool.overflow(), 0),  # type: ignore[attr-defined]
+                "utilization": round(checked_out / capacity, 3) if capacity else 0.0,
+                **_stats[db_url].to_dict(),
+            }
+    return metrics
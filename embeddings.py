@@ -0,0 +1,127 @@
+"""Persistent embedding cache wrapping an OpenAI embedder.
+
+Embeddings are stored in a local SQLite file keyed by the model id, the
+dimensions and a hash of the text, so identical texts are only embedded once
+across knowledge loads, searches and restarts. The cache keeps the most recently
+used `max_entries` embeddings. Misses are sent to the API in batches.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from agno.embedder.base import Embedder
+from agno.embedder.openai import OpenAIEmbedder
+from agno.utils.log import log_debug
+
+
+@dataclass
+class CachedEmbedder(Embedder):
+    # Embedder used for cache misses
+    embedder: OpenAIEmbedder = field(default_factory=OpenAIEmbedder)
+    # SQLite file storing the embeddings
+    cache_path: Path = Path(".cache/embeddings.sqlite3")
+    # Number of embeddings kept, least recently used ones are evicted first
+    max_entries: int = 50_000
+    # Number of texts sent in a single embeddings request
+    batch_size: int = 100
+
+    hits: int = 0
+    misses: int = 0
+
+    def __post_init__(self):
+        self.dimensions = self.embedder.dimensions
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        return self._db
+
+    def cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.embedder.id}:{self.dimensions}:{text}".encode()).hexdigest()
+
+    def _get_cached(self, keys: List[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                rows = self.db.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+                self.db.commit()
+        return found
+
+    def _set_cached(self, embeddings: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", embedding).tobytes(), now) for key, embedding in embeddings.items()],
+            )
+            (count,) = self.db.execute("SELECT count(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self.db.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self.db.commit()
+
+    def get_embeddings_and_usage(self, texts: List[str]) -> Tuple[List[List[float]], Optional[Dict]]:
+        """Embed a list of texts, only sending the ones missing from the cache to the API, in batches.
+
+        Returns:
+            Tuple[List[List[float]], Optional[Dict]]: Embeddings in the order of `texts`, and the
+                token usage of the API requests, or None if every text was cached
+        """
+        keys = [self.cache_key(text) for text in texts]
+        embeddings = self._get_cached(list(set(keys)))
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        usage: Optional[Dict] = None
+        missing_keys = list(missing)
+        for i in range(0, len(missing_keys), self.batch_size):
+            batch = missing_keys[i : i + self.batch_size]
+            log_debug(f"Embedding {len(batch)} texts with {self.embedder.id}")
+            response = self.embedder.response(text=[missing[key] for key in batch])  # type: ignore[arg-type]
+            new_embeddings = {batch[item.index]: item.embedding for item in response.data}
+            self._set_cached(new_embeddings)
+            embeddings.update(new_embeddings)
+            if response.usage:
+                usage = usage or {}
+                for name, value in response.usage.model_dump().items():
+                    if isinstance(value, int):
+                        usage[name] = usage.get(name, 0) + value
+        return [embeddings[key] for key in keys], usage
+
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.get_embeddings_and_usage(texts)[0]
+
+    def get_embedding(self, text: str) -> List[float]:
+        return self.get_embeddings([text])[0]
+
+    def get_embedding_and_usage(self, text: str) -> Tuple[List[float], Optional[Dict]]:
+        embeddings, usage = self.get_embeddings_and_usage([text])
+        return embeddings[0], usage
@@ -0,0 +1,202 @@
+"""Join planning over the relationships of the semantic model.
+
+The relationships form a graph of the tables. `JoinGraph` computes the shortest
+join path between every pair of tables once, and joins a set of tables by
+growing a tree from the first one, adding the table closest to the tree until
+every table is in it. The agent gets the JOIN clauses of the tree from the
+`plan_joins` tool in one call, instead of working them out from the semantic
+model over several turns.
+
+Fact tables are never joined to each other: when the tree has several, the plan
+is a template aggregating each of them by the keys of the dimensions they share
+in a CTE, then joining the aggregates on those keys.
+"""
+
+import json
+import math
+import re
+from collections import deque
+from typing import Any, Dict, List, Set
+
+from agno.tools import Toolkit
+from agno.utils.log import log_debug
+from semantic_model import Relationship, model_relationships
+
+
+class JoinGraph:
+    """Shortest join paths between all the tables of a semantic model"""
+
+    def __init__(self, semantic_model: Dict[str, Any]):
+        self.tables: List[str] = [table["table_name"] for table in semantic_model["tables"]]
+        self.relationships = model_relationships(semantic_model)
+        self.edges: Dict[str, List[Relationship]] = {table: [] for table in self.tables}
+        for relationship in self.relationships:
+            self.edges.setdefault(relationship.one_table, []).append(relationship)
+            self.edges.setdefault(relationship.many_table, []).append(relationship)
+        # Tables only ever on the many side of their relationships, e.g. FACT_SALES
+        one_side = {relationship.one_table for relationship in self.relationships}
+        self.fact_tables: Set[str] = {table for table in self.edges if table not in one_side}
+        # paths[a][b]: relationships joining a to b, in order from a
+        self.paths: Dict[str, Dict[str, List[Relationship]]] = {
+            table: self.shortest_paths(table) for table in self.edges
+        }
+
+    @staticmethod
+    def other_table(relationship: Relationship, table: str) -> str:
+        return relationship.many_table if relationship.one_table == table else relationship.one_table
+
+    def neighbours(self, table: str) -> Set[str]:
+        return {self.other_table(relationship, table) for relationship in self.edges[table]}
+
+    def shortest_paths(self, source: str) -> Dict[str, List[Relationship]]:
+        """Breadth-first search from a table, through dimension tables before fact tables on ties"""
+        paths: Dict[str, List[Relationship]] = {source: []}
+        queue = deque([source])
+        while queue:
+            table = queue.popleft()
+            edges = sorted(
+                self.edges[table],
+                key=lambda r: (self.other_table(r, table) in self.fact_tables, self.other_table(r, table)),
+            )
+            for relationship in edges:
+                other = self.other_table(relationship, table)
+                if other not in paths:
+                    paths[other] = paths[table] + [relationship]
+                    queue.append(other)
+        return paths
+
+    def resolve(self, names: List[str]) -> List[str]:
+        """Table names as in the semantic model, raising `ValueError` for unknown tables"""
+        by_upper = {table.upper(): table for table in self.edges}
+        unknown = [name for name in names if name.upper() not in by_upper]
+        if unknown:
+            raise ValueError(f"Unknown tables: {', '.join(unknown)}. Known tables: {', '.join(self.tables)}")
+        return list(dict.fromkeys(by_upper[name.upper()] for name in names))
+
+    def plan(self, tables: List[str]) -> Dict[str, Any]:
+        """Join tree of the tables, with the tables it goes through to connect them.
+
+        Returns:
+            Dict[str, Any]: `sql` with the FROM and JOIN clauses, the `joins` and the `tables` of the tree,
+                and `notes`; with several fact tables, the plan of `plan_aggregates` instead
+        """
+        tables = self.resolve(tables)
+        if not tables:
+            raise ValueError("No tables given.")
+        in_tree = [tables[0]]
+        joins: List[Dict[str, str]] = []
+        remaining = tables[1:]
+        while remaining:
+            # The table closest to any table of the tree
+            start, target = min(
+                ((start, target) for start in in_tree for target in remaining),
+                key=lambda pair: len(self.paths[pair[0]][pair[1]]) if pair[1] in self.paths[pair[0]] else math.inf,
+            )
+            if target not in self.paths[start]:
+                raise ValueError(f"No relationship connects {target} to {', '.join(in_tree)}.")
+            table = start
+            for relationship in self.paths[start][target]:
+                other = self.other_table(relationship, table)
+                if other not in in_tree:
+                    in_tree.append(other)
+                    joins.append(
+                        {
+                            "table": other,
+                            "on": f'"{relationship.one_table}"."{relationship.one_column}" = '
+                            f'"{relationship.many_table}"."{relationship.many_column}"',
+                        }
+                    )
+                table = other
+            remaining = [name for name in remaining if name not in in_tree]
+
+        fact_tables = [table for table in in_tree if table in self.fact_tables]
+        if len(fact_tables) > 1:
+            return self.plan_aggregates(fact_tables, [table for table in tables if table not in self.fact_tables])
+        sql = "\n".join([f'FROM "{in_tree[0]}"'] + [f'JOIN "{join["table"]}" ON {join["on"]}' for join in joins])
+        return {"sql": sql, "joins": joins, "tables": in_tree, "notes": []}
+
+    def plan_aggregates(self, fact_tables: List[str], dimension_tables: List[str]) -> Dict[str, Any]:
+        """Template aggregating each fact table by the keys of the dimensions they all share, then joining the
+        aggregates on those keys: joined directly, every row of one fact table is repeated for each matching row
+        of the other.
+        """
+        shared = sorted(set.intersection(*(self.neighbours(fact_table) for fact_table in fact_tables)))
+        if not shared:
+            raise ValueError(f"The fact tables {', '.join(fact_tables)} share no dimension, query them separately.")
+        # links[fact_table][dimension]: relationship joining the fact table to a shared dimension
+        links = {
+            fact_table: {r.one_table: r for r in self.edges[fact_table] if r.many_table == fact_table}
+            for fact_table in fact_tables
+        }
+        keys = {
+            fact_table: [links[fact_table][dimension].many_column for dimension in shared] for fact_table in fact_tables
+        }
+        names = {fact_table: f"{fact_table.lower()}_totals" for fact_table in fact_tables}
+        ctes = []
+        for fact_table in fact_tables:
+            columns = ", ".join(f'"{column}"' for column in keys[fact_table])
+            ctes.append(
+                f"{names[fact_table]} AS (\n    SELECT {columns}, <aggregates>\n"
+                f'    FROM "{fact_table}"\n    GROUP BY {columns}\n)'
+            )
+        first = fact_tables[0]
+        joins: List[Dict[str, str]] = []
+        for fact_table in fact_tables[1:]:
+            on = " AND ".join(
+                f'{names[first]}."{first_column}" = {names[fact_table]}."{column}"'
+                for first_column, column in zip(keys[first], keys[fact_table])
+            )
+            joins.append({"table": names[fact_table], "on": on})
+        notes = [
+            f"The fact tables {', '.join(fact_tables)} are aggregated separately by the keys of the dimensions they "
+            f"share ({', '.join(shared)}), then joined: joining them directly repeats every row of one for each "
+            "matching row of the other. Replace <aggregates> with the measures of each table, e.g. "
+            "SUM(column) AS total, and remove the keys the question does not need from every CTE and join."
+        ]
+        for dimension in dimension_tables:
+            if dimension in shared:
+                joins.append(
+                    {
+                        "table": f'"{dimension}"',
+                        "on": f'"{dimension}"."{links[first][dimension].one_column}" = '
+                        f'{names[first]}."{links[first][dimension].many_column}"',
+                    }
+                )
+            else:
+                notes.append(
+                    f"{dimension} is not shared by all the fact tables: join it inside the CTE of the fact table "
+                    "it relates to and group by its columns there."
+                )
+        sql = "\n".join(
+            ["WITH " + ",\n".join(ctes), f"SELECT <columns>\nFROM {names[first]}"]
+            + [f'JOIN {join["table"]} ON {join["on"]}' for join in joins]
+        )
+        tables = fact_tables + [table for table in dimension_tables if table in shared]
+        return {"sql": sql, "joins": joins, "tables": tables, "notes": notes}
+
+
+class JoinPlannerTools(Toolkit):
+    """Tool giving the agent the JOIN clauses of a set of tables"""
+
+    def __init__(self, join_graph: JoinGraph):
+        super().__init__(name="join_planner_tools")
+        self.join_graph = join_graph
+        self.register(self.plan_joins)
+
+    def plan_joins(self, tables: str) -> str:
+        """Use this function to get the JOIN clauses joining tables, from the relationships of the semantic model.
+
+        Args:
+            tables (str): Names of the tables to join, separated by commas, e.g. "FACT_SALES, DIM_STORE".
+        Returns:
+            str: JSON with the FROM and JOIN clauses in `sql`, the `tables` joined, including the ones
+                needed to connect the given tables, and `notes` to follow. With several fact tables,
+                `sql` is a query template aggregating each of them in a CTE before joining them.
+        """
+        names = [name.strip("\"'` ") for name in re.split(r"[\s,]+", tables.strip())]
+        try:
+            plan = self.join_graph.plan([name for name in names if name])
+        except ValueError as e:
+            return f"Error planning joins: {e}"
+        log_debug(f"Join plan for {tables}: {plan['tables']}")
+        return json.dumps(plan)
@@ -1,8 +1,29 @@
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
 import pandas as pd
-from agents import db_url
 from agno.utils.log import logger
-from sqlalchemy import create_engine
-import os
+from db import get_engine
+from rollups import ROLLUPS, Rollup, create_rollup_sql, drop_rollup_sql, get_existing_rollups, refresh_rollup_sql
+from schema import (
+    LOAD_STATE_TABLE,
+    TableSchema,
+    cast_sql,
+    create_table_sql,
+    drop_foreign_key_sql,
+    foreign_key_sql,
+    index_sql,
+    load_table_schemas,
+    primary_key_sql,
+)
+from schema_catalog import refresh_schema_catalogs
+from settings import db_url, knowledge_dir
+from sql_tools import invalidate_cached_tables
+from sqlalchemy import Connection, Engine, text
 
 # List of files and their corresponding table names
 files_to_tables = {
@@ -19,28 +40,488 @@ files_to_tables = {
     "data/fact_sales.csv": "FACT_SALES"
 }
 
-def load_retail_data():
-    """Load retail inventory data into the database"""
+# Number of rows pandas reads to infer column types of tables missing from the knowledge files
+INFER_SAMPLE_ROWS = 10_000
+# Size of the chunks streamed to Postgres during COPY
+COPY_CHUNK_SIZE = 1 << 20
+# Default number of tables loaded concurrently
+DEFAULT_WORKERS = 4
+
+
+def file_fingerprint(file_path: str) -> str:
+    """Get the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while data := f.read(COPY_CHUNK_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def copy_file(conn: Connection, file_path: str, table_name: str, columns: List[str]) -> int:
+    """Stream a CSV file into a table with COPY FROM STDIN on the connection's transaction.
+
+    Returns:
+        int: Number of rows copied
+    """
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    copy_sql = f'COPY "{table_name}" ({column_list}) FROM STDIN WITH (FORMAT csv, HEADER true)'
+    with conn.connection.driver_connection.cursor() as cur:
+        with open(file_path, "rb") as f, cur.copy(copy_sql) as copy:
+            while data := f.read(COPY_CHUNK_SIZE):
+                copy.write(data)
+        return cur.rowcount
+
+
+def stage_csv(conn: Connection, file_path: str, stage: str) -> Tuple[List[str], int]:
+    """Copy a CSV file into a temporary table of TEXT columns, dropped when the transaction commits.
+
+    Returns:
+        Tuple[List[str], int]: Columns of the file and number of rows copied
+    """
+    columns = list(pd.read_csv(file_path, nrows=0).columns)
+    column_list = ", ".join(f'"{column}" TEXT' for column in columns)
+    conn.execute(text(f'CREATE TEMP TABLE "{stage}" ({column_list}) ON COMMIT DROP'))
+    return columns, copy_file(conn, file_path, stage, columns)
+
+
+def select_from_stage_sql(table: TableSchema, columns: List[str], stage: str) -> str:
+    """SELECT statement reading the staged columns converted to the types of the table"""
+    expressions = []
+    for column_name in columns:
+        column = table.column(column_name)
+        expressions.append(cast_sql(column) if column is not None else f'"{column_name}"')
+    return f'SELECT {", ".join(expressions)} FROM "{stage}"'
+
+
+def copy_csv_to_table(conn: Connection, file_path: str, table_name: str, table: Optional[TableSchema] = None) -> int:
+    """Replace a table with the contents of a CSV file using COPY FROM STDIN.
+
+    The table is created with the types from its schema, the file is streamed to
+    Postgres in chunks into a staging table, without being parsed in Python, and
+    converted to the table types in a single INSERT ... SELECT. Tables without a
+    schema are created from column types inferred on a sample of the file instead.
+    Drop, create and copy run on the caller's transaction, so readers never see an
+    empty table.
+
+    Args:
+        conn: Connection with an open transaction on the target database
+        file_path: Path to the CSV file, with a header row
+        table_name: Name of the table to replace
+        table: Schema of the table
+
+    Returns:
+        int: Number of rows copied
+    """
+    conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+    if table is None:
+        sample = pd.read_csv(file_path, nrows=INFER_SAMPLE_ROWS)
+        conn.execute(text(pd.io.sql.get_schema(sample, table_name, con=conn)))
+        return copy_file(conn, file_path, table_name, list(sample.columns))
+
+    conn.execute(text(create_table_sql(table)))
+    stage = f"{table_name}_stage"
+    columns, _ = stage_csv(conn, file_path, stage)
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    insert_sql = f'INSERT INTO "{table_name}" ({column_list}) {select_from_stage_sql(table, columns, stage)}'
+    return conn.execute(text(insert_sql)).rowcount
+
+
+def insert_csv_to_table(conn: Connection, file_path: str, table_name: str, table: Optional[TableSchema] = None) -> int:
+    """Replace a table with the contents of a CSV file using pandas `to_sql`.
+
+    Returns:
+        int: Number of rows inserted
+    """
+    df = pd.read_csv(file_path)
+    if table is None:
+        df.to_sql(table_name, conn, if_exists="replace", index=False)
+    else:
+        conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+        conn.execute(text(create_table_sql(table)))
+        df.to_sql(table_name, conn, if_exists="append", index=False)
+    return len(df)
+
+
+def upsert_csv_to_table(conn: Connection, file_path: str, table: TableSchema) -> int:
+    """Merge the contents of a CSV file into an existing table by primary key.
+
+    The file is copied into a temporary staging table, then inserted with
+    ON CONFLICT DO UPDATE. Rows whose values did not change are left untouched,
+    and rows missing from the file are kept.
+
+    Returns:
+        int: Number of rows inserted or updated
+    """
+    stage = f"{table.name}_stage"
+    columns, _ = stage_csv(conn, file_path, stage)
+
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    updates = [column for column in columns if column != table.primary_key]
+    upsert_sql = f'INSERT INTO "{table.name}" ({column_list}) {select_from_stage_sql(table, columns, stage)} '
+    if updates:
+        upsert_sql += (
+            f'ON CONFLICT ("{table.primary_key}") DO UPDATE SET '
+            + ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in updates)
+            + " WHERE ("
+            + ", ".join(f'"{table.name}"."{column}"' for column in updates)
+            + ") IS DISTINCT FROM ("
+            + ", ".join(f'EXCLUDED."{column}"' for column in updates)
+            + ")"
+        )
+    else:
+        upsert_sql += f'ON CONFLICT ("{table.primary_key}") DO NOTHING'
+    return conn.execute(text(upsert_sql)).rowcount
+
+
+def get_load_state(engine: Engine) -> Dict[str, str]:
+    """Get the fingerprint of the file each table was last loaded from"""
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {LOAD_STATE_TABLE.split('.')[0]}"))
+        conn.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {LOAD_STATE_TABLE} ("
+                "table_name TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, "
+                "row_count BIGINT, loaded_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        )
+        rows = conn.execute(text(f"SELECT table_name, fingerprint FROM {LOAD_STATE_TABLE}"))
+        return {table_name: fingerprint for table_name, fingerprint in rows}
+
+
+def save_load_state(conn: Connection, table_name: str, fingerprint: str, rows: int) -> None:
+    """Record the fingerprint of the file a table was loaded from, on the load's transaction"""
+    conn.execute(
+        text(
+            f"INSERT INTO {LOAD_STATE_TABLE} (table_name, fingerprint, row_count, loaded_at) "
+            "VALUES (:table_name, :fingerprint, :rows, now()) "
+            "ON CONFLICT (table_name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, "
+            "row_count = EXCLUDED.row_count, loaded_at = EXCLUDED.loaded_at"
+        ),
+        {"table_name": table_name, "fingerprint": fingerprint, "rows": rows},
+    )
+
+
+def get_upsertable_tables(engine: Engine) -> Dict[str, List[str]]:
+    """Get the columns of the existing tables that carry the primary key built by this loader"""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT c.table_name, c.column_name FROM information_schema.columns c "
+                "WHERE c.table_schema = current_schema() AND EXISTS ("
+                "SELECT 1 FROM information_schema.table_constraints k "
+                "WHERE k.table_schema = c.table_schema AND k.table_name = c.table_name "
+                "AND k.constraint_type = 'PRIMARY KEY') "
+                "ORDER BY c.table_name, c.ordinal_position"
+            )
+        )
+        tables: Dict[str, List[str]] = {}
+        for table_name, column_name in rows:
+            tables.setdefault(table_name, []).append(column_name)
+        return tables
+
+
+def get_existing_tables(engine: Engine) -> Set[str]:
+    """Get the names of the tables in the current schema"""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema()")
+        )
+        return {table_name for table_name, in rows}
+
+
+def load_table(
+    engine: Engine,
+    file_path: str,
+    table_name: str,
+    fingerprint: str,
+    table: Optional[TableSchema] = None,
+    bulk: bool = True,
+    upsert: bool = False,
+) -> Tuple[int, float]:
+    """Load a single CSV file into its table and record its fingerprint, in one transaction.
+
+    Args:
+        table: Schema of the table, from the knowledge files
+        upsert: Upsert into the existing table by primary key instead of replacing it
+
+    Returns:
+        Tuple[int, float]: Number of rows loaded and elapsed seconds
+    """
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        if upsert:
+            rows = upsert_csv_to_table(conn, file_path, table)
+        elif bulk:
+            rows = copy_csv_to_table(conn, file_path, table_name, table)
+        else:
+            rows = insert_csv_to_table(conn, file_path, table_name, table)
+        save_load_state(conn, table_name, fingerprint, rows)
+    return rows, time.perf_counter() - start
+
+
+def execute_ddl(engine: Engine, *statements: str) -> None:
+    """Run DDL statements in a single transaction"""
+    with engine.begin() as conn:
+        for statement in statements:
+            logger.debug(statement)
+            conn.execute(text(statement))
+
+
+def has_rows(engine: Engine, table_name: str) -> bool:
+    with engine.connect() as conn:
+        return bool(conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{table_name}")')).scalar())
+
+
+def build_rollup(engine: Engine, rollup: Rollup, refresh: bool = False) -> float:
+    """Create a rollup, or recompute an existing one from its source table.
+
+    A rollup of an empty table is not created, so queries keep reading the table
+    itself. It is built by a later load that adds rows to the table.
+
+    Returns:
+        float: Elapsed seconds
+    """
+    start = time.perf_counter()
+    if not refresh and not has_rows(engine, rollup.source):
+        logger.info(f"{rollup.source} table is empty, skipping the {rollup.name} rollup.")
+        return 0.0
+    # Bumping the load time of the source table with the rollup drops the results cached by other
+    # processes between the load of the table and the rollup, which read the rollup before it was refreshed
+    bump_version = f"UPDATE {LOAD_STATE_TABLE} SET loaded_at = now() WHERE table_name = '{rollup.source}'"
+    if refresh:
+        execute_ddl(engine, refresh_rollup_sql(rollup), bump_version)
+    else:
+        execute_ddl(engine, *create_rollup_sql(rollup), bump_version)
+    elapsed = time.perf_counter() - start
+    logger.info(f"{'Refreshed' if refresh else 'Built'} {rollup.name} rollup in {elapsed:.2f}s.")
+    return elapsed
+
+
+def run_tasks(tasks: Dict[str, Tuple[Callable[[], Any], Set[str]]], workers: int) -> Dict[str, Any]:
+    """Run tasks on a thread pool, starting each one as soon as its dependencies have finished.
+
+    Tasks are started in insertion order when several are ready. If a task fails,
+    the tasks depending on it are skipped.
+
+    Args:
+        tasks: task name -> (function, names of the tasks it depends on)
+        workers: Maximum number of tasks running at the same time
+
+    Returns:
+        Dict[str, Any]: task name -> result, for the tasks that succeeded
+    """
+    results: Dict[str, Any] = {}
+    pending = dict(tasks)
+    failed: Set[str] = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if deps & failed:
+                    logger.warning(f"Skipping {name}: dependency failed.")
+                    failed.add(name)
+                    del pending[name]
+                elif deps <= results.keys():
+                    running[executor.submit(func)] = name
+                    del pending[name]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.error(f"Task {name} failed: {e}")
+                    failed.add(name)
+    return results
+
+
+def load_retail_data(bulk: bool = True, workers: int = DEFAULT_WORKERS, incremental: bool = False) -> List[str]:
+    """Load retail inventory data into the database
+
+    Tables are created with the column types, primary keys and foreign keys listed
+    in the knowledge files, see `schema.py`. They are loaded concurrently on a pool
+    of `workers` connections without any keys. Primary keys, foreign keys and the
+    indexes on foreign key columns are built once the data is in, each as soon as
+    the tables it depends on are ready.
+
+    In incremental mode, tables whose source file has the same fingerprint as on the
+    last load are skipped, and changed files are upserted into the existing tables by
+    primary key. A table is only replaced when it does not exist yet, has no primary
+    key or its columns changed. Every load runs in a single transaction, so queries
+    keep seeing the previous contents until it commits.
+
+    Args:
+        bulk: Stream files with COPY FROM STDIN instead of pandas `to_sql` INSERTs
+        workers: Number of tables loaded, and constraints built, concurrently
+        incremental: Only load the files that changed since the last load
+
+    Returns:
+        List[str]: Names of the tables that were loaded
+    """
 
     logger.info("Loading retail database.")
-    engine = create_engine(db_url)
+    engine = get_engine(db_url)
+
+    load_state = get_load_state(engine)
+    existing_tables = get_existing_tables(engine)
+    table_schemas = load_table_schemas(knowledge_dir)
+    upsertable_tables = get_upsertable_tables(engine) if incremental else {}
 
-    # Load each CSV file into the corresponding PostgreSQL table
+    # Decide, for each file, whether to skip it, upsert it or replace its table
+    fingerprints: Dict[str, str] = {}
+    tables_to_upsert: Dict[str, str] = {}
+    tables_to_replace: Dict[str, str] = {}
     for file_path, table_name in files_to_tables.items():
         if not os.path.exists(file_path):
             logger.warning(f"File {file_path} not found. Skipping.")
             continue
-            
-        logger.info(f"Loading {file_path} into {table_name} table.")
-        
-        # Read the CSV file directly
-        df = pd.read_csv(file_path)
-        
-        df.to_sql(table_name, engine, if_exists="replace", index=False)
-        logger.info(f"{file_path} loaded into {table_name} table.")
+        fingerprints[table_name] = file_fingerprint(file_path)
+        table = table_schemas.get(table_name)
+        if not incremental:
+            tables_to_replace[table_name] = file_path
+        elif load_state.get(table_name) == fingerprints[table_name] and table_name in existing_tables:
+            logger.info(f"{file_path} unchanged since the last load. Skipping.")
+        elif table_name not in upsertable_tables or table is None or table.primary_key is None:
+            tables_to_replace[table_name] = file_path
+        elif list(pd.read_csv(file_path, nrows=0).columns) != upsertable_tables[table_name]:
+            logger.info(f"Columns of {file_path} changed, replacing {table_name} table.")
+            tables_to_replace[table_name] = file_path
+        else:
+            tables_to_upsert[table_name] = file_path
+
+    # Rollups of replaced tables are dropped with them and built again, rollups of upserted tables are refreshed.
+    # Rollups of tables that are neither loaded nor in the database, e.g. FACT_SALES without its file, are skipped
+    source_tables = existing_tables.union(tables_to_replace, tables_to_upsert)
+    missing_sources = sorted({rollup.source for rollup in ROLLUPS if rollup.source not in source_tables})
+    if missing_sources:
+        logger.info(f"No {', '.join(missing_sources)} table, skipping its rollups.")
+    existing_rollups = get_existing_rollups(engine)
+    rollups_to_build = [
+        rollup
+        for rollup in ROLLUPS
+        if rollup.source in tables_to_replace
+        or (rollup.name not in existing_rollups and rollup.source in source_tables)
+    ]
+    rollups_to_refresh = [
+        rollup for rollup in ROLLUPS if rollup.source in tables_to_upsert and rollup not in rollups_to_build
+    ]
+
+    if not tables_to_replace and not tables_to_upsert and not rollups_to_build:
+        logger.info("Retail database is up to date.")
+        return []
+
+    # Foreign keys and rollups would prevent dropping the replaced tables, so drop
+    # the ones on, and pointing to, those tables and build them again afterwards
+    tables_to_relink = [
+        table
+        for table in table_schemas.values()
+        if table.name in tables_to_replace
+        or any(foreign_key.ref_table in tables_to_replace for foreign_key in table.foreign_keys)
+    ]
+    execute_ddl(
+        engine,
+        *(drop_foreign_key_sql(table, foreign_key) for table in tables_to_relink for foreign_key in table.foreign_keys),
+        *(drop_rollup_sql(rollup) for rollup in ROLLUPS if rollup.source in tables_to_replace),
+    )
+
+    def load(file_path: str, table_name: str, upsert: bool = False) -> int:
+        logger.info(f"{'Upserting' if upsert else 'Loading'} {file_path} into {table_name} table.")
+        rows, elapsed = load_table(
+            engine,
+            file_path,
+            table_name,
+            fingerprints[table_name],
+            table=table_schemas.get(table_name),
+            bulk=bulk,
+            upsert=upsert,
+        )
+        logger.info(
+            f"{file_path} loaded into {table_name} table: "
+            f"{rows:,} rows in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s)."
+        )
+        return rows
+
+    # Load every table first, then build constraints and indexes on top of the loaded data
+    tasks: Dict[str, Tuple[Callable[[], Any], Set[str]]] = {}
+    for table_name, file_path in tables_to_replace.items():
+        tasks[f"load:{table_name}"] = (lambda f=file_path, t=table_name: load(f, t), set())
+    for table_name, file_path in tables_to_upsert.items():
+        # Upserted rows are checked against the existing foreign keys, so new
+        # dimension rows must be in before the facts referencing them
+        deps = {
+            f"load:{foreign_key.ref_table}"
+            for foreign_key in table_schemas[table_name].foreign_keys
+            if foreign_key.ref_table in tables_to_upsert
+        }
+        tasks[f"load:{table_name}"] = (lambda f=file_path, t=table_name: load(f, t, upsert=True), deps)
+
+    # Statistics of the loaded tables, for the query planner and the row counts of the schema catalog
+    for table_name in list(tables_to_replace) + list(tables_to_upsert):
+        tasks[f"analyze:{table_name}"] = (
+            lambda t=table_name: execute_ddl(engine, f'ANALYZE "{t}"'),
+            {f"load:{table_name}"},
+        )
+
+    for table_name in tables_to_replace:
+        table = table_schemas.get(table_name)
+        if table is not None and table.primary_key is not None:
+            tasks[f"pk:{table_name}"] = (
+                lambda s=primary_key_sql(table): execute_ddl(engine, s),
+                {f"load:{table_name}"},
+            )
+
+    for table in tables_to_relink:
+        fk_statements = []
+        fk_deps = {f"load:{table.name}"} if f"load:{table.name}" in tasks else set()
+        for foreign_key in table.foreign_keys:
+            if table.name in tables_to_replace:
+                # Indexes on the join columns only need the table itself
+                tasks[f"ix:{table.name}.{foreign_key.column}"] = (
+                    lambda s=index_sql(table, foreign_key): execute_ddl(engine, s),
+                    {f"load:{table.name}"},
+                )
+            # Foreign keys need the primary key of the referenced table
+            if f"pk:{foreign_key.ref_table}" in tasks:
+                fk_deps.add(f"pk:{foreign_key.ref_table}")
+            elif foreign_key.ref_table in tables_to_replace or foreign_key.ref_table not in existing_tables:
+                continue
+            fk_statements.append(foreign_key_sql(table, foreign_key))
+        if fk_statements and table.name in existing_tables.union(tables_to_replace):
+            tasks[f"fk:{table.name}"] = (lambda s=tuple(fk_statements): execute_ddl(engine, *s), fk_deps)
+
+    for rollup in rollups_to_build + rollups_to_refresh:
+        deps = {f"load:{rollup.source}"} if f"load:{rollup.source}" in tasks else set()
+        tasks[f"rollup:{rollup.name}"] = (
+            lambda r=rollup: build_rollup(engine, r, refresh=r in rollups_to_refresh),
+            deps,
+        )
+
+    total_start = time.perf_counter()
+    results = run_tasks(tasks, workers=workers)
+    total_rows = sum(rows for name, rows in results.items() if name.startswith("load:"))
+    total_elapsed = time.perf_counter() - total_start
+    logger.info(
+        f"Retail database loaded: {total_rows:,} rows in {total_elapsed:.2f}s "
+        f"({total_rows / max(total_elapsed, 1e-9):,.0f} rows/s), "
+        f"{len(results)}/{len(tasks)} load, index, analyze and rollup tasks succeeded."
+    )
 
-    logger.info("Retail database loaded.")
+    # Cached query results that read the loaded tables are stale
+    loaded_tables = [name.split(":", 1)[1] for name in results if name.startswith("load:")]
+    invalidate_cached_tables(loaded_tables)
+    refresh_schema_catalogs()
+    return loaded_tables
 
 
 if __name__ == "__main__":
-    load_retail_data()
+    parser = argparse.ArgumentParser(description="Load the retail CSV files into the database.")
+    parser.add_argument(
+        "--incremental", action="store_true", help="Only load the files that changed since the last load."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=DEFAULT_WORKERS, help="Number of tables loaded concurrently."
+    )
+    args = parser.parse_args()
+    load_retail_data(workers=args.workers, incremental=args.incremental)
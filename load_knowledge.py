@@ -1,12 +1,79 @@
-from agents import agent_knowledge
+import argparse
+from hashlib import md5
+from typing import Dict, List
+
+from agents import get_agent_knowledge
+from agno.document import Document
 from agno.utils.log import logger
+from embeddings import CachedEmbedder
+from sqlalchemy import delete, select
+
+
+def content_hash(document: Document) -> str:
+    """Hash of a document's content, computed the same way as the `content_hash` column of PgVector"""
+    return md5(document.content.replace("\x00", "\ufffd").encode()).hexdigest()
+
+
+def sync_knowledge() -> None:
+    """Bring the vector db in line with the knowledge directory without recreating it.
+
+    Documents are matched by id. Only new documents and documents whose content
+    hash changed are embedded and upserted, and documents that are no longer
+    produced by the knowledge base are deleted. The table is never dropped, so
+    it stays searchable during the sync.
+    """
+    agent_knowledge = get_agent_knowledge()
+    vector_db = agent_knowledge.vector_db
+    if not vector_db.exists():
+        vector_db.create()
+
+    documents: Dict[str, Document] = {}
+    for document_list in agent_knowledge.document_lists:
+        for document in document_list:
+            documents[document.id or content_hash(document)] = document
+
+    table = vector_db.table
+    with vector_db.Session() as sess:
+        existing = dict(sess.execute(select(table.c.id, table.c.content_hash)).all())
+
+    changed: List[Document] = [
+        document for doc_id, document in documents.items() if existing.get(doc_id) != content_hash(document)
+    ]
+    removed = [doc_id for doc_id in existing if doc_id not in documents]
+
+    if changed:
+        if isinstance(vector_db.embedder, CachedEmbedder):
+            # Embed in batches up front, the upsert then reads every embedding from the cache
+            vector_db.embedder.get_embeddings([document.content for document in changed])
+        vector_db.upsert(documents=changed)
+    if removed:
+        with vector_db.Session() as sess, sess.begin():
+            sess.execute(delete(table).where(table.c.id.in_(removed)))
+    logger.info(
+        f"Knowledge synced: {len(changed)} documents embedded, {len(removed)} removed, "
+        f"{len(documents) - len(changed)} unchanged."
+    )
+
 
+def load_knowledge(recreate: bool = False):
+    """Load the knowledge base into the vector db.
 
-def load_knowledge(recreate: bool = True):
+    Args:
+        recreate: Drop the vector db table and embed every document again,
+            instead of only syncing the documents that changed
+    """
     logger.info("Loading SQL agent knowledge.")
-    agent_knowledge.load(recreate=recreate)
+    if recreate:
+        get_agent_knowledge().load(recreate=True)
+    else:
+        sync_knowledge()
     logger.info("SQL agent knowledge loaded.")
 
 
 if __name__ == "__main__":
-    load_knowledge()
+    parser = argparse.ArgumentParser(description="Load the knowledge directory into the vector db.")
+    parser.add_argument(
+        "--recreate", action="store_true", help="Drop the knowledge table and embed every document again."
+    )
+    args = parser.parse_args()
+    load_knowledge(recreate=args.recreate)
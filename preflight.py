@@ -0,0 +1,232 @@
+"""Local pre-flight of the SQL written by the agent, before it reaches Postgres.
+
+The loader creates the tables with quoted upper-case names (`"FACT_SALES"`),
+which unquoted names like `FROM fact_sales` do not match. The pre-flight
+tokenizes a query and, using the table schemas from the knowledge directory:
+
+- quotes and fixes the case of table names, and the case of quoted column names
+- strips trailing semicolons
+- adds a LIMIT to read queries that have none
+
+Errors Postgres would report anyway, like unbalanced parentheses, unterminated
+strings, several statements or unknown tables, are raised as `PreflightError`
+without a database round-trip.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+from schema import TableSchema
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    |(?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>[EeBbXxNn]?'(?:[^']|'')*'|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$)
+    |(?P<quoted>"(?:[^"]|"")+")
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+    |(?P<word>[A-Za-z_][\w$]*)
+    |(?P<operator>::|<>|!=|>=|<=|\|\||.)
+    """,
+    re.DOTALL | re.VERBOSE,
+)
+# Functions using FROM inside their arguments, e.g. EXTRACT(YEAR FROM full_date)
+FROM_FUNCTIONS = {"EXTRACT", "SUBSTRING", "TRIM", "OVERLAY"}
+
+
+class PreflightError(Exception):
+    """A query that cannot run, found without sending it to the database"""
+
+    def __init__(self, reason: str, **details: Any):
+        super().__init__(reason)
+        self.details: Dict[str, Any] = {"error": "preflight", "reason": reason, **details}
+
+
+@dataclass
+class Token:
+    kind: str
+    text: str
+    start: int
+    end: int
+
+    @property
+    def upper(self) -> str:
+        return self.text.upper()
+
+
+@dataclass
+class PreflightResult:
+    sql: str
+    # Descriptions of the changes made to the query
+    fixes: List[str] = field(default_factory=list)
+    # LIMIT added to the query, if it had none
+    limit_added: Optional[int] = None
+
+
+def tokenize(sql: str) -> List[Token]:
+    """Split a query into tokens, without whitespace"""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup if match.lastgroup != "tag" else "string"
+        if kind == "space":
+            continue
+        if kind == "operator" and match.group(0) == "'":
+            raise PreflightError("Unterminated string literal.")
+        if kind == "operator" and match.group(0) == '"':
+            raise PreflightError("Unterminated quoted identifier.")
+        tokens.append(Token(kind=kind, text=match.group(0), start=match.start(), end=match.end()))
+    return tokens
+
+
+class SQLPreflight:
+    """Checks and fixes queries against the table schemas, without a database"""
+
+    def __init__(self, table_schemas: Dict[str, TableSchema], auto_limit: Optional[int] = 1_000):
+        """
+        Args:
+            table_schemas: Schemas of the tables the queries read
+            auto_limit: LIMIT added to read queries without one, None to not add any
+        """
+        self.tables = {name.upper(): name for name in table_schemas}
+        self.columns: Dict[str, Set[str]] = {}
+        for table in table_schemas.values():
+            for column in table.columns:
+                self.columns.setdefault(column.name.lower(), set()).add(column.name)
+        self.auto_limit = auto_limit
+
+    def check(self, sql: str) -> PreflightResult:
+        """Fix a query, or raise `PreflightError` if it cannot run"""
+        tokens = [token for token in tokenize(sql) if token.kind != "comment"]
+        result = PreflightResult(sql=sql)
+
+        # Trailing semicolons are dropped, any other one separates statements
+        while tokens and tokens[-1].text == ";":
+            tokens.pop()
+            result.fixes.append("removed trailing semicolon")
+        if not tokens:
+            raise PreflightError("The query is empty.")
+        if any(token.text == ";" for token in tokens):
+            raise PreflightError("Only one statement can be run at a time.")
+
+        depths = self.depths(tokens)
+        if min(depths) < 0:
+            raise PreflightError("Unbalanced parentheses: `)` without a matching `(`.")
+        if sum(token.text == "(" for token in tokens) != sum(token.text == ")" for token in tokens):
+            raise PreflightError("Unbalanced parentheses: `(` without a matching `)`.")
+
+        cte_names = {
+            tokens[i].upper
+            for i in range(len(tokens) - 2)
+            if tokens[i].kind in ("word", "quoted")
+            and tokens[i + 1].upper == "AS"
+            and (tokens[i + 2].text == "(" or tokens[i + 2].upper in ("MATERIALIZED", "NOT"))
+        }
+
+        edits: List[tuple] = []
+        for i, token in enumerate(tokens):
+            previous = tokens[i - 1] if i > 0 else None
+            following = tokens[i + 1] if i + 1 < len(tokens) else None
+            if previous is not None and previous.text == ".":
+                # Table of a schema-qualified name, or column of a qualified reference
+                if i > 1 and tokens[i - 2].upper == "PUBLIC":
+                    table = self.fix_table(token)
+                    if table is not None:
+                        edits.append((token, table, f"table {token.text} -> {table}"))
+                    continue
+                name = self.fix_column(token)
+                if name is not None:
+                    edits.append((token, name, f"column {token.text} -> {name}"))
+                continue
+            if following is not None and following.text == "(":
+                continue
+            if token.kind in ("word", "quoted"):
+                table = self.fix_table(token)
+                if table is not None:
+                    edits.append((token, table, f"table {token.text} -> {table}"))
+                    continue
+                name = self.fix_column(token)
+                if name is not None:
+                    edits.append((token, name, f"column {token.text} -> {name}"))
+            if (
+                token.upper in ("FROM", "JOIN")
+                and not (previous is not None and previous.upper == "DISTINCT")
+                and not self.in_from_function(tokens, i)
+            ):
+                self.check_table_reference(tokens, i + 1, cte_names)
+
+        result.fixes.extend(description for _, _, description in edits)
+        fixed = sql
+        # Apply the edits from the end, so the offsets of the others stay valid
+        for token, replacement, _ in reversed(edits):
+            fixed = fixed[: token.start] + replacement + fixed[token.end :]
+        # Cut what followed the last token: trailing semicolons and comments
+        fixed = fixed[: tokens[-1].end + len(fixed) - len(sql)].rstrip()
+
+        if self.auto_limit is not None and tokens[0].upper in ("SELECT", "WITH"):
+            top_level = [token.upper for token, level in zip(tokens, depths) if level == 0]
+            if "LIMIT" not in top_level and "FETCH" not in top_level:
+                fixed = f"{fixed}\nLIMIT {self.auto_limit}"
+                result.limit_added = self.auto_limit
+                result.fixes.append(f"added LIMIT {self.auto_limit}")
+        result.sql = fixed
+        return result
+
+    @staticmethod
+    def depths(tokens: List[Token]) -> List[int]:
+        """Parenthesis depth of each token"""
+        depths, depth = [], 0
+        for token in tokens:
+            if token.text == ")":
+                depth -= 1
+            depths.append(depth)
+            if token.text == "(":
+                depth += 1
+        return depths
+
+    @staticmethod
+    def in_from_function(tokens: List[Token], index: int) -> bool:
+        """Whether the FROM at `index` is an argument of a function like EXTRACT"""
+        depth = 0
+        for i in range(index - 1, -1, -1):
+            if tokens[i].text == ")":
+                depth += 1
+            elif tokens[i].text == "(":
+                if depth == 0:
+                    return i > 0 and tokens[i - 1].upper in FROM_FUNCTIONS
+                depth -= 1
+        return False
+
+    def fix_table(self, token: Token) -> Optional[str]:
+        """Quoted name of the table a word refers to, if it is not written that way"""
+        name = token.text[1:-1] if token.kind == "quoted" else token.text
+        table = self.tables.get(name.upper())
+        if table is None or token.text == f'"{table}"':
+            return None
+        return f'"{table}"'
+
+    def fix_column(self, token: Token) -> Optional[str]:
+        """Name of the column a quoted identifier refers to, in the right case"""
+        if token.kind != "quoted":
+            return None
+        name = token.text[1:-1]
+        candidates = self.columns.get(name.lower(), set())
+        if len(candidates) != 1 or name in candidates:
+            return None
+        return f'"{next(iter(candidates))}"'
+
+    def check_table_reference(self, tokens: List[Token], index: int, cte_names: Set[str]) -> None:
+        while index < len(tokens) and tokens[index].upper in ("ONLY", "LATERAL"):
+            index += 1
+        if index >= len(tokens):
+            raise PreflightError("The query ends with FROM or JOIN, a table name is missing.")
+        token = tokens[index]
+        if token.text == "(" or token.kind not in ("word", "quoted"):
+            return
+        if index + 1 < len(tokens) and tokens[index + 1].text in (".", "("):
+            # Schema-qualified name or function, e.g. information_schema.columns or generate_series(...)
+            return
+        name = token.text[1:-1] if token.kind == "quoted" else token.text
+        if name.upper() in self.tables or token.upper in cte_names or name.lower().startswith("pg_"):
+            return
+        raise PreflightError(f"Unknown table {token.text}.", known_tables=sorted(self.tables.values()))
@@ -0,0 +1,208 @@
+"""Question cache for the SQL agent.
+
+Questions answered with a successful read query are stored in Postgres together
+with their embedding and that query. When a new question is close enough to a
+stored one, and mentions the same numbers, the stored query is run directly and
+the agent is only asked to format its result, instead of searching the
+knowledge base, describing tables and writing the query again.
+"""
+
+import re
+from dataclasses import dataclass
+from hashlib import md5
+from typing import Any, Dict, List, Optional, Tuple
+
+from agno.agent import Agent
+from agno.embedder.base import Embedder
+from agno.tools.sql import SQLTools
+from agno.utils.log import log_debug, logger
+from pgvector.sqlalchemy import Vector
+from sql_tools import is_read_query
+from sqlalchemy import Column, DateTime, Engine, Integer, MetaData, String, Table, Text, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+# Tools reading the conversation: an answer using them depends on earlier turns and is not reusable
+HISTORY_TOOLS = {"get_chat_history", "get_tool_call_history"}
+
+
+def question_key(question: str) -> str:
+    return md5(re.sub(r"\s+", " ", question).strip().lower().encode()).hexdigest()
+
+
+def question_numbers(question: str) -> List[str]:
+    """Numbers in a question, e.g. the 5 of "top 5 customers", which change the query but barely the embedding"""
+    return sorted(re.findall(r"\d+(?:\.\d+)?", question))
+
+
+def successful_query(tools: Optional[List[Dict[str, Any]]]) -> Optional[Tuple[str, Optional[int]]]:
+    """The last read query a run executed without error, with its row limit.
+
+    Returns:
+        Optional[Tuple[str, Optional[int]]]: (query, limit), or None if no query succeeded
+            or the run read the chat history
+    """
+    query = None
+    for tool in tools or []:
+        tool_name = tool.get("tool_name")
+        if tool_name in HISTORY_TOOLS:
+            return None
+        if tool_name != "run_sql_query" or tool.get("tool_call_error"):
+            continue
+        tool_args = tool.get("tool_args") or {}
+        content = tool.get("content")
+        sql = tool_args.get("query")
+        if not sql or not isinstance(content, str) or content.startswith("Error") or not is_read_query(sql):
+            continue
+        query = (sql.strip().rstrip(";"), tool_args.get("limit", 10))
+    return query
+
+
+@dataclass
+class CachedQuestion:
+    id: str
+    question: str
+    sql: str
+    limit: Optional[int]
+    similarity: float
+
+
+class QuestionCache:
+    """Questions and the query that answered them, searched by embedding similarity"""
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        embedder: Embedder,
+        table_name: str = "sql_agent_question_cache",
+        schema: str = "ai",
+        threshold: float = 0.95,
+    ):
+        """
+        Args:
+            db_engine: Engine of the database storing the questions
+            embedder: Embedder for the questions
+            table_name: Table storing the questions
+            schema: Schema of the table
+            threshold: Minimum cosine similarity for a stored question to be reused
+        """
+        self.db_engine = db_engine
+        self.embedder = embedder
+        self.schema = schema
+        self.threshold = threshold
+        self.table = Table(
+            table_name,
+            MetaData(schema=schema),
+            Column("id", String, primary_key=True),
+            Column("question", Text, nullable=False),
+            Column("sql", Text, nullable=False),
+            Column("row_limit", Integer),
+            Column("embedding", Vector(embedder.dimensions)),
+            Column("hits", Integer, nullable=False, server_default="0"),
+            Column("created_at", DateTime(timezone=True), server_default=func.now()),
+            Column("last_used_at", DateTime(timezone=True), server_default=func.now()),
+        )
+        self._created = False
+
+    def create(self) -> None:
+        if self._created:
+            return
+        with self.db_engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {self.schema}"))
+            self.table.create(conn, checkfirst=True)
+        self._created = True
+
+    def lookup(self, question: str) -> Optional[CachedQuestion]:
+        """Get the most similar stored question above the threshold that mentions the same numbers"""
+        try:
+            self.create()
+            distance = self.table.c.embedding.cosine_distance(self.embedder.get_embedding(question))
+            with self.db_engine.connect() as conn:
+                rows = conn.execute(
+                    select(
+                        self.table.c.id,
+                        self.table.c.question,
+                        self.table.c.sql,
+                        self.table.c.row_limit,
+                        distance.label("distance"),
+                    )
+                    .where(distance <= 1 - self.threshold)
+                    .order_by(distance)
+                    .limit(5)
+                ).all()
+        except Exception as e:
+            logger.warning(f"Question cache lookup failed: {e}")
+            return None
+
+        numbers = question_numbers(question)
+        for row in rows:
+            if question_numbers(row.question) == numbers:
+                return CachedQuestion(
+                    id=row.id, question=row.question, sql=row.sql, limit=row.row_limit, similarity=1 - row.distance
+                )
+        return None
+
+    def add(self, question: str, sql: str, limit: Optional[int]) -> None:
+        self.create()
+        statement = insert(self.table).values(
+            id=question_key(question),
+            question=question,
+            sql=sql,
+            row_limit=limit,
+            embedding=self.embedder.get_embedding(question),
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[self.table.c.id],
+            set_={"sql": statement.excluded.sql, "row_limit": statement.excluded.row_limit, "last_used_at": func.now()},
+        )
+        with self.db_engine.begin() as conn:
+            conn.execute(statement)
+
+    def remove(self, cached: CachedQuestion) -> None:
+        with self.db_engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.id == cached.id))
+
+    def remember(self, question: str, tools: Optional[List[Dict[str, Any]]]) -> None:
+        """Store the query that answered a question, if the run has one that can be reused"""
+        query = successful_query(tools)
+        if query is None:
+            return
+        try:
+            self.add(question, *query)
+            log_debug(f"Question cached: {question}")
+        except Exception as e:
+            logger.warning(f"Could not cache question: {e}")
+
+    def answer(self, question: str, agent: Agent) -> Optional[str]:
+        """Run the stored query of a similar question with the agent's SQL tools.
+
+        Returns:
+            Optional[str]: Message asking the agent to answer from the query result,
+                or None if no stored question matches or its query now fails
+        """
+        cached = self.lookup(question)
+        sql_tools = next((tool for tool in agent.tools or [] if isinstance(tool, SQLTools)), None)
+        if cached is None or sql_tools is None:
+            return None
+
+        result = sql_tools.run_sql_query(cached.sql, limit=cached.limit)
+        if result.startswith("Error"):
+            # The query no longer runs, e.g. after a schema change: answer the question from scratch
+            logger.info(f"Dropping cached question, its query failed: {cached.question}")
+            self.remove(cached)
+            return None
+
+        logger.info(f"Question cache hit ({cached.similarity:.3f}): {cached.question}")
+        with self.db_engine.begin() as conn:
+            conn.execute(
+                self.table.update()
+                .where(self.table.c.id == cached.id)
+                .values(hits=self.table.c.hits + 1, last_used_at=func.now())
+            )
+        return (
+            f"This question was answered before as: {cached.question}\n"
+            "The query below answered it and has just been run again. Do not call any tool: answer the question "
+            "from this result, show the SQL query and follow the formatting rules.\n"
+            f"<query>\n{cached.sql}\n</query>\n"
+            f"<result>\n{result}\n</result>"
+        )
@@ -0,0 +1,196 @@
+"""Knowledge retrieval for the SQL agent.
+
+The agent calls `search_knowledge_base(table_name)` before writing every query.
+Those lookups are answered from an in-memory index of the `knowledge/*.json`
+table metadata files, built once at startup, without an embedding request or a
+vector search. Free-text queries are answered by fusing the vector db results
+with a local BM25 keyword index over the same documents.
+
+Sample queries are stored as one document per `<query>` block together with its
+`<query description>`, so a retrieved sample is always complete.
+"""
+
+import json
+import math
+import re
+from collections import Counter
+from hashlib import md5
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from agno.document import Document
+from agno.knowledge.agent import AgentKnowledge
+from agno.utils.log import log_debug
+
+# A sample query block of `knowledge/sample_queries.sql`
+SAMPLE_QUERY_PATTERN = re.compile(
+    r"^--\s*<query description>\s*$(?P<description>.*?)^--\s*</query description>\s*$\s*"
+    r"^--\s*<query>\s*$(?P<sql>.*?)^--\s*</query>\s*$",
+    re.MULTILINE | re.DOTALL,
+)
+
+
+def parse_sample_queries(path: Path) -> List[Document]:
+    """Read a SQL file of sample queries into one document per query, including its description"""
+    documents = []
+    for match in SAMPLE_QUERY_PATTERN.finditer(path.read_text("utf-8")):
+        description = " ".join(
+            line.strip().lstrip("-").strip() for line in match.group("description").splitlines() if line.strip()
+        )
+        sql = match.group("sql").strip()
+        documents.append(
+            Document(
+                # Keyed by description, so adding a query does not change the ids of the others
+                id=f"{path.stem}_{md5(description.encode()).hexdigest()[:16]}",
+                name=path.stem,
+                meta_data={"description": description},
+                content=f"-- <query description>\n-- {description}\n-- </query description>\n-- <query>\n{sql}\n-- </query>",
+            )
+        )
+    return documents
+
+
+class SampleQueriesKnowledgeBase(AgentKnowledge):
+    """Knowledge base of the `.sql` sample query files in a directory, one document per query"""
+
+    path: Union[str, Path]
+
+    @property
+    def document_lists(self) -> Iterator[List[Document]]:
+        _path = Path(self.path)
+        files = sorted(_path.glob("*.sql")) if _path.is_dir() else [_path]
+        for _file in files:
+            if _file.exists() and _file.suffix == ".sql":
+                yield parse_sample_queries(_file)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words, with identifiers like `fact_sales` also split into their parts"""
+    tokens = []
+    for word in re.findall(r"\w+", text.lower()):
+        tokens.append(word)
+        if "_" in word:
+            tokens.extend(part for part in word.split("_") if part)
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 keyword index over a fixed set of documents"""
+
+    def __init__(self, documents: List[Document], k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(document.content)) for document in documents]
+        self.lengths = [sum(tf.values()) for tf in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequencies = Counter(term for tf in self.term_frequencies for term in tf)
+        n = len(documents)
+        self.idf = {
+            term: math.log(1 + (n - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    @classmethod
+    def from_knowledge(cls, knowledge: AgentKnowledge) -> "BM25Index":
+        return cls([document for document_list in knowledge.document_lists for document in document_list])
+
+    def search(self, query: str, limit: int = 5) -> List[Document]:
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = []
+        for i, tf in enumerate(self.term_frequencies):
+            score = 0.0
+            for term in terms:
+                frequency = tf.get(term, 0)
+                if frequency:
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average_length)
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return [self.documents[i] for _, i in scores[:limit]]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], limit: int, k: int = 60) -> List[Document]:
+    """Merge ranked document lists, scoring each document by the sum of 1 / (k + rank) over the lists"""
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = md5(document.content.encode()).hexdigest()
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [documents[key] for key in best]
+
+
+class TableMetadataIndex:
+    """Table metadata documents from the knowledge directory, keyed by upper-case table name"""
+
+    def __init__(self, knowledge_dir: Path):
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(knowledge_dir.glob("*.json")):
+            metadata = json.loads(path.read_text("utf-8"))
+            if "table_name" not in metadata:
+                continue
+            # Same shape as the documents returned by the vector db for this file
+            self.documents[metadata["table_name"].upper()] = {
+                "name": path.name.split(".")[0],
+                "meta_data": {"page": 1},
+                "content": json.dumps(metadata),
+            }
+
+    def lookup(self, query: str) -> Optional[List[Dict[str, Any]]]:
+        """Get the metadata of the tables named in the query.
+
+        The query matches if it is a table name, or a list of table names separated
+        by commas or whitespace, in any case and optionally quoted.
+
+        Returns:
+            Optional[List[Dict[str, Any]]]: Metadata documents, or None if the query is not a table name lookup
+        """
+        names = [name for name in re.split(r"[\s,]+", query.strip().upper()) if name]
+        names = [name.strip("\"'`") for name in names]
+        if not names or any(name not in self.documents for name in names):
+            return None
+        return [self.documents[name] for name in dict.fromkeys(names)]
+
+
+class KnowledgeRetriever:
+    """Retriever for `Agent(retriever=...)`.
+
+    Exact table names are answered from the metadata index. Other queries get the
+    vector db and keyword index results, fused by reciprocal rank.
+    """
+
+    def __init__(
+        self,
+        knowledge: AgentKnowledge,
+        table_index: TableMetadataIndex,
+        keyword_index: Optional[BM25Index] = None,
+    ):
+        self.knowledge = knowledge
+        self.table_index = table_index
+        self.keyword_index = keyword_index
+
+    def __call__(self, query: str, num_documents: Optional[int] = None, **kwargs) -> Optional[List[Dict[str, Any]]]:
+        documents = self.table_index.lookup(query)
+        if documents is not None:
+            log_debug(f"Table metadata lookup: {query}")
+            return documents
+
+        limit = num_documents or self.knowledge.num_documents
+        if self.keyword_index is None:
+            relevant_docs = self.knowledge.search(query=query, num_documents=limit, **kwargs)
+        else:
+            # Fetch more candidates from each side than returned, the fusion keeps the best ones
+            relevant_docs = reciprocal_rank_fusion(
+                [
+                    self.knowledge.search(query=query, num_documents=limit * 2, **kwargs),
+                    self.keyword_index.search(query, limit=limit * 2),
+                ],
+                limit=limit,
+            )
+        if len(relevant_docs) == 0:
+            return None
+        return [doc.to_dict() for doc in relevant_docs]
@@ -0,0 +1,290 @@
+"""Rollups of the fact tables, and rewriting of queries to read them.
+
+A rollup is a materialized view summing the measures of a fact table at a
+coarser grain, e.g. sales per date and store. `load_retail_data()` builds the
+rollups of the tables it replaces and refreshes the rollups of the tables it
+upserts with `REFRESH MATERIALIZED VIEW CONCURRENTLY`. The refresh is not
+incremental: Postgres runs the whole view query again and applies the difference
+to the rollup, but it does not block the queries reading the rollup meanwhile.
+
+`RollupRewriter.rewrite` points an aggregate query at the smallest rollup that
+answers it. A query is only rewritten when the result is guaranteed to be the
+same: it is a single SELECT reading the fact table once, every fact column it
+uses outside `SUM(column)` is in the rollup grain, and its only other aggregates
+are `COUNT(*)`, `COUNT(DISTINCT ...)`, `MIN` and `MAX`. Any other query runs
+unchanged.
+"""
+
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from agno.utils.log import log_debug
+from schema import TableSchema, constraint_name
+from sqlalchemy import Engine, text
+
+SALES_MEASURES = ["quantity_sold", "extended_price", "discount_amount", "net_price", "cost_amount", "profit_margin"]
+INVENTORY_MEASURES = [
+    "beginning_quantity",
+    "received_quantity",
+    "sold_quantity",
+    "adjusted_quantity",
+    "ending_quantity",
+]
+
+
+@dataclass
+class Rollup:
+    name: str
+    source: str
+    grain: List[str]
+    # Columns of the source table summed in the rollup, under the same name
+    measures: List[str]
+
+
+# Rollups of each fact table, from the smallest to the largest: queries are rewritten to the first that fits.
+# The loader only builds the rollups of the fact tables that exist and have rows.
+ROLLUPS = [
+    Rollup("ROLLUP_SALES_CUSTOMER", "FACT_SALES", ["customer_id"], SALES_MEASURES),
+    Rollup("ROLLUP_SALES_DATE_PROMOTION", "FACT_SALES", ["date_id", "promotion_id"], SALES_MEASURES),
+    Rollup("ROLLUP_SALES_DATE_STORE", "FACT_SALES", ["date_id", "store_id"], SALES_MEASURES),
+    Rollup("ROLLUP_SALES_DATE_PRODUCT", "FACT_SALES", ["date_id", "product_id"], SALES_MEASURES),
+    # Stockout flags are part of the grain, so stockout filters and counts can use the inventory rollups
+    Rollup("ROLLUP_INVENTORY_DATE_STORE", "FACT_INVENTORY", ["date_id", "store_id", "is_stockout"], INVENTORY_MEASURES),
+    Rollup(
+        "ROLLUP_INVENTORY_DATE_PRODUCT", "FACT_INVENTORY", ["date_id", "product_id", "is_stockout"], INVENTORY_MEASURES
+    ),
+]
+
+
+def create_rollup_sql(rollup: Rollup) -> List[str]:
+    """Statements creating the materialized view of a rollup and the unique index its concurrent refresh needs"""
+    grain = ", ".join(f'"{column}"' for column in rollup.grain)
+    measures = ", ".join(f'SUM("{column}") AS "{column}"' for column in rollup.measures)
+    return [
+        f'CREATE MATERIALIZED VIEW IF NOT EXISTS "{rollup.name}" AS '
+        f'SELECT {grain}, {measures}, COUNT(*) AS "row_count" FROM "{rollup.source}" GROUP BY {grain}',
+        f'CREATE UNIQUE INDEX IF NOT EXISTS "{constraint_name("ux", rollup.name)}" ON "{rollup.name}" ({grain})',
+    ]
+
+
+def refresh_rollup_sql(rollup: Rollup) -> str:
+    """Statement recomputing a rollup without blocking its readers"""
+    return f'REFRESH MATERIALIZED VIEW CONCURRENTLY "{rollup.name}"'
+
+
+def drop_rollup_sql(rollup: Rollup) -> str:
+    return f'DROP MATERIALIZED VIEW IF EXISTS "{rollup.name}"'
+
+
+def get_existing_rollups(engine: Engine) -> Set[str]:
+    """Names of the populated rollups in the database"""
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT matviewname FROM pg_matviews WHERE ispopulated"))
+        return {name for name, in rows}
+
+
+# A table read by a query, with its optional schema and alias
+TABLE_PATTERN = re.compile(
+    r'\b(?:FROM|JOIN)\s+(?P<table>(?:\w+\.)?(?P<quote>"?)(?P<name>\w+)(?P=quote))'
+    r'(?:\s+(?:AS\s+)?(?P<alias>"?\w+"?))?',
+    re.IGNORECASE,
+)
+# Words that can follow a table name and are not its alias
+NOT_ALIASES = {
+    "ON", "USING", "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "NATURAL",
+    "GROUP", "ORDER", "HAVING", "LIMIT", "OFFSET", "UNION", "INTERSECT", "EXCEPT", "WINDOW", "FETCH",
+}  # fmt: skip
+# Aggregates giving a different result over a rollup than over the fact rows
+UNSAFE_PATTERN = re.compile(
+    r"\b(?:AVG|STDDEV\w*|VARIANCE|VAR_\w+|ARRAY_AGG|STRING_AGG|JSONB?_AGG|JSONB?_OBJECT_AGG|BOOL_AND|BOOL_OR|EVERY"
+    r"|PERCENTILE_\w+|MODE|CORR|COVAR_\w+|REGR_\w+|BIT_AND|BIT_OR)\s*\(|\bOVER\b",
+    re.IGNORECASE,
+)
+COUNT_ROWS_PATTERN = re.compile(r"\bCOUNT\s*\(\s*(?:\*|1)\s*\)", re.IGNORECASE)
+COUNT_PATTERN = re.compile(r"\bCOUNT\s*\(\s*(?P<distinct>DISTINCT\b)?", re.IGNORECASE)
+SUM_PATTERN = re.compile(r"\bSUM\s*\(", re.IGNORECASE)
+
+
+def mask_literals(sql: str) -> str:
+    """Blank out string literals and comments, keeping every offset the same"""
+
+    def blank(match: re.Match) -> str:
+        token = match.group(0)
+        if token.startswith("'"):
+            return "'" + " " * (len(token) - 2) + "'"
+        return " " * len(token)
+
+    return re.sub(r"'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/", blank, sql, flags=re.DOTALL)
+
+
+def paren_depths(sql: str) -> List[int]:
+    """Parenthesis nesting depth at each offset of a query"""
+    depths, depth = [], 0
+    for char in sql:
+        if char == ")":
+            depth -= 1
+        depths.append(depth)
+        if char == "(":
+            depth += 1
+    return depths
+
+
+def column_pattern(ref: str, columns: List[str]) -> re.Pattern:
+    """References to columns of a table: qualified by its alias, or bare"""
+    names = "|".join(re.escape(column) for column in sorted(columns, key=len, reverse=True))
+    qualifier = re.escape(ref) if ref.startswith('"') else f"(?i:{re.escape(ref)})"
+    return re.compile(rf'(?:(?<![\w."]){qualifier}\.|(?<![\w."]))"?(?P<column>{names})"?(?![\w.(])')
+
+
+class RollupRewriter:
+    """Rewrites aggregate queries over fact tables to read the matching rollup"""
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        table_schemas: Dict[str, TableSchema],
+        rollups: Optional[List[Rollup]] = None,
+        check_interval: float = 5,
+    ):
+        """
+        Args:
+            db_engine: Engine to list the rollups built in the database
+            table_schemas: Schemas of the tables, to know the columns of the fact tables
+            rollups: Rollups queries can be rewritten to
+            check_interval: Seconds between two reads of the rollups built in the database
+        """
+        self.db_engine = db_engine
+        self.table_schemas = {name.upper(): table for name, table in table_schemas.items()}
+        self.rollups = ROLLUPS if rollups is None else rollups
+        self.check_interval = check_interval
+        self._available: Set[str] = set()
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def available(self) -> Set[str]:
+        """Rollups built in the database, read again every `check_interval` seconds"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at > self.check_interval:
+                self._checked_at = now
+                try:
+                    self._available = get_existing_rollups(self.db_engine)
+                except Exception as e:
+                    log_debug(f"Could not list rollups: {e}")
+                    self._available = set()
+            return self._available
+
+    def rewrite(self, sql: str) -> str:
+        """Get the query reading a rollup instead of the fact table, or the query unchanged"""
+        masked = mask_literals(sql)
+        if not re.match(r"\s*SELECT\b", masked, re.IGNORECASE) or len(re.findall(r"\bSELECT\b", masked, re.I)) != 1:
+            return sql
+        if UNSAFE_PATTERN.search(masked) or re.search(r"\bSELECT\s+(?:DISTINCT\s+)?\*|\.\s*\*", masked, re.I):
+            return sql
+        if re.search(r"\b(?:RIGHT|FULL)\s+(?:OUTER\s+)?JOIN\b", masked, re.IGNORECASE):
+            return sql
+        # Without aggregation the number of rows returned depends on the number of fact rows
+        if not (
+            re.search(r"\bGROUP\s+BY\b|\bSELECT\s+DISTINCT\b", masked, re.IGNORECASE)
+            or SUM_PATTERN.search(masked)
+            or COUNT_PATTERN.search(masked)
+        ):
+            return sql
+
+        # Tables read by the query, ignoring the FROM of functions like EXTRACT(YEAR FROM ...)
+        depths = paren_depths(masked)
+        references = [match for match in TABLE_PATTERN.finditer(masked) if depths[match.start()] == 0]
+        if not references or any(match.group("name").upper() not in self.table_schemas for match in references):
+            return sql
+        sources = {rollup.source for rollup in self.rollups}
+        facts = [match for match in references if match.group("name").upper() in sources]
+        if len(facts) != 1 or not facts[0].group(0).upper().startswith("FROM"):
+            # The fact table must be read once, and never on the nullable side of an outer join
+            return sql
+        fact = facts[0]
+        if len(re.findall(rf"\b{fact.group('name')}\b", masked, re.IGNORECASE)) != 1:
+            return sql
+
+        rewritten = self.rewrite_fact(sql, masked, fact)
+        if rewritten is not None:
+            log_debug(f"Rewrote query to read a rollup:\n{rewritten}")
+            return rewritten
+        return sql
+
+    def rewrite_fact(self, sql: str, masked: str, fact: re.Match) -> Optional[str]:
+        fact_name = fact.group("name").upper()
+        table = self.table_schemas[fact_name]
+        alias = fact.group("alias")
+        if alias is not None and alias.strip('"').upper() in NOT_ALIASES:
+            alias = None
+        ref = alias or fact.group("table").split(".")[-1]
+
+        # Every SUM must be over a fact column: summing anything else, e.g. a
+        # dimension column, would count it once per rollup row instead of per fact row
+        sums: List[Tuple[int, int, str]] = []
+        sum_argument = re.compile(rf'\s*(?:{re.escape(ref)}\.)?"?(?P<column>\w+)"?\s*\)', re.IGNORECASE)
+        for match in SUM_PATTERN.finditer(masked):
+            argument = sum_argument.match(masked, match.end())
+            if argument is None or table.column(argument.group("column")) is None:
+                return None
+            sums.append((match.start(), argument.end(), argument.group("column")))
+
+        # Counting rows is a sum of the row counts, counting values is not
+        for match in COUNT_PATTERN.finditer(masked):
+            if match.group("distinct") is None and not COUNT_ROWS_PATTERN.match(masked, match.start()):
+                return None
+
+        # Fact columns used outside of a SUM must be in the grain of the rollup
+        grouped: Set[str] = set()
+        for match in column_pattern(ref, [column.name for column in table.columns]).finditer(masked):
+            if not any(start <= match.start() < end for start, end, _ in sums):
+                grouped.add(match.group("column"))
+        summed = {column for _, _, column in sums}
+
+        available = self.available()
+        rollup = next(
+            (
+                rollup
+                for rollup in self.rollups
+                if rollup.source == fact_name
+                and rollup.name in available
+                and grouped <= set(rollup.grain)
+                and summed <= set(rollup.measures)
+            ),
+            None,
+        )
+        if rollup is None:
+            return None
+
+        edits: List[Tuple[int, int, str]] = []
+        for _, end, column in sums:
+            if table.column(column).type == "INTEGER":
+                # Keep the BIGINT type of a sum of integers, instead of the NUMERIC of a sum of sums
+                edits.append((end, end, "::BIGINT"))
+        depths = paren_depths(masked)
+        select_end = next(
+            (match.start() for match in re.finditer(r"\bFROM\b", masked, re.I) if depths[match.start()] == 0),
+            len(masked),
+        )
+        for match in COUNT_ROWS_PATTERN.finditer(masked):
+            # COUNT(*) over no rows is 0, not the NULL of a SUM
+            replacement = f"COALESCE(SUM({ref}.row_count), 0)::BIGINT"
+            if (
+                depths[match.start()] == 0
+                and match.end() <= select_end
+                and re.search(r"(?:\bSELECT(?:\s+DISTINCT)?|,)\s*$", masked[: match.start()], re.IGNORECASE)
+                and re.match(r"\s*(?:,|FROM\b)", masked[match.end() :], re.IGNORECASE)
+            ):
+                # Keep the name of the unaliased column
+                replacement += " AS count"
+            edits.append((match.start(), match.end(), replacement))
+        edits.append(
+            (fact.start("table"), fact.end("table"), f'"{rollup.name}"' + ("" if alias is not None else f" AS {ref}"))
+        )
+        # Apply the edits from the end, so the offsets of the others stay valid
+        for start, end, replacement in sorted(edits, reverse=True):
+            sql = sql[:start] + replacement + sql[end:]
+        return sql
@@ -0,0 +1,146 @@
+"""Typed table schemas built from the table metadata in the knowledge directory.
+
+Each `knowledge/*.json` file lists the columns of a table with their `column_type`
+and `column_attr` (PK, FK, NOTNULL). This module turns them into Postgres DDL:
+typed CREATE TABLE statements, primary keys, foreign keys and indexes on the
+foreign key columns used by the joins in the semantic model.
+"""
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Table recording the fingerprint of the file each table was last loaded from, and when
+LOAD_STATE_TABLE = "ai.retail_load_state"
+
+# Postgres types for the `column_type` values used in the knowledge files
+POSTGRES_TYPES = {
+    "int": "INTEGER",
+    "decimal": "NUMERIC",
+    "float": "DOUBLE PRECISION",
+    "varchar": "TEXT",
+    "date": "DATE",
+    "timestamp": "TIMESTAMP",
+    "boolean": "BOOLEAN",
+}
+
+
+@dataclass
+class ColumnSchema:
+    name: str
+    type: str
+    not_null: bool = False
+
+
+@dataclass
+class ForeignKey:
+    column: str
+    ref_table: str
+    ref_column: str
+
+
+@dataclass
+class TableSchema:
+    name: str
+    columns: List[ColumnSchema]
+    primary_key: Optional[str] = None
+    foreign_keys: List[ForeignKey] = field(default_factory=list)
+
+    def column(self, name: str) -> Optional[ColumnSchema]:
+        return next((column for column in self.columns if column.name == name), None)
+
+
+def load_table_schemas(knowledge_dir: Path) -> Dict[str, TableSchema]:
+    """Build the schema of every table described by a JSON file in `knowledge_dir`.
+
+    A column marked FK references the table whose primary key has the same name,
+    and takes the type of that primary key so the constraint can be created.
+
+    Returns:
+        Dict[str, TableSchema]: table name -> schema
+    """
+    tables: Dict[str, TableSchema] = {}
+    foreign_key_columns: Dict[str, List[str]] = {}
+    for path in sorted(knowledge_dir.glob("*.json")):
+        metadata = json.loads(path.read_text())
+        table = TableSchema(name=metadata["table_name"], columns=[])
+        for column in metadata.get("columns", []):
+            attrs = {attr.upper() for attr in column.get("column_attr", [])}
+            table.columns.append(
+                ColumnSchema(
+                    name=column["column_name"],
+                    type=POSTGRES_TYPES.get(column.get("column_type", "").lower(), "TEXT"),
+                    not_null="NOTNULL" in attrs or "PK" in attrs,
+                )
+            )
+            if "PK" in attrs:
+                table.primary_key = column["column_name"]
+            if "FK" in attrs:
+                foreign_key_columns.setdefault(table.name, []).append(column["column_name"])
+        tables[table.name] = table
+
+    primary_key_tables = {table.primary_key: table for table in tables.values() if table.primary_key}
+    for table_name, columns in foreign_key_columns.items():
+        for column_name in columns:
+            ref_table = primary_key_tables.get(column_name)
+            if ref_table is None or ref_table.name == table_name:
+                continue
+            column = tables[table_name].column(column_name)
+            column.type = ref_table.column(column_name).type
+            tables[table_name].foreign_keys.append(
+                ForeignKey(column=column_name, ref_table=ref_table.name, ref_column=column_name)
+            )
+    return tables
+
+
+def constraint_name(prefix: str, table: str, column: str = "") -> str:
+    """Deterministic name for a constraint or index, so a later load can find and drop it"""
+    return "_".join(part for part in (prefix, table.lower(), column.lower()) if part)
+
+
+def create_table_sql(table: TableSchema) -> str:
+    """CREATE TABLE statement with the column types and NOT NULL constraints, without keys"""
+    columns = ", ".join(
+        f'"{column.name}" {column.type}{" NOT NULL" if column.not_null else ""}' for column in table.columns
+    )
+    return f'CREATE TABLE "{table.name}" ({columns})'
+
+
+def cast_sql(column: ColumnSchema) -> str:
+    """Expression converting a text column of a staging table to the column type"""
+    expression = f'"{column.name}"'
+    if column.type == "TEXT":
+        return expression
+    if column.type == "INTEGER":
+        # Nullable integer columns are exported by pandas as floats, e.g. `44.0`
+        return f"{expression}::NUMERIC::INTEGER"
+    return f"{expression}::{column.type}"
+
+
+def primary_key_sql(table: TableSchema) -> str:
+    return (
+        f'ALTER TABLE "{table.name}" ADD CONSTRAINT "{constraint_name("pk", table.name)}" '
+        f'PRIMARY KEY ("{table.primary_key}")'
+    )
+
+
+def foreign_key_sql(table: TableSchema, foreign_key: ForeignKey) -> str:
+    return (
+        f'ALTER TABLE "{table.name}" ADD CONSTRAINT "{constraint_name("fk", table.name, foreign_key.column)}" '
+        f'FOREIGN KEY ("{foreign_key.column}") REFERENCES "{foreign_key.ref_table}" ("{foreign_key.ref_column}")'
+    )
+
+
+def drop_foreign_key_sql(table: TableSchema, foreign_key: ForeignKey) -> str:
+    return (
+        f'ALTER TABLE IF EXISTS "{table.name}" '
+        f'DROP CONSTRAINT IF EXISTS "{constraint_name("fk", table.name, foreign_key.column)}"'
+    )
+
+
+def index_sql(table: TableSchema, foreign_key: ForeignKey) -> str:
+    return (
+        f'CREATE INDEX IF NOT EXISTS "{constraint_name("ix", table.name, foreign_key.column)}" '
+        f'ON "{table.name}" ("{foreign_key.column}")'
+    )
@@ -0,0 +1,190 @@
+"""In-memory snapshot of the database catalog, for `describe_table`.
+
+agno's `SQLTools.describe_table` inspects the catalog with a few queries on every
+call, and the agent describes tables before most queries. `SchemaCatalog` reads
+the tables of a schema, their columns, types, comments and the planner's estimate
+of their row count in a single query, and then describes tables from memory.
+
+The snapshot is read again when it may be stale:
+
+- in this process, `load_retail_data()` calls `refresh_schema_catalogs()` once
+  the tables are loaded and analyzed,
+- otherwise, a fingerprint of the tables (oid, storage, column count and row
+  estimate, which change with DDL, rewrites and ANALYZE) is checked at most
+  every `check_interval` seconds.
+"""
+
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from agno.utils.log import log_debug, logger
+from sqlalchemy import Engine, text
+
+# Tables, partitioned tables, views and materialized views
+RELATION_KINDS = "('r', 'p', 'v', 'm')"
+
+CATALOG_QUERY = f"""
+SELECT c.relname AS table_name,
+       c.reltuples AS row_estimate,
+       obj_description(c.oid, 'pg_class') AS table_comment,
+       a.attname AS column_name,
+       format_type(a.atttypid, a.atttypmod) AS column_type,
+       NOT a.attnotnull AS nullable,
+       col_description(c.oid, a.attnum) AS column_comment
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+WHERE n.nspname = :schema AND c.relkind IN {RELATION_KINDS}
+ORDER BY c.relname, a.attnum
+"""
+
+FINGERPRINT_QUERY = f"""
+SELECT md5(coalesce(string_agg(
+    c.oid::text || ':' || c.relfilenode || ':' || c.relnatts || ':' || c.reltuples, ',' ORDER BY c.oid), ''))
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = :schema AND c.relkind IN {RELATION_KINDS}
+"""
+
+
+@dataclass
+class CatalogColumn:
+    name: str
+    type: str
+    nullable: bool
+    description: Optional[str] = None
+
+
+@dataclass
+class CatalogTable:
+    name: str
+    # None until the table is analyzed
+    row_estimate: Optional[int]
+    description: Optional[str] = None
+    columns: List[CatalogColumn] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "table_name": self.name,
+            "description": self.description,
+            "approximate_row_count": self.row_estimate,
+            "columns": [
+                {
+                    "name": column.name,
+                    "type": column.type,
+                    "nullable": column.nullable,
+                    **({"description": column.description} if column.description else {}),
+                }
+                for column in self.columns
+            ],
+        }
+
+
+# Every catalog of the process, refreshed together by `refresh_schema_catalogs`
+schema_catalogs: "weakref.WeakSet[SchemaCatalog]" = weakref.WeakSet()
+
+
+class SchemaCatalog:
+    """Tables and columns of a schema, read from the database once and described from memory"""
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        schema: Optional[str] = None,
+        table_descriptions: Optional[Dict[str, str]] = None,
+        check_interval: float = 5,
+    ):
+        """
+        Args:
+            db_engine: Engine of the database
+            schema: Schema of the tables, `public` by default
+            table_descriptions: Descriptions of the tables without a comment in the database
+            check_interval: Seconds between two checks of the fingerprint of the tables
+        """
+        self.db_engine = db_engine
+        self.schema = schema or "public"
+        self.table_descriptions = table_descriptions or {}
+        self.check_interval = check_interval
+        self.tables: Optional[Dict[str, CatalogTable]] = None
+        self.fingerprint: Optional[str] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        schema_catalogs.add(self)
+
+    def read_fingerprint(self) -> str:
+        with self.db_engine.connect() as conn:
+            return conn.execute(text(FINGERPRINT_QUERY), {"schema": self.schema}).scalar() or ""
+
+    def refresh(self) -> None:
+        """Read the snapshot of the tables from the database"""
+        start = time.perf_counter()
+        with self.db_engine.connect() as conn:
+            fingerprint = conn.execute(text(FINGERPRINT_QUERY), {"schema": self.schema}).scalar() or ""
+            rows = conn.execute(text(CATALOG_QUERY), {"schema": self.schema}).all()
+        tables: Dict[str, CatalogTable] = {}
+        for row in rows:
+            table = tables.get(row.table_name)
+            if table is None:
+                table = tables[row.table_name] = CatalogTable(
+                    name=row.table_name,
+                    row_estimate=int(row.row_estimate) if row.row_estimate is not None and row.row_estimate >= 0 else None,
+                    description=row.table_comment or self.table_descriptions.get(row.table_name),
+                )
+            table.columns.append(
+                CatalogColumn(
+                    name=row.column_name, type=row.column_type, nullable=row.nullable, description=row.column_comment
+                )
+            )
+        with self._lock:
+            self.tables = tables
+            self.fingerprint = fingerprint
+            self._checked_at = time.monotonic()
+        log_debug(f"Schema catalog of {self.schema}: {len(tables)} tables in {time.perf_counter() - start:.3f}s")
+
+    def invalidate(self) -> None:
+        """Read the snapshot again on the next lookup"""
+        with self._lock:
+            self.tables = None
+
+    def snapshot(self) -> Dict[str, CatalogTable]:
+        """Current snapshot, read again if it was invalidated or the fingerprint of the tables changed"""
+        now = time.monotonic()
+        if self.tables is not None and now - self._checked_at <= self.check_interval:
+            return self.tables
+        if self.tables is not None:
+            self._checked_at = now
+            try:
+                if self.read_fingerprint() == self.fingerprint:
+                    return self.tables
+            except Exception as e:
+                log_debug(f"Could not check the schema catalog: {e}")
+                return self.tables
+        self.refresh()
+        return self.tables or {}
+
+    def table(self, table_name: str) -> Optional[CatalogTable]:
+        """Table by name, matched case-insensitively when there is no exact match"""
+        tables = self.snapshot()
+        name = table_name.strip().strip("\"'`")
+        if "." in name:
+            name = name.split(".", 1)[1].strip('"')
+        table = tables.get(name)
+        if table is None:
+            table = next((t for t in tables.values() if t.name.lower() == name.lower()), None)
+        return table
+
+    def table_names(self) -> List[str]:
+        return sorted(self.snapshot())
+
+
+def refresh_schema_catalogs() -> None:
+    """Read the snapshot of every schema catalog of the process again, e.g. after the tables were reloaded"""
+    for catalog in list(schema_catalogs):
+        try:
+            catalog.refresh()
+        except Exception as e:
+            logger.warning(f"Could not refresh the schema catalog: {e}")
+            catalog.invalidate()
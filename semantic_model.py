@@ -0,0 +1,431 @@
+"""Semantic model of the retail tables, and the prompt describing it to the agent.
+
+The semantic model lists the tables with their use and the relationships used to
+join them. It used to be sent in full, as indented JSON, with every model call.
+`SemanticModelPrompt` writes it in a compact text form instead, and only describes
+the tables relevant to the question, matched by the words of their names,
+descriptions and columns, together with the tables they join with. The other
+tables are only named, so the agent still knows every table it can query.
+
+This module has no dependencies, like `settings`, so the prompt can be built and
+measured without the agent (see `benchmark_prompt.py`).
+"""
+
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+
+# The semantic model helps the agent identify the tables and columns to use
+# This is sent in the system prompt, the agent then uses the `search_knowledge_base` tool to get table metadata, rules and sample queries
+# This is very much how data analysts and data scientists work:
+#  - We start with a set of tables and columns that we know are relevant to the task
+#  - We then use the `search_knowledge_base` tool to get more information about the tables and columns
+#  - We then use the `search_knowledge_base` tool to get sample queries for the tables and columns
+#  - We then use the `describe_table` tool to get more information about the tables and columns
+semantic_model = {
+    "tables": [
+        {
+            "table_name": "DIM_CUSTOMER",
+            "table_description": "Customer dimension table for loyalty analysis with customer details and segments.",
+            "Use Case": "Use this table for customer profiling, loyalty analysis, and demographic studies.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"customer_id": "customer_id"},
+                    "description": "One customer makes many sales"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_DATE",
+            "table_description": "Date dimension table with calendar attributes for time-based analysis.",
+            "Use Case": "Use this table for temporal analysis, seasonality studies, and periodic reporting.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "One date has many sales"
+                },
+                {
+                    "related_table": "FACT_INVENTORY",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "One date has many inventory records"
+                },
+                {
+                    "related_table": "FACT_PURCHASE_ORDERS",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "One date has many purchase orders"
+                },
+                {
+                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "One date has many employee performance records"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_EMPLOYEE",
+            "table_description": "Employee dimension table with personnel details and roles.",
+            "Use Case": "Use this table for workforce analysis, performance evaluation, and organizational studies.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"employee_id": "employee_id"},
+                    "description": "One employee processes many sales"
+                },
+                {
+                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"employee_id": "employee_id"},
+                    "description": "One employee has many performance records"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_PRODUCT",
+            "table_description": "Product dimension table with catalog information, pricing, and suppliers.",
+            "Use Case": "Use this table for product analysis, category performance, and pricing strategies.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "One product included in many sales"
+                },
+                {
+                    "related_table": "FACT_INVENTORY",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "One product has many inventory records"
+                },
+                {
+                    "related_table": "FACT_PURCHASE_ORDERS",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "One product ordered in many purchase orders"
+                },
+                {
+                    "related_table": "DIM_SUPPLIER",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"supplier_id": "supplier_id"},
+                    "description": "Many products provided by one supplier"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_PROMOTION",
+            "table_description": "Promotion dimension table with campaign details and discounts.",
+            "Use Case": "Use this table for promotional effectiveness, campaign analysis, and discount evaluation.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"promotion_id": "promotion_id"},
+                    "description": "One promotion applied to many sales"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_STORE",
+            "table_description": "Store dimension table with location details and attributes.",
+            "Use Case": "Use this table for location analysis, store performance, and geographical studies.",
+            "relationships": [
+                {
+                    "related_table": "FACT_SALES",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "One store generates many sales"
+                },
+                {
+                    "related_table": "FACT_INVENTORY",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "One store maintains many inventory records"
+                },
+                {
+                    "related_table": "FACT_EMPLOYEE_PERFORMANCE",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "One store has many employee performance records"
+                }
+            ]
+        },
+        {
+            "table_name": "DIM_SUPPLIER",
+            "table_description": "Supplier dimension table with vendor details and terms.",
+            "Use Case": "Use this table for supplier performance, vendor relations, and procurement analysis.",
+            "relationships": [
+                {
+                    "related_table": "DIM_PRODUCT",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"supplier_id": "supplier_id"},
+                    "description": "One supplier provides many products"
+                },
+                {
+                    "related_table": "FACT_PURCHASE_ORDERS",
+                    "relationship_type": "one-to-many",
+                    "join_columns": {"supplier_id": "supplier_id"},
+                    "description": "One supplier receives many purchase orders"
+                }
+            ]
+        },
+        {
+            "table_name": "FACT_EMPLOYEE_PERFORMANCE",
+            "table_description": "Employee performance fact table with metrics and KPIs.",
+            "Use Case": "Use this table for workforce productivity analysis, performance evaluation, and HR analytics.",
+            "relationships": [
+                {
+                    "related_table": "DIM_DATE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "Many performance records belong to one date"
+                },
+                {
+                    "related_table": "DIM_EMPLOYEE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"employee_id": "employee_id"},
+                    "description": "Many performance records belong to one employee"
+                },
+                {
+                    "related_table": "DIM_STORE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "Many performance records belong to one store"
+                }
+            ]
+        },
+        {
+            "table_name": "FACT_INVENTORY",
+            "table_description": "Inventory fact table for stock level analysis, with quantities and costs.",
+            "Use Case": "Use this table for stock level monitoring, inventory turnover analysis, and stockout prevention.",
+            "relationships": [
+                {
+                    "related_table": "DIM_DATE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "Many inventory records belong to one date"
+                },
+                {
+                    "related_table": "DIM_STORE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "Many inventory records maintained by one store"
+                },
+                {
+                    "related_table": "DIM_PRODUCT",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "Many inventory records for one product"
+                }
+            ]
+        },
+        {
+            "table_name": "FACT_PURCHASE_ORDERS",
+            "table_description": "Purchase orders fact table for procurement analysis.",
+            "Use Case": "Use this table for procurement analysis, supplier performance, and order fulfillment studies.",
+            "relationships": [
+                {
+                    "related_table": "DIM_DATE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "Many purchase orders belong to one date"
+                },
+                {
+                    "related_table": "DIM_SUPPLIER",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"supplier_id": "supplier_id"},
+                    "description": "Many purchase orders placed with one supplier"
+                },
+                {
+                    "related_table": "DIM_PRODUCT",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "Many purchase orders for one product"
+                }
+            ]
+        },
+        {
+            "table_name": "FACT_SALES",
+            "table_description": "Sales fact table for transaction analysis with pricing, quantities, and margins.",
+            "Use Case": "Use this table for sales performance analysis, profitability studies, and customer purchasing behavior.",
+            "relationships": [
+                {
+                    "related_table": "DIM_DATE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"date_id": "date_id"},
+                    "description": "Many sales belong to one date"
+                },
+                {
+                    "related_table": "DIM_STORE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"store_id": "store_id"},
+                    "description": "Many sales generated by one store"
+                },
+                {
+                    "related_table": "DIM_PRODUCT",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"product_id": "product_id"},
+                    "description": "Many sales include one product"
+                },
+                {
+                    "related_table": "DIM_CUSTOMER",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"customer_id": "customer_id"},
+                    "description": "Many sales made by one customer"
+                },
+                {
+                    "related_table": "DIM_PROMOTION",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"promotion_id": "promotion_id"},
+                    "description": "Many sales applied with one promotion"
+                },
+                {
+                    "related_table": "DIM_EMPLOYEE",
+                    "relationship_type": "many-to-one",
+                    "join_columns": {"employee_id": "employee_id"},
+                    "description": "Many sales processed by one employee"
+                }
+            ]
+        }
+    ]
+}
+
+
+# Words of the table texts that say nothing about what a table holds
+STOPWORDS = {
+    "a", "all", "and", "as", "at", "by", "for", "from", "has", "have", "in", "is", "many", "of", "on", "one",
+    "or", "the", "this", "to", "use", "with", "table", "dimension", "fact", "id", "analysis", "detail",
+    "study", "attribute", "record", "information",
+}
+
+
+def word_stem(word: str) -> str:
+    """Crude singular of a word, e.g. "stores" and "store" or "categories" and "category" match"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def words(text: str) -> Set[str]:
+    """Stems of the words of a text, with identifiers like `FACT_SALES` split into their parts"""
+    return {word_stem(word) for word in re.findall(r"[a-z0-9]+", text.lower())} - STOPWORDS
+
+
+@dataclass(frozen=True)
+class Relationship:
+    """Join between two tables, from the table on the one side to the table on the many side"""
+
+    one_table: str
+    one_column: str
+    many_table: str
+    many_column: str
+    type: str = "one-to-many"
+
+
+def model_relationships(semantic_model: Dict[str, Any]) -> List[Relationship]:
+    """Relationships of a semantic model, each one once although both of its tables list it"""
+    relationships: List[Relationship] = []
+    seen: Set[frozenset] = set()
+    for table in semantic_model["tables"]:
+        name = table["table_name"]
+        for relationship in table.get("relationships", []):
+            related = relationship["related_table"]
+            for column, related_column in relationship["join_columns"].items():
+                key = frozenset([(name, column), (related, related_column)])
+                if key in seen:
+                    continue
+                seen.add(key)
+                if relationship["relationship_type"] == "many-to-one":
+                    relationships.append(Relationship(related, related_column, name, column))
+                else:
+                    relationships.append(
+                        Relationship(name, column, related, related_column, relationship["relationship_type"])
+                    )
+    return relationships
+
+
+class SemanticModelPrompt:
+    """Compact, question-relevant text of a semantic model"""
+
+    def __init__(
+        self,
+        semantic_model: Dict[str, Any],
+        table_columns: Optional[Dict[str, List[str]]] = None,
+        max_table_share: float = 0.25,
+    ):
+        """
+        Args:
+            semantic_model: Tables and relationships, in the format of `semantic_model`
+            table_columns: Column names of each table, their words also match questions
+            max_table_share: Words of the descriptions and columns found in a larger share of the
+                tables are ignored, they do not tell the tables apart. Words of table names always match.
+        """
+        self.tables: Dict[str, Dict[str, Any]] = {table["table_name"]: table for table in semantic_model["tables"]}
+        self.relationships = model_relationships(semantic_model)
+        self.neighbours: Dict[str, Set[str]] = {name: set() for name in self.tables}
+        for relationship in self.relationships:
+            if relationship.one_table in self.tables and relationship.many_table in self.tables:
+                self.neighbours[relationship.one_table].add(relationship.many_table)
+                self.neighbours[relationship.many_table].add(relationship.one_table)
+
+        table_words = {}
+        for name, table in self.tables.items():
+            text = " ".join([table.get("table_description", ""), table.get("Use Case", "")])
+            text += " " + " ".join((table_columns or {}).get(name, []))
+            table_words[name] = words(text)
+        frequency = Counter(word for table_word_set in table_words.values() for word in table_word_set)
+        max_tables = max(1, int(max_table_share * len(self.tables)))
+        self.keywords: Dict[str, Set[str]] = {
+            name: words(name) | {word for word in table_words[name] if frequency[word] <= max_tables}
+            for name in self.tables
+        }
+
+    def relevant_tables(self, question: str) -> List[str]:
+        """Tables sharing a keyword with the question"""
+        question_words = words(question)
+        return [name for name in self.tables if self.keywords[name] & question_words]
+
+    def tables_for(self, question: Optional[str]) -> List[str]:
+        """Tables relevant to the question and the tables they join with, every table if none is relevant"""
+        relevant = set(self.relevant_tables(question or ""))
+        if not relevant:
+            return list(self.tables)
+        for name in list(relevant):
+            relevant |= self.neighbours[name]
+        return [name for name in self.tables if name in relevant]
+
+    def encode(self, table_names: List[str]) -> str:
+        """One line per table and per relationship between the tables, the others tables only named"""
+        included = set(table_names)
+        lines = ["Tables (name: description. use):"]
+        for name in table_names:
+            table = self.tables[name]
+            use_case = re.sub(r"^Use this table for ", "Use for ", table.get("Use Case", ""))
+            lines.append(f"{name}: {table.get('table_description', '')} {use_case}".rstrip())
+        lines.append("Relationships (one side = many side):")
+        for relationship in self.relationships:
+            if relationship.one_table in included and relationship.many_table in included:
+                line = (
+                    f"{relationship.one_table}.{relationship.one_column} = "
+                    f"{relationship.many_table}.{relationship.many_column}"
+                )
+                if relationship.type != "one-to-many":
+                    line += f" ({relationship.type})"
+                lines.append(line)
+        others = [name for name in self.tables if name not in included]
+        if others:
+            lines.append(f"Other tables, search the knowledge base before using them: {', '.join(others)}")
+        return "\n".join(lines)
+
+    def build(self, question: Optional[str] = None) -> str:
+        """Text of the semantic model for a question, of the whole model without a question"""
+        return self.encode(self.tables_for(question))
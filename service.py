@@ -0,0 +1,414 @@
+"""Headless question answering with the SQL agent, over HTTP or in batch.
+
+Questions are answered by agents from a pool (see `agent_pool.py`), on at most
+`workers` threads, each within a timeout. Every answer is a stream of events:
+the tool calls as they complete, the content as it is generated, then `done` with
+the whole answer or `error`. Throughput and latency percentiles are kept for the
+questions answered since the start.
+
+Serve over HTTP:
+
+    python service.py --workers 8 --timeout 180 serve --port 8000
+
+- `POST /ask` with `{"question": "...", "model_id": "openai:gpt-4o", "session_id": null, "stream": true}`
+  streams the events as newline-delimited JSON, or returns the `done` event when
+  `stream` is false. A 503 is returned when `workers` questions are running and
+  as many are waiting.
+- `GET /stats` returns the throughput and latencies.
+
+Answer a JSONL file of questions, one `{"id": ..., "question": ...}` per line:
+
+    python service.py --workers 8 --timeout 180 batch questions.jsonl --output answers.jsonl
+"""
+
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional
+
+from agent_pool import AgentPool
+from agents import get_question_cache, get_sql_agent, semantic_model_context
+from agno.models.message import Message
+from agno.utils.log import logger
+from dotenv import load_dotenv
+
+DEFAULT_MODEL_ID = "openai:gpt-4o"
+
+
+class ServiceBusy(Exception):
+    """Every worker is busy and the waiting line is full"""
+
+
+def tool_call_time(metrics: Any) -> Optional[float]:
+    if metrics is None:
+        return None
+    return metrics.get("time") if isinstance(metrics, dict) else getattr(metrics, "time", None)
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of the values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class LatencyStats:
+    """Outcomes and latencies of the questions answered since the start, the last `window` latencies kept"""
+
+    def __init__(self, window: int = 10_000):
+        self.started_at = time.monotonic()
+        self.latencies: "deque[float]" = deque(maxlen=window)
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, outcome: str) -> None:
+        with self._lock:
+            if outcome == "done":
+                self.completed += 1
+                self.latencies.append(latency)
+            elif outcome == "timeout":
+                self.timed_out += 1
+            else:
+                self.failed += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = list(self.latencies)
+            elapsed = time.monotonic() - self.started_at
+            return {
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "elapsed_s": round(elapsed, 3),
+                "throughput_per_min": round(self.completed / elapsed * 60, 2) if elapsed else 0.0,
+                "latency_p50_s": round(percentile(latencies, 0.5) or 0.0, 3),
+                "latency_p95_s": round(percentile(latencies, 0.95) or 0.0, 3),
+                "latency_max_s": round(max(latencies, default=0.0), 3),
+            }
+
+
+class QuestionService:
+    """Answers questions with pooled agents on a bounded number of worker threads"""
+
+    def __init__(
+        self,
+        workers: int = 8,
+        max_waiting: Optional[int] = None,
+        timeout: float = 180,
+        model_id: str = DEFAULT_MODEL_ID,
+        use_question_cache: bool = True,
+    ):
+        """
+        Args:
+            workers: Questions answered at the same time
+            max_waiting: Questions waiting for a worker before new ones are refused, `workers` by default
+            timeout: Seconds a question is given, including the wait for a worker
+            model_id: Model of the questions that do not name one
+            use_question_cache: Answer close paraphrases of questions answered before from their query
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.model_id = model_id
+        self.use_question_cache = use_question_cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="question")
+        self.slots = threading.BoundedSemaphore(workers + (workers if max_waiting is None else max_waiting))
+        # No debug logging, and one warm agent kept per worker
+        self.agent_pool = AgentPool(
+            factory=lambda model_id, debug_mode: get_sql_agent(model_id=model_id, debug_mode=debug_mode),
+            max_size=workers,
+        )
+        self.stats = LatencyStats()
+
+    def run(
+        self,
+        question: str,
+        model_id: str,
+        session_id: Optional[str],
+        events: "queue.Queue[Dict[str, Any]]",
+        cancel: threading.Event,
+    ) -> None:
+        """Answer a question on a worker, putting its events on the queue"""
+        agent = None
+        run_response = None
+        try:
+            if cancel.is_set():
+                return
+            agent = self.agent_pool.acquire(model_id=model_id, debug_mode=False, session_id=session_id)
+            agent.additional_context = semantic_model_context(question)
+            cached_answer = get_question_cache().answer(question, agent) if self.use_question_cache else None
+            response = ""
+            run_response = agent.run(
+                question,
+                messages=[Message(role="user", content=cached_answer)] if cached_answer else None,
+                stream=True,
+                stream_intermediate_steps=True,
+            )
+            for chunk in run_response:
+                if cancel.is_set():
+                    # The agent stops at the next chunk, its answer is not needed anymore
+                    return
+                if chunk.event == "ToolCallCompleted":
+                    for tool in chunk.tools or []:
+                        events.put(
+                            {
+                                "event": "tool_call",
+                                "tool_name": tool.get("tool_name"),
+                                "tool_args": tool.get("tool_args"),
+                                "time_s": tool_call_time(tool.get("metrics")),
+                                "error": bool(tool.get("tool_call_error")),
+                            }
+                        )
+                elif chunk.event == "RunResponse" and chunk.content is not None:
+                    response += chunk.content
+                    events.put({"event": "content", "content": chunk.content})
+            if self.use_question_cache and cached_answer is None:
+                get_question_cache().remember(question, agent.run_response.tools)
+            events.put(
+                {
+                    "event": "done",
+                    "answer": response,
+                    "session_id": agent.session_id,
+                    "cached": cached_answer is not None,
+                }
+            )
+        except Exception as e:
+            logger.exception(e)
+            events.put({"event": "error", "error": str(e)})
+        finally:
+            # The run is ended before the agent goes back to the pool
+            if run_response is not None:
+                run_response.close()
+            self.agent_pool.release(agent)
+            self.slots.release()
+
+    def answer(
+        self,
+        question: str,
+        model_id: Optional[str] = None,
+        session_id: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Events of the answer to a question, ending with `done` or `error`.
+
+        The question is admitted, or refused, before the first event is read.
+
+        Raises:
+            ServiceBusy: If every worker is busy and the waiting line is full
+        """
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        if not self.slots.acquire(blocking=False):
+            raise ServiceBusy(f"{self.workers} questions are being answered and the waiting line is full.")
+        events: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        cancel = threading.Event()
+        try:
+            self.executor.submit(self.run, question, model_id or self.model_id, session_id, events, cancel)
+        except BaseException:
+            # The slot is released by the worker, which will not run
+            self.slots.release()
+            raise
+        return self.events(events, cancel, start, deadline)
+
+    def events(
+        self,
+        events: "queue.Queue[Dict[str, Any]]",
+        cancel: threading.Event,
+        start: float,
+        deadline: float,
+    ) -> Iterator[Dict[str, Any]]:
+        """Events a worker puts on the queue, until `done`, `error` or the deadline"""
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    cancel.set()
+                    latency = time.monotonic() - start
+                    self.stats.record(latency, "timeout")
+                    yield {"event": "error", "error": "timeout", "latency_s": round(latency, 3)}
+                    return
+                if event["event"] in ("done", "error"):
+                    latency = time.monotonic() - start
+                    self.stats.record(latency, event["event"])
+                    event["latency_s"] = round(latency, 3)
+                    yield event
+                    return
+                yield event
+        finally:
+            # e.g. the client disconnected, the worker stops the run at its next chunk
+            cancel.set()
+
+    def ask(self, question: str, **kwargs: Any) -> Dict[str, Any]:
+        """The `done` or `error` event of the answer to a question"""
+        event: Dict[str, Any] = {}
+        for event in self.answer(question, **kwargs):
+            pass
+        return event
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def request_error(body: Dict[str, Any]) -> Optional[str]:
+    """Why the body of an `/ask` request is invalid, None if it is valid"""
+    if not isinstance(body.get("question"), str) or not body["question"].strip():
+        return '"question" must be a non-empty string.'
+    for key in ("model_id", "session_id"):
+        if body.get(key) is not None and not isinstance(body[key], str):
+            return f'"{key}" must be a string.'
+    timeout = body.get("timeout")
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+        return '"timeout" must be a positive number of seconds.'
+    return None
+
+
+class QuestionRequestHandler(BaseHTTPRequestHandler):
+    # Chunked responses, to stream the events
+    protocol_version = "HTTP/1.1"
+    service: QuestionService
+
+    def send_json(self, status: int, body: Dict[str, Any]) -> None:
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self.send_json(200, {"workers": self.service.workers, **self.service.stats.summary()})
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path != "/ask":
+            self.send_json(404, {"error": f"Not found: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            question = body["question"]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'Expected a JSON body with a "question".'})
+            return
+        error = request_error(body)
+        if error:
+            self.send_json(400, {"error": error})
+            return
+        try:
+            events = self.service.answer(
+                question,
+                model_id=body.get("model_id"),
+                session_id=body.get("session_id"),
+                timeout=body.get("timeout"),
+            )
+            if not body.get("stream", True):
+                event: Dict[str, Any] = {}
+                for event in events:
+                    pass
+                self.send_json(200 if event.get("event") == "done" else 500, event)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in events:
+                self.send_chunk(json.dumps(event, default=str).encode() + b"\n")
+            self.send_chunk(b"")
+        except ServiceBusy as e:
+            self.send_json(503, {"error": str(e)})
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(service: QuestionService, host: str, port: int) -> None:
+    handler = type("Handler", (QuestionRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info(f"Answering questions on http://{host}:{port} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def run_batch(service: QuestionService, input_path: str, output_path: Optional[str]) -> Dict[str, Any]:
+    """Answer every question of a JSONL file, writing one result per line as they complete"""
+    with open(input_path) as input_file:
+        requests = [json.loads(line) for line in input_file if line.strip()]
+    output = open(output_path, "w") if output_path else sys.stdout
+    output_lock = threading.Lock()
+
+    def answer(index: int, request: Dict[str, Any]) -> None:
+        try:
+            result = service.ask(request["question"], model_id=request.get("model_id"))
+        except Exception as e:
+            # e.g. ServiceBusy while timed out runs still hold their slots, the other answers are kept
+            logger.warning(f"Could not answer question {request.get('id', index)}: {e}")
+            result = {"event": "error", "error": str(e)}
+        with output_lock:
+            output.write(json.dumps({"id": request.get("id", index), "question": request["question"], **result}) + "\n")
+            output.flush()
+
+    try:
+        # As many questions in flight as workers, so none waits long enough to be refused
+        with ThreadPoolExecutor(max_workers=service.workers) as executor:
+            for future in [executor.submit(answer, index, request) for index, request in enumerate(requests)]:
+                future.result()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        service.shutdown()
+    summary = service.stats.summary()
+    logger.info(
+        f"Answered {summary['completed']}/{len(requests)} questions in {summary['elapsed_s']:.1f}s "
+        f"({summary['throughput_per_min']:.1f}/min), latency p50 {summary['latency_p50_s']:.2f}s, "
+        f"p95 {summary['latency_p95_s']:.2f}s, {summary['failed']} failed, {summary['timed_out']} timed out."
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Answer questions with the SQL agent without the UI.")
+    parser.add_argument("--workers", type=int, default=8, help="Questions answered at the same time.")
+    parser.add_argument("--timeout", type=float, default=180, help="Seconds a question is given.")
+    parser.add_argument("--model-id", default=DEFAULT_MODEL_ID, help="Model in format 'provider:model_name'.")
+    parser.add_argument("--no-question-cache", action="store_true", help="Always answer through the agent loop.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Answer questions over HTTP.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    batch_parser = commands.add_parser("batch", help="Answer the questions of a JSONL file.")
+    batch_parser.add_argument("input", help='JSONL file, one {"id": ..., "question": ...} per line.')
+    batch_parser.add_argument("--output", help="JSONL file of the answers, standard output by default.")
+    args = parser.parse_args()
+
+    question_service = QuestionService(
+        workers=args.workers,
+        timeout=args.timeout,
+        model_id=args.model_id,
+        use_question_cache=not args.no_question_cache,
+    )
+    if args.command == "serve":
+        serve(question_service, args.host, args.port)
+    else:
+        run_batch(question_service, args.input, args.output)
@@ -0,0 +1,342 @@
+"""Compaction of the stored agent sessions.
+
+The agent reads its tool call history, so the result of every query it runs is
+kept in the memory of its session, and the whole memory is written to and read
+from `ai.sql_agent_sessions` by every `upsert()` and `load_session()`.
+
+- Tool results larger than `max_inline_bytes` are stored once, compressed and
+  keyed by their SHA-256, in `ai.sql_agent_blobs`. The session only keeps a
+  reference to the blob and a short preview of the result.
+- Runs, and the messages of the chat history, older than `archive_after` are
+  moved to blobs too, listed by session in `ai.sql_agent_session_archive`.
+
+`CompactingAgentStorage` compacts every session it writes. The agent keeps its
+whole memory and writes it again after each run, so blobs and archive entries
+this process already stored are not written again. Offloaded results are read
+back with `SessionCompactor.expand` and archived runs with
+`SessionCompactor.archived`, e.g. for the chat history.
+
+Sessions written before are compacted by running this module, e.g. periodically:
+
+    python session_compaction.py --archive-after-days 30
+"""
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import timedelta
+from hashlib import sha256
+from typing import TYPE_CHECKING, Any, Dict, Hashable, List, Optional
+
+from agno.storage.agent.postgres import PostgresAgentStorage
+from agno.utils.log import log_debug, logger
+from sqlalchemy import Column, Engine, Integer, LargeBinary, MetaData, String, Table, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+if TYPE_CHECKING:
+    from agno.storage.session.agent import AgentSession
+
+# Start of the content of an offloaded tool result, followed by the digest of the blob holding it
+TOOL_RESULT_REF = "[tool result stored out of line: sha256:"
+
+
+class KnownKeys:
+    """Keys of the rows this process stored, the most recent `max_size` kept"""
+
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self.keys: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            if key not in self.keys:
+                return False
+            self.keys.move_to_end(key)
+            return True
+
+    def add(self, key: Hashable) -> None:
+        with self._lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+
+class BlobStore:
+    """zlib compressed texts keyed by their SHA-256, each text stored once"""
+
+    def __init__(self, db_engine: Engine, table_name: str = "sql_agent_blobs", schema: str = "ai"):
+        self.db_engine = db_engine
+        self.schema = schema
+        self.table = Table(
+            table_name,
+            MetaData(schema=schema),
+            Column("digest", String, primary_key=True),
+            Column("size", Integer, nullable=False),
+            Column("content", LargeBinary, nullable=False),
+        )
+        self.stored = KnownKeys()
+        self._created = False
+
+    def create(self) -> None:
+        if self._created:
+            return
+        with self.db_engine.begin() as conn:
+            conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {self.schema}"))
+            self.table.create(conn, checkfirst=True)
+        self._created = True
+
+    def put(self, content: str) -> str:
+        data = content.encode()
+        digest = sha256(data).hexdigest()
+        if digest in self.stored:
+            return digest
+        self.create()
+        with self.db_engine.begin() as conn:
+            conn.execute(
+                insert(self.table)
+                .values(digest=digest, size=len(data), content=zlib.compress(data))
+                .on_conflict_do_nothing(index_elements=[self.table.c.digest])
+            )
+        self.stored.add(digest)
+        return digest
+
+    def get(self, digest: str) -> Optional[str]:
+        self.create()
+        with self.db_engine.connect() as conn:
+            data = conn.execute(select(self.table.c.content).where(self.table.c.digest == digest)).scalar()
+        return zlib.decompress(data).decode() if data is not None else None
+
+
+def tool_result_digest(content: str) -> Optional[str]:
+    """Digest of the blob of an offloaded tool result, None if the result is stored inline"""
+    if not content.startswith(TOOL_RESULT_REF):
+        return None
+    return content[len(TOOL_RESULT_REF) :].split(" ", 1)[0]
+
+
+class SessionCompactor:
+    """Offloads the large tool results and archives the old runs of a session's memory"""
+
+    def __init__(
+        self,
+        db_engine: Engine,
+        max_inline_bytes: int = 4_000,
+        preview_chars: int = 500,
+        archive_after: Optional[timedelta] = None,
+        table_name: str = "sql_agent_session_archive",
+        schema: str = "ai",
+    ):
+        """
+        Args:
+            db_engine: Engine of the database storing the blobs and the archive
+            max_inline_bytes: Size over which a tool result is stored out of line
+            preview_chars: Characters of an offloaded tool result kept in the session
+            archive_after: Age of the runs and messages moved out of the session, None to keep them all
+            table_name: Table listing the archived runs and messages of each session
+            schema: Schema of the tables
+        """
+        self.db_engine = db_engine
+        self.max_inline_bytes = max_inline_bytes
+        self.preview_chars = preview_chars
+        self.archive_after = archive_after
+        self.blobs = BlobStore(db_engine, schema=schema)
+        self.archive = Table(
+            table_name,
+            MetaData(schema=schema),
+            Column("session_id", String, primary_key=True),
+            Column("digest", String, primary_key=True),
+            # "run" or "message"
+            Column("kind", String, nullable=False),
+            Column("created_at", Integer),
+        )
+        # (session_id, digest) of the runs and messages this process archived
+        self.archived_keys = KnownKeys()
+        self._created = False
+
+    def create(self) -> None:
+        if self._created:
+            return
+        self.blobs.create()
+        with self.db_engine.begin() as conn:
+            self.archive.create(conn, checkfirst=True)
+        self._created = True
+
+    def offload(self, content: str) -> str:
+        """Store a tool result out of line, returning the reference and preview kept in the session"""
+        size = len(content.encode())
+        if size <= self.max_inline_bytes or tool_result_digest(content) is not None:
+            return content
+        digest = self.blobs.put(content)
+        return f"{TOOL_RESULT_REF}{digest} ({size} bytes), preview:]\n{content[: self.preview_chars]}"
+
+    def offload_tool_results(self, value: Any) -> int:
+        """Offload the large results of the tool messages and tool executions found in `value`, in place.
+
+        Returns:
+            int: Number of results offloaded
+        """
+        offloaded = 0
+        if isinstance(value, dict):
+            content = value.get("content")
+            if isinstance(content, str) and (value.get("role") == "tool" or "tool_name" in value):
+                value["content"] = self.offload(content)
+                offloaded += value["content"] is not content
+            for item in value.values():
+                offloaded += self.offload_tool_results(item)
+        elif isinstance(value, list):
+            for item in value:
+                offloaded += self.offload_tool_results(item)
+        return offloaded
+
+    def archive_old(self, session_id: str, memory: Dict[str, Any]) -> int:
+        """Move the runs and messages older than `archive_after` out of the memory, in place.
+
+        Returns:
+            int: Number of runs and messages archived
+        """
+        if self.archive_after is None:
+            return 0
+        cutoff = time.time() - self.archive_after.total_seconds()
+        archived = []
+        for kind, key in (("run", "runs"), ("message", "messages")):
+            kept = []
+            for item in memory.get(key) or []:
+                created_at = (item.get("response") or {}).get("created_at") if kind == "run" else item.get("created_at")
+                if created_at is not None and created_at < cutoff:
+                    digest = self.blobs.put(json.dumps(item, default=str))
+                    if (session_id, digest) not in self.archived_keys:
+                        archived.append(
+                            {"session_id": session_id, "digest": digest, "kind": kind, "created_at": created_at}
+                        )
+                else:
+                    kept.append(item)
+            if key in memory:
+                memory[key] = kept
+        if archived:
+            with self.db_engine.begin() as conn:
+                conn.execute(insert(self.archive).values(archived).on_conflict_do_nothing())
+            for row in archived:
+                self.archived_keys.add((session_id, row["digest"]))
+        return len(archived)
+
+    def compact(self, session_id: str, memory: Optional[Dict[str, Any]]) -> bool:
+        """Compact the memory of a session in place, returns whether it changed"""
+        if not memory:
+            return False
+        self.create()
+        archived = self.archive_old(session_id, memory)
+        offloaded = self.offload_tool_results(memory)
+        if archived or offloaded:
+            log_debug(f"Session {session_id}: {offloaded} tool results offloaded, {archived} runs and messages archived")
+        return bool(archived or offloaded)
+
+    def archived(self, session_id: str, kind: str = "run") -> List[Dict[str, Any]]:
+        """Archived runs or messages of a session, oldest first"""
+        self.create()
+        with self.db_engine.connect() as conn:
+            digests = conn.execute(
+                select(self.archive.c.digest)
+                .where(self.archive.c.session_id == session_id, self.archive.c.kind == kind)
+                .order_by(self.archive.c.created_at)
+            ).scalars()
+            return [json.loads(self.blobs.get(digest) or "null") for digest in digests]
+
+    def expand(self, content: str) -> str:
+        """Full content of a tool result, reading it from its blob if it was offloaded"""
+        digest = tool_result_digest(content)
+        if digest is None:
+            return content
+        return self.blobs.get(digest) or content
+
+
+class CompactingAgentStorage(PostgresAgentStorage):
+    """Agent storage compacting the memory of every session before writing it"""
+
+    def __init__(self, *args: Any, compactor: SessionCompactor, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.compactor = compactor
+
+    def upsert(self, session: "AgentSession", create_and_retry: bool = True) -> Optional["AgentSession"]:
+        try:
+            self.compactor.compact(session.session_id, session.memory)
+        except Exception as e:
+            # The session is written as it is, the next write or compaction job will compact it
+            logger.warning(f"Could not compact session {session.session_id}: {e}")
+        return super().upsert(session, create_and_retry=create_and_retry)
+
+
+def compact_sessions(
+    db_engine: Engine,
+    compactor: SessionCompactor,
+    table_name: str = "sql_agent_sessions",
+    schema: str = "ai",
+    batch_size: int = 100,
+) -> int:
+    """Compact every stored session, a batch at a time.
+
+    Returns:
+        int: Number of sessions that changed
+    """
+    changed = 0
+    skipped = 0
+    last_session_id = ""
+    while True:
+        with db_engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    f"SELECT session_id, memory, updated_at FROM {schema}.{table_name} "
+                    f"WHERE session_id > :after ORDER BY session_id LIMIT :limit"
+                ),
+                {"after": last_session_id, "limit": batch_size},
+            ).all()
+        if not rows:
+            break
+        for session_id, memory, updated_at in rows:
+            if compactor.compact(session_id, memory):
+                # updated_at is left as is, compacting does not change the conversation. The memory is
+                # only written if the session was not written since it was read, e.g. by a run of the app,
+                # whose write compacts it anyway
+                with db_engine.begin() as conn:
+                    result = conn.execute(
+                        text(
+                            f"UPDATE {schema}.{table_name} SET memory = CAST(:memory AS jsonb) "
+                            f"WHERE session_id = :id AND updated_at IS NOT DISTINCT FROM :updated_at"
+                        ),
+                        {"memory": json.dumps(memory, default=str), "id": session_id, "updated_at": updated_at},
+                    )
+                if result.rowcount:
+                    changed += 1
+                else:
+                    log_debug(f"Session {session_id} was written while compacted, skipped")
+                    skipped += 1
+        last_session_id = rows[-1].session_id
+    logger.info(f"Sessions compacted: {changed} changed, {skipped} written meanwhile and skipped.")
+    return changed
+
+
+if __name__ == "__main__":
+    from agents import get_agent_storage, get_db_engine
+
+    parser = argparse.ArgumentParser(description="Compact the stored sessions of the SQL agent.")
+    parser.add_argument(
+        "--archive-after-days", type=float, help="Archive the runs older than this, by default the agent's setting."
+    )
+    parser.add_argument("--batch-size", type=int, default=100, help="Sessions read at a time.")
+    args = parser.parse_args()
+
+    agent_storage = get_agent_storage()
+    compactor = agent_storage.compactor
+    if args.archive_after_days is not None:
+        compactor.archive_after = timedelta(days=args.archive_after_days)
+    compact_sessions(
+        get_db_engine(),
+        compactor,
+        table_name=agent_storage.table_name,
+        schema=agent_storage.schema,
+        batch_size=args.batch_size,
+    )
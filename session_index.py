@@ -0,0 +1,145 @@
+"""Index of the stored agent sessions.
+
+`PostgresAgentStorage.get_all_sessions()` reads every row of the sessions table,
+with the memory and the session data of each session, and the sidebar only needs
+their ids and names. `SessionIndex` reads these few columns a page at a time,
+filtered by user and by a search on the id or the name, and keeps each page for
+a few seconds so reruns of the app do not query the database again.
+"""
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from agno.utils.log import log_debug, logger
+from sqlalchemy import Engine, text
+
+
+@dataclass
+class SessionSummary:
+    session_id: str
+    session_name: Optional[str]
+    user_id: Optional[str]
+    # Seconds since the epoch, as stored by the agent storage
+    updated_at: Optional[int]
+
+    @property
+    def display_name(self) -> str:
+        return self.session_name or self.session_id
+
+
+@dataclass
+class SessionPage:
+    sessions: List[SessionSummary]
+    # Sessions matching the search, across all pages
+    total: int
+    offset: int
+    limit: int
+
+    @property
+    def has_more(self) -> bool:
+        return self.offset + len(self.sessions) < self.total
+
+
+def like_pattern(search: str) -> str:
+    escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class SessionIndex:
+    """Pages of session ids and names, newest first, cached for `ttl` seconds"""
+
+    def __init__(self, db_engine: Engine, table_name: str = "sql_agent_sessions", schema: str = "ai", ttl: float = 10):
+        """
+        Args:
+            db_engine: Engine of the database storing the sessions
+            table_name: Table of the agent storage
+            schema: Schema of the table
+            ttl: Seconds a page is kept
+        """
+        self.db_engine = db_engine
+        self.table_name = table_name
+        self.schema = schema
+        self.ttl = ttl
+        self.pages: Dict[Tuple[Optional[str], str, int, int], Tuple[float, SessionPage]] = {}
+        self._indexed = False
+        self._lock = threading.Lock()
+
+    def create_index(self) -> None:
+        """Index the creation time, so a page is read without sorting the whole table"""
+        if self._indexed:
+            return
+        with self.db_engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS idx_{self.table_name}_created_at "
+                    f"ON {self.schema}.{self.table_name} (created_at DESC)"
+                )
+            )
+        self._indexed = True
+
+    def list_sessions(
+        self,
+        user_id: Optional[str] = None,
+        search: Optional[str] = None,
+        limit: int = 50,
+        offset: int = 0,
+    ) -> SessionPage:
+        """Get a page of sessions, optionally of one user and whose id or name contains `search`"""
+        search = (search or "").strip()
+        key = (user_id, search.lower(), limit, offset)
+        with self._lock:
+            cached = self.pages.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+        conditions = []
+        params = {"limit": limit, "offset": offset}
+        if user_id is not None:
+            conditions.append("user_id = :user_id")
+            params["user_id"] = user_id
+        if search:
+            conditions.append("(session_id ILIKE :search OR session_data ->> 'session_name' ILIKE :search)")
+            params["search"] = like_pattern(search)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = text(
+            f"SELECT session_id, session_data ->> 'session_name' AS session_name, user_id, updated_at, "
+            f"count(*) OVER () AS total "
+            f"FROM {self.schema}.{self.table_name} {where} "
+            f"ORDER BY created_at DESC, session_id LIMIT :limit OFFSET :offset"
+        )
+        try:
+            self.create_index()
+            with self.db_engine.connect() as conn:
+                rows = conn.execute(query, params).all()
+        except Exception as e:
+            logger.warning(f"Could not list sessions: {e}")
+            return SessionPage(sessions=[], total=0, offset=offset, limit=limit)
+
+        page = SessionPage(
+            sessions=[
+                SessionSummary(
+                    session_id=row.session_id,
+                    session_name=row.session_name,
+                    user_id=row.user_id,
+                    updated_at=row.updated_at,
+                )
+                for row in rows
+            ],
+            total=rows[0].total if rows else 0,
+            offset=offset,
+            limit=limit,
+        )
+        log_debug(f"Listed {len(page.sessions)} of {page.total} sessions")
+        now = time.monotonic()
+        with self._lock:
+            # Every search is a key, drop the expired pages so they do not pile up
+            self.pages = {k: v for k, v in self.pages.items() if v[0] > now}
+            self.pages[key] = (now + self.ttl, page)
+        return page
+
+    def invalidate(self) -> None:
+        """Drop the cached pages, e.g. after a session was created or renamed"""
+        with self._lock:
+            self.pages.clear()
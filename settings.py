@@ -0,0 +1,18 @@
+"""Settings shared by the agent, the loaders and the app.
+
+This module has no dependencies, so the loaders can read the database URL and
+the paths without importing the agent and its model providers.
+"""
+
+from pathlib import Path
+
+# ************* Database Connection *************
+db_url = "postgresql+psycopg://ai:ai@localhost:5532/ai"
+# *******************************
+
+# ************* Paths *************
+cwd = Path(__file__).parent
+knowledge_dir = cwd.joinpath("knowledge")
+# Created by the agent when it is first built
+output_dir = cwd.joinpath("output")
+# *******************************
@@ -0,0 +1,526 @@
+"""SQL tools used by the SQL agent.
+
+`RetailSQLTools` extends agno's `SQLTools` with a result cache for read queries,
+and runs aggregate queries against the rollups of the fact tables when they can.
+Results are keyed on the normalized SQL text and the row limit, expire after a
+TTL, and are evicted least recently used first. Each entry remembers the version
+of the tables it read: the loader bumps the version of every table it reloads,
+in this process through `invalidate_cached_tables` and in other
+processes through the `loaded_at` column of the load state table, again once
+the rollups of the table are refreshed.
+
+Read queries are streamed from a server-side cursor, so a result larger than
+`max_rows` rows or `max_bytes` of JSON is never held in memory: the agent gets
+a preview, and the rest of the result is not fetched, so its total number of
+rows is unknown and the agent is told so. When the agent asks for it, the whole result is streamed to a CSV file
+in `spill_dir` instead.
+
+Before a query runs, its plan is checked with `EXPLAIN`: plans estimated over
+`max_cost` or `max_estimated_rows` are rejected, and every statement runs under
+a `statement_timeout`. Statements that EXPLAIN does not support, e.g. DDL, only
+get the timeout. Rejections are returned to the agent as a JSON error
+with the estimates and the most expensive plan nodes, so it can fix the query.
+Queries first go through the local `SQLPreflight`, which fixes the quoting of
+table names and adds a LIMIT, or rejects them without a database round-trip.
+Tables are described from a `SchemaCatalog` snapshot held in memory.
+"""
+
+import csv
+import json
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from hashlib import md5
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from agno.tools.sql import SQLTools
+from agno.utils.log import log_debug, logger
+from preflight import PreflightError, SQLPreflight
+from rollups import RollupRewriter
+from schema import LOAD_STATE_TABLE
+from schema_catalog import SchemaCatalog
+from sqlalchemy import Connection, Engine, text
+from sqlalchemy.exc import OperationalError
+
+# Tables read by a query: the identifiers following FROM and JOIN
+TABLE_REFERENCE_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+(?:\w+\.)?"?(\w+)"?', re.IGNORECASE)
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and drop trailing semicolons, so trivially different queries share a cache entry"""
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+
+def is_read_query(sql: str) -> bool:
+    return normalize_sql(sql).split(" ", 1)[0].upper() in {"SELECT", "WITH"}
+
+
+def is_explainable(sql: str) -> bool:
+    """Whether `EXPLAIN` supports the statement, without running it"""
+    return normalize_sql(sql).split(" ", 1)[0].upper() in {
+        "SELECT",
+        "WITH",
+        "VALUES",
+        "TABLE",
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+        "MERGE",
+    }
+
+
+def referenced_tables(sql: str) -> Set[str]:
+    return {name.upper() for name in TABLE_REFERENCE_PATTERN.findall(sql)}
+
+
+class QueryRejected(Exception):
+    """A query not run because of its estimated cost or its running time, with details for the agent"""
+
+    def __init__(self, details: Dict[str, Any]):
+        super().__init__(details["reason"])
+        self.details = details
+
+
+def plan_nodes(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Flatten an `EXPLAIN (FORMAT JSON)` plan into its nodes"""
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+@dataclass
+class QueryResult:
+    rows: List[Dict[str, Any]]
+    # Number of rows of the result that were read, which can be more than the rows returned
+    row_count: int
+    # The result has more rows than `row_count`, which were not read
+    more_rows: bool = False
+    # CSV file with the whole result, when it did not fit in the preview
+    file: Optional[str] = None
+    # LIMIT added to the query by the pre-flight, when the result reached it
+    limit_reached: Optional[int] = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.more_rows or self.row_count > len(self.rows)
+
+    def to_json(self) -> str:
+        if not self.truncated and self.limit_reached is None:
+            return json.dumps(self.rows, default=str)
+        notes = []
+        row_count: Any = f"more than {self.row_count}" if self.more_rows else self.row_count
+        if self.truncated:
+            notes.append(f"Only the first {len(self.rows)} of {row_count} rows are shown.")
+        if self.more_rows:
+            notes.append("The total number of rows is unknown, run a COUNT(*) query if you need it.")
+        if self.limit_reached is not None:
+            notes.append(f"The query had no LIMIT and was limited to {self.limit_reached} rows, there may be more.")
+        result: Dict[str, Any] = {"rows": self.rows, "row_count": row_count, "note": " ".join(notes)}
+        if self.file is not None:
+            result["file"] = self.file
+        return json.dumps(result, default=str)
+
+
+@dataclass
+class CachedResult:
+    result: QueryResult
+    table_versions: Dict[str, float]
+    expires_at: float
+
+
+# Every result cache of the process, invalidated together by `invalidate_cached_tables`
+result_caches: "weakref.WeakSet[QueryResultCache]" = weakref.WeakSet()
+
+
+class QueryResultCache:
+    """LRU cache of query results with a TTL, invalidated when a table the query read is reloaded"""
+
+    def __init__(
+        self,
+        db_engine: Optional[Engine] = None,
+        max_entries: int = 256,
+        ttl: float = 600,
+        version_check_interval: float = 5,
+    ):
+        """
+        Args:
+            db_engine: Engine to read the table load times from, to see reloads made by other processes
+            max_entries: Number of results kept
+            ttl: Seconds a result is kept
+            version_check_interval: Seconds between two reads of the table load times
+        """
+        self.db_engine = db_engine
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.entries: "OrderedDict[Tuple[str, Optional[int]], CachedResult]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._local_versions: Dict[str, float] = {}
+        self._loaded_versions: Dict[str, float] = {}
+        self._versions_checked_at = 0.0
+        self._lock = threading.Lock()
+        result_caches.add(self)
+
+    def table_versions(self, tables: Set[str]) -> Dict[str, float]:
+        """Current version of each table: the latest of its load time and its last local invalidation"""
+        now = time.monotonic()
+        if self.db_engine is not None and now - self._versions_checked_at > self.version_check_interval:
+            self._versions_checked_at = now
+            try:
+                with self.db_engine.connect() as conn:
+                    rows = conn.execute(
+                        text(f"SELECT table_name, extract(epoch FROM loaded_at) FROM {LOAD_STATE_TABLE}")
+                    )
+                    self._loaded_versions = {name.upper(): float(loaded_at) for name, loaded_at in rows}
+            except Exception as e:
+                log_debug(f"Could not read table versions: {e}")
+        return {
+            table: max(self._loaded_versions.get(table, 0.0), self._local_versions.get(table, 0.0))
+            for table in tables
+        }
+
+    def get(self, sql: str, limit: Optional[int]) -> Optional[QueryResult]:
+        key = (normalize_sql(sql), limit)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                fresh = entry.expires_at > time.monotonic()
+                if fresh and self.table_versions(set(entry.table_versions)) == entry.table_versions:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    log_debug(f"Query cache hit ({self.stats()})")
+                    return entry.result
+                del self.entries[key]
+            self.misses += 1
+            log_debug(f"Query cache miss ({self.stats()})")
+            return None
+
+    def versions_of(self, sql: str) -> Dict[str, float]:
+        """Versions of the tables a query reads, taken before running it"""
+        with self._lock:
+            return self.table_versions(referenced_tables(sql))
+
+    def set(self, sql: str, limit: Optional[int], result: QueryResult, table_versions: Dict[str, float]) -> None:
+        """Cache the result of a query run against the given table versions.
+
+        The versions must be taken with `versions_of` before running the query, so
+        a result computed while a table was being reloaded is never served as current.
+        """
+        key = (normalize_sql(sql), limit)
+        with self._lock:
+            if self.table_versions(set(table_versions)) != table_versions:
+                return
+            self.entries[key] = CachedResult(
+                result=result,
+                table_versions=table_versions,
+                expires_at=time.monotonic() + self.ttl,
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate_tables(self, tables: List[str]) -> None:
+        """Bump the version of tables that were reloaded, dropping the results that read them"""
+        with self._lock:
+            version = time.time()
+            for table in tables:
+                self._local_versions[table.upper()] = version
+            stale = [
+                key
+                for key, entry in self.entries.items()
+                if any(table.upper() in entry.table_versions for table in tables)
+            ]
+            for key in stale:
+                del self.entries[key]
+        if stale:
+            logger.info(f"Invalidated {len(stale)} cached query results for tables {', '.join(tables)}.")
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
+def invalidate_cached_tables(tables: List[str]) -> None:
+    """Drop the results that read reloaded tables from every result cache of the process"""
+    for cache in list(result_caches):
+        cache.invalidate_tables(tables)
+
+
+class RetailSQLTools(SQLTools):
+    """SQLTools streaming bounded results, serving repeated read queries from a
+    shared `QueryResultCache`, and aggregates from rollups"""
+
+    def __init__(
+        self,
+        result_cache: Optional[QueryResultCache] = None,
+        rollup_rewriter: Optional[RollupRewriter] = None,
+        max_rows: int = 200,
+        max_bytes: int = 20_000,
+        fetch_size: int = 1_000,
+        spill_dir: Optional[Path] = None,
+        max_cost: Optional[float] = 5_000_000,
+        max_estimated_rows: Optional[float] = 10_000_000,
+        statement_timeout: Optional[float] = 30,
+        preflight: Optional[SQLPreflight] = None,
+        schema_catalog: Optional[SchemaCatalog] = None,
+        **kwargs,
+    ):
+        """
+        Args:
+            result_cache: Cache of the results of read queries
+            rollup_rewriter: Rewriter of aggregate queries to the rollups
+            max_rows: Maximum number of rows returned by a query
+            max_bytes: Maximum size of the JSON of the rows returned by a query
+            fetch_size: Number of rows fetched at a time from the server-side cursor
+            spill_dir: Directory to write the whole result of truncated queries to, as CSV
+            max_cost: Maximum planner cost estimate of a query, None to not check it
+            max_estimated_rows: Maximum planner estimate of the rows of a query, None to not check it
+            statement_timeout: Seconds a query can run before Postgres cancels it, None for no timeout
+            preflight: Local check and fix of the queries before they are sent to the database
+            schema_catalog: Snapshot of the catalog to describe tables from, without querying the database
+        """
+        super().__init__(**kwargs)
+        self.result_cache = result_cache
+        self.rollup_rewriter = rollup_rewriter
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.fetch_size = fetch_size
+        self.spill_dir = spill_dir
+        self.max_cost = max_cost
+        self.max_estimated_rows = max_estimated_rows
+        self.statement_timeout = statement_timeout
+        self.preflight = preflight
+        self.schema_catalog = schema_catalog
+
+    def check_plan(self, conn: Connection, sql: str) -> None:
+        """Raise `QueryRejected` if the estimated cost or rows of the query plan are over the limits"""
+        if self.max_cost is None and self.max_estimated_rows is None:
+            return
+        explain = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+        if isinstance(explain, str):
+            explain = json.loads(explain)
+        plan = explain[0]["Plan"]
+        cost, rows = plan["Total Cost"], plan["Plan Rows"]
+        if self.max_cost is not None and cost > self.max_cost:
+            reason = f"Estimated cost {cost:,.0f} is over the limit of {self.max_cost:,.0f}."
+        elif self.max_estimated_rows is not None and rows > self.max_estimated_rows:
+            reason = f"Estimated {rows:,.0f} rows, over the limit of {self.max_estimated_rows:,.0f}."
+        else:
+            return
+        costliest = sorted(plan_nodes(plan), key=lambda node: node["Total Cost"], reverse=True)[:5]
+        raise QueryRejected(
+            {
+                "error": "query_rejected",
+                "reason": reason,
+                "estimated_cost": cost,
+                "estimated_rows": rows,
+                "costliest_plan_nodes": [
+                    {
+                        "node": node["Node Type"],
+                        "relation": node.get("Relation Name"),
+                        "join_filter": node.get("Join Filter") or node.get("Hash Cond") or node.get("Merge Cond"),
+                        "estimated_rows": node["Plan Rows"],
+                        "estimated_cost": node["Total Cost"],
+                    }
+                    for node in costliest
+                ],
+                "hint": "Rewrite the query before running it again: check that every join has a join condition, "
+                "filter and aggregate in SQL, and add a LIMIT.",
+            }
+        )
+
+    def prepare(self, conn: Connection, sql: str) -> None:
+        """Set the statement timeout of the transaction, and check the plan of the statement if EXPLAIN supports it"""
+        if self.db_engine.dialect.name != "postgresql":
+            return
+        if self.statement_timeout is not None:
+            conn.execute(
+                text("SELECT set_config('statement_timeout', :timeout, true)"),
+                {"timeout": str(int(self.statement_timeout * 1000))},
+            )
+        if is_explainable(sql):
+            self.check_plan(conn, sql)
+
+    def stream_sql(self, sql: str, limit: Optional[int] = None, spill: bool = False) -> QueryResult:
+        """Run a read query on a server-side cursor, keeping at most `limit` rows within the row and size caps.
+
+        Once the caps are reached, only the rows already fetched are counted. With
+        `spill`, the rest of the result is streamed to a CSV file in `spill_dir`
+        if the caps cut rows the query asked for.
+        """
+        log_debug(f"Streaming sql |\n{sql}")
+        wanted = min(limit, self.max_rows) if limit else self.max_rows
+        rows: List[Dict[str, Any]] = []
+        size = 0
+        row_count = 0
+        preview_full = False
+        more_rows = False
+        spill_path: Optional[Path] = None
+        writer = None
+        with ExitStack() as stack:
+            conn = stack.enter_context(self.db_engine.connect())
+            self.prepare(conn, sql)
+            result = conn.execution_options(stream_results=True, max_row_buffer=self.fetch_size).execute(text(sql))
+            for partition in result.partitions(self.fetch_size):
+                for row in partition:
+                    row_count += 1
+                    if preview_full and writer is None:
+                        continue
+                    record = row._asdict()
+                    if not preview_full:
+                        row_size = len(json.dumps(record, default=str))
+                        if len(rows) < wanted and size + row_size <= self.max_bytes:
+                            rows.append(record)
+                            size += row_size
+                            continue
+                        preview_full = True
+                        # Only spill when the caps, not the limit of the query, cut the result
+                        if spill and self.spill_dir is not None and (not limit or len(rows) < limit):
+                            self.spill_dir.mkdir(parents=True, exist_ok=True)
+                            name = md5(f"{normalize_sql(sql)}:{limit}".encode()).hexdigest()[:16]
+                            spill_path = self.spill_dir.joinpath(f"query_{name}.csv")
+                            spill_file = stack.enter_context(open(f"{spill_path}.tmp", "w", newline=""))
+                            writer = csv.DictWriter(spill_file, fieldnames=list(record))
+                            writer.writeheader()
+                            writer.writerows(rows)
+                    if writer is not None and (not limit or row_count <= limit):
+                        writer.writerow(record)
+                # Stop reading once nothing more of the result is kept, only check whether there is more
+                if preview_full and (writer is None or (limit and row_count >= limit)):
+                    more_rows = result.fetchone() is not None
+                    break
+        if spill_path is not None:
+            os.replace(f"{spill_path}.tmp", spill_path)
+            written = min(row_count, limit) if limit else row_count
+            logger.info(f"Query result of {written:,} rows written to {spill_path}")
+        return QueryResult(
+            rows=rows, row_count=row_count, more_rows=more_rows, file=str(spill_path) if spill_path else None
+        )
+
+    def run_statement(self, sql: str, limit: Optional[int] = None) -> QueryResult:
+        """Run a statement other than a read query in a transaction, with the checks of the read queries"""
+        log_debug(f"Running sql |\n{sql}")
+        with self.db_engine.begin() as conn:
+            self.prepare(conn, sql)
+            result = conn.execute(text(sql))
+            rows = []
+            if result.returns_rows:
+                rows = [row._asdict() for row in (result.fetchmany(limit) if limit else result.fetchall())]
+        return QueryResult(rows=rows, row_count=len(rows))
+
+    def execute_sql(self, sql: str, limit: Optional[int] = None, spill: bool = False) -> QueryResult:
+        if not is_read_query(sql):
+            return self.run_statement(sql=sql, limit=limit)
+        if self.rollup_rewriter is not None:
+            rewritten = self.rollup_rewriter.rewrite(sql)
+            if rewritten != sql:
+                try:
+                    return self.stream_sql(sql=rewritten, limit=limit, spill=spill)
+                except (QueryRejected, OperationalError):
+                    raise
+                except Exception as e:
+                    # e.g. the rollup is being rebuilt by a load
+                    log_debug(f"Rollup query failed, running the original query: {e}")
+        return self.stream_sql(sql=sql, limit=limit, spill=spill)
+
+    def query(self, sql: str, limit: Optional[int] = None, spill: bool = False) -> QueryResult:
+        limit_added = None
+        if self.preflight is not None:
+            checked = self.preflight.check(sql)
+            if checked.fixes:
+                log_debug(f"Pre-flight fixes: {', '.join(checked.fixes)}")
+            sql, limit_added = checked.sql, checked.limit_added
+
+        # Cached results have no file, spilled results are not cached
+        if self.result_cache is None or not is_read_query(sql) or spill:
+            result = self.execute_sql(sql=sql, limit=limit, spill=spill)
+        else:
+            result = self.result_cache.get(sql, limit)
+            if result is None:
+                table_versions = self.result_cache.versions_of(sql)
+                result = self.execute_sql(sql=sql, limit=limit)
+                self.result_cache.set(sql, limit, result, table_versions)
+
+        if limit_added is not None and (result.more_rows or result.row_count >= limit_added):
+            result = replace(result, limit_reached=limit_added)
+        return result
+
+    def describe_table(self, table_name: str) -> str:
+        """Use this function to describe a table: its columns, their types, and its approximate row count.
+
+        Args:
+            table_name (str): The name of the table to get the schema for.
+        Returns:
+            str: JSON with the `description`, the `approximate_row_count` and the `columns` of the table.
+        """
+        if self.schema_catalog is None:
+            return super().describe_table(table_name)
+        try:
+            table = self.schema_catalog.table(table_name)
+        except Exception as e:
+            logger.warning(f"Schema catalog unavailable, inspecting the database: {e}")
+            return super().describe_table(table_name)
+        if table is None:
+            tables = ", ".join(self.schema_catalog.table_names())
+            return f"Error getting table schema: table {table_name} not found. Tables: {tables}"
+        log_debug(f"Describing table from the schema catalog: {table.name}")
+        return json.dumps(table.to_dict())
+
+    def run_sql(self, sql: str, limit: Optional[int] = None) -> List[dict]:
+        return self.query(sql=sql, limit=limit).rows
+
+    def run_sql_query(self, query: str, limit: Optional[int] = 10, save_to_file: bool = False) -> str:
+        """Use this function to run a SQL query and return the result.
+
+        Args:
+            query (str): The query to run.
+            limit (int, optional): The number of rows to return. Defaults to 10. Use `None` to show all results.
+            save_to_file (bool, optional): Write the whole result to a CSV file when it is truncated.
+                Only use it when the user asks for the full data. Defaults to False.
+        Returns:
+            str: Result of the SQL query.
+        Notes:
+            - The result may be empty if the query does not return any data.
+            - Large results are truncated: you then get an object with the first `rows`, the
+              `row_count`, and the `file` with the whole result if you asked for it. A `row_count`
+              like "more than 1000" means the rest was not read and the total is unknown: it is not
+              the number of rows. Aggregate in SQL instead of reading many rows.
+        """
+        try:
+            return self.query(sql=query, limit=limit, spill=save_to_file).to_json()
+        except (PreflightError, QueryRejected) as e:
+            logger.warning(f"Query rejected: {e}")
+            return f"Error running query: {json.dumps(e.details, default=str)}"
+        except OperationalError as e:
+            if getattr(e.orig, "sqlstate", None) != "57014":
+                logger.error(f"Error running query: {e}")
+                return f"Error running query: {e}"
+            # query_canceled: the statement timeout was reached
+            details = {
+                "error": "statement_timeout",
+                "reason": f"The query was canceled after running for {self.statement_timeout}s.",
+                "hint": "Rewrite the query before running it again: filter and aggregate earlier, "
+                "avoid joining fact tables with each other, and add a LIMIT.",
+            }
+            logger.warning(f"Query timed out: {query}")
+            return f"Error running query: {json.dumps(details)}"
+        except Exception as e:
+            logger.error(f"Error running query: {e}")
+            return f"Error running query: {e}"
@@ -3,10 +3,18 @@ from dataclasses import asdict
 from typing import Any, Dict, List, Optional
 
 import streamlit as st
-from agents import get_sql_agent
+from agents import get_agent_storage, get_session_index
+from db import pool_metrics
 from agno.agent.agent import Agent
 from agno.utils.log import logger
 
+# Turns at the end of the chat rendered in full, older ones are collapsed
+RECENT_TURNS = 3
+# Collapsed turns listed above the recent ones, more are listed on demand
+HISTORY_TURNS_SHOWN = 20
+# Sessions listed at a time in the session selector
+SESSIONS_PER_PAGE = 50
+
 
 def is_json(myjson):
     """Check if a string is valid JSON"""
@@ -44,10 +52,57 @@ def add_message(
     )
 
 
+def run_id(agent_run: Any) -> Optional[str]:
+    return agent_run.response.run_id if agent_run.response is not None else None
+
+
+def load_run_history(agent: Agent) -> None:
+    """Append the runs of the agent's session that are not in the chat history yet.
+
+    The history is rebuilt only when the agent moves to another session, starting
+    with the runs archived out of the stored session. Otherwise each rerun only
+    reads the runs after the last one loaded.
+    """
+    if st.session_state.get("messages_session_id") != agent.session_id:
+        logger.debug("Loading run history")
+        st.session_state["messages"] = []
+        st.session_state["messages_session_id"] = agent.session_id
+        st.session_state["messages_last_run_id"] = None
+        st.session_state["history_turns_shown"] = HISTORY_TURNS_SHOWN
+        if agent.session_id is not None:
+            try:
+                for _run in get_agent_storage().compactor.archived(agent.session_id):
+                    if _run.get("message"):
+                        add_message(_run["message"]["role"], _run["message"].get("content"))
+                    if _run.get("response"):
+                        add_message("assistant", _run["response"].get("content"), _run["response"].get("tools"))
+            except Exception as e:
+                logger.warning(f"Could not load the archived runs: {e}")
+
+    agent_runs = agent.memory.runs
+    run_ids = [run_id(_run) for _run in agent_runs]
+    last_run_id = st.session_state.get("messages_last_run_id")
+    # Runs are archived oldest first: when the last run loaded was archived, every run left is newer
+    start = run_ids.index(last_run_id) + 1 if last_run_id is not None and last_run_id in run_ids else 0
+    if last_run_id is not None and start == 0:
+        logger.debug("Last run loaded was archived, loading the runs left")
+    for _run in agent_runs[start:]:
+        if _run.message is not None:
+            add_message(_run.message.role, _run.message.content)
+        if _run.response is not None:
+            add_message("assistant", _run.response.content, _run.response.tools)
+    mark_runs_loaded(agent)
+
+
+def mark_runs_loaded(agent: Agent) -> None:
+    """Record that the chat history holds every run of the agent, e.g. after adding the messages of a new run"""
+    if agent.memory.runs:
+        st.session_state["messages_last_run_id"] = run_id(agent.memory.runs[-1])
+
+
 def restart_agent():
-    """Reset the agent and clear chat history"""
+    """Start a new session and clear chat history"""
     logger.debug("---*--- Restarting agent ---*---")
-    st.session_state["sql_agent"] = None
     st.session_state["sql_agent_session_id"] = None
     st.session_state["messages"] = []
     st.rerun()
@@ -77,13 +132,17 @@ def display_tool_calls(tool_calls_container, tools):
                 tool_name = tool_call.get("tool_name", "Unknown Tool")
                 tool_args = tool_call.get("tool_args", {})
                 content = tool_call.get("content", None)
+                if isinstance(content, str):
+                    # Results of the stored sessions may be offloaded, read them back for display
+                    content = get_agent_storage().compactor.expand(content)
                 metrics = tool_call.get("metrics", None)
 
                 # Add timing information
                 execution_time_str = "N/A"
                 try:
-                    if metrics is not None and hasattr(metrics, "time"):
-                        execution_time = metrics.time
+                    if metrics is not None:
+                        # Message metrics, or their dict in the tool calls of a run response
+                        execution_time = metrics.get("time") if isinstance(metrics, dict) else getattr(metrics, "time", None)
                         if execution_time is not None:
                             execution_time_str = f"{execution_time:.4f}s"
                 except Exception as e:
@@ -115,6 +174,59 @@ def display_tool_calls(tool_calls_container, tools):
         tool_calls_container.error("Failed to display tool results")
 
 
+def group_turns(messages: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Split the chat history into turns, each one a user message and the answers to it"""
+    turns: List[List[Dict[str, Any]]] = []
+    for message in messages:
+        if message["role"] not in ["user", "assistant"] or message["content"] is None:
+            continue
+        if message["role"] == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def display_message(message: Dict[str, Any], debug_mode: bool) -> None:
+    with st.chat_message(message["role"]):
+        # Display tool calls if they exist in the message and debug mode is enabled
+        if debug_mode and message.get("tool_calls"):
+            display_tool_calls(st.empty(), message["tool_calls"])
+        st.markdown(message["content"])
+
+
+def display_chat_history(debug_mode: bool) -> None:
+    """Display the chat history, with the older turns collapsed to their question.
+
+    A collapsed turn only renders its messages and tool calls once opened, so
+    the cost of a rerun does not grow with the length of the session.
+    """
+    turns = group_turns(st.session_state["messages"])
+    older_turns, recent_turns = turns[:-RECENT_TURNS], turns[-RECENT_TURNS:]
+
+    shown = st.session_state.get("history_turns_shown", HISTORY_TURNS_SHOWN)
+    hidden = max(len(older_turns) - shown, 0)
+    if hidden > 0:
+        if st.button(f"⬆️ Show earlier messages ({hidden} more)", key="show_earlier_turns"):
+            st.session_state["history_turns_shown"] = shown + HISTORY_TURNS_SHOWN
+            st.rerun()
+
+    session_id = st.session_state.get("messages_session_id")
+    for index in range(hidden, len(older_turns)):
+        turn = older_turns[index]
+        question = turn[0]["content"] if turn[0]["role"] == "user" else "Assistant"
+        label = " ".join(question.split())
+        if len(label) > 80:
+            label = label[:77] + "..."
+        # Keyed by the position of the turn in the session, which does not change as turns are added
+        if st.toggle(f"💬 {label}", key=f"history_turn_{session_id}_{index}"):
+            for message in turn:
+                display_message(message, debug_mode)
+
+    for turn in recent_turns:
+        for message in turn:
+            display_message(message, debug_mode)
+
+
 def sidebar_widget() -> None:
     """Display a sidebar with sample user queries"""
     with st.sidebar:
@@ -164,40 +276,63 @@ def sidebar_widget() -> None:
 
 
 def session_selector_widget(agent: Agent, model_id: str) -> None:
-    """Display a session selector in the sidebar"""
+    """Display a session selector in the sidebar, a page of sessions at a time"""
     if agent.storage:
-        agent_sessions = agent.storage.get_all_sessions()
+        search = st.sidebar.text_input("Search sessions", key="session_search")
+        if st.session_state.get("session_page_search") != search:
+            st.session_state["session_page_search"] = search
+            st.session_state["session_page"] = 0
+        page_number = st.session_state.get("session_page", 0)
+        page = get_session_index().list_sessions(
+            user_id=agent.user_id,
+            search=search,
+            limit=SESSIONS_PER_PAGE,
+            offset=page_number * SESSIONS_PER_PAGE,
+        )
+
         # Get session names if available, otherwise use IDs
-        session_options = []
-        for session in agent_sessions:
-            session_id = session.session_id
-            session_name = (
-                session.session_data.get("session_name", None)
-                if session.session_data
-                else None
-            )
-            display_name = session_name if session_name else session_id
-            session_options.append({"id": session_id, "display": display_name})
+        session_options = [{"id": s.session_id, "display": s.display_name} for s in page.sessions]
+        # The current session is always listed, e.g. when it is on another page or was just created
+        current_session_id = st.session_state["sql_agent_session_id"]
+        if current_session_id not in [s["id"] for s in session_options]:
+            session_options.insert(0, {"id": current_session_id, "display": agent.session_name or current_session_id})
+        session_ids = [s["id"] for s in session_options]
+
+        # Point the selector at the current session when it was changed elsewhere, e.g. by a new chat
+        if (
+            st.session_state.get("session_selector_session_id") != current_session_id
+            or st.session_state.get("session_selector") not in session_ids
+        ):
+            st.session_state["session_selector"] = current_session_id
+            st.session_state["session_selector_session_id"] = current_session_id
 
         # Display session selector
-        selected_session = st.sidebar.selectbox(
+        selected_session_id = st.sidebar.selectbox(
             "Session",
-            options=[s["display"] for s in session_options],
+            options=session_ids,
+            format_func=lambda session_id: next(s["display"] for s in session_options if s["id"] == session_id),
             key="session_selector",
         )
-        # Find the selected session ID
-        selected_session_id = next(
-            s["id"] for s in session_options if s["display"] == selected_session
-        )
 
-        if st.session_state["sql_agent_session_id"] != selected_session_id:
+        if page_number > 0 or page.has_more:
+            previous_col, count_col, next_col = st.sidebar.columns([1, 2, 1], vertical_alignment="center")
+            with previous_col:
+                if st.button("◀", key="previous_sessions", disabled=page_number == 0):
+                    st.session_state["session_page"] = page_number - 1
+                    st.rerun()
+            with count_col:
+                st.caption(f"{page.offset + 1}-{page.offset + len(page.sessions)} of {page.total}")
+            with next_col:
+                if st.button("▶", key="next_sessions", disabled=not page.has_more):
+                    st.session_state["session_page"] = page_number + 1
+                    st.rerun()
+
+        if current_session_id != selected_session_id:
             logger.info(
                 f"---*--- Loading {model_id} run: {selected_session_id} ---*---"
             )
-            st.session_state["sql_agent"] = get_sql_agent(
-                model_id=model_id,
-                session_id=selected_session_id,
-            )
+            # The next run of the script takes an agent bound to the selected session
+            st.session_state["sql_agent_session_id"] = selected_session_id
             st.rerun()
 
 
@@ -226,12 +361,27 @@ def rename_session_widget(agent: Agent) -> None:
             if st.button("✓", key="save_session_name", type="primary"):
                 if new_session_name:
                     agent.rename_session(new_session_name)
+                    get_session_index().invalidate()
                     st.session_state.session_edit_mode = False
                     container.success("Renamed!")
         else:
             if st.button("✎", key="edit_session_name"):
                 st.session_state.session_edit_mode = True
 
+
+def pool_metrics_widget() -> None:
+    """Display the utilization of the database connection pools in the sidebar"""
+    with st.sidebar.expander("🔌 Connection Pool", expanded=False):
+        for db_url, metrics in pool_metrics().items():
+            st.caption(db_url)
+            st.progress(
+                min(metrics["utilization"], 1.0),
+                text=f"{metrics['checked_out']}/{metrics['capacity']} connections in use "
+                f"(peak {metrics['peak_checked_out']})",
+            )
+            st.json(metrics, expanded=False)
+
+
 CUSTOM_CSS = """
     <style>
     /* Main Styles */